@@ -21,7 +21,295 @@
 #   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from casadi import *
+import numpy as NP
+import scipy.sparse
+import scipy.sparse.linalg
+import setup_nlp
+import forecast_do_mpc
 
+def typical_scaling(values):
+    """ Round typical magnitudes to the nearest power of ten. Zero or non-finite magnitudes get a scaling of 1 """
+    values = NP.abs(NP.array(values, dtype=float))
+    scaling = NP.ones(values.size)
+    valid = NP.isfinite(values) & (values > 0)
+    scaling[valid] = 10.0 ** NP.floor(NP.log10(values[valid]))
+    return scaling
 
+def typical_values(value, lb, ub):
+    """ Typical magnitude of a variable: its nominal value if it is not zero, otherwise the largest finite bound """
+    value = NP.abs(NP.array(value, dtype=float))
+    bounds = NP.abs(NP.vstack((lb, ub)).astype(float))
+    bounds[~NP.isfinite(bounds)] = 0
+    return NP.where(value > 0, value, NP.max(bounds, axis = 0))
 
-# TODO: here also add the automatic checking of the collocation accuracy and the calculation of a good initial condition
+def auto_scaling(model, p_nominal = None, tv_p_nominal = None, t_sim = 0, n_steps = 20):
+    """ Compute scaling factors for the states, the controls and the constraints of a model. The typical values of the
+    states are taken from x0 and the bounds or, if p_nominal is given and t_sim > 0, from a short open-loop simulation
+    with the initial input u0. Returns x_scaling, u_scaling, cons_scaling and cons_terminal_scaling, which can be
+    assigned to model.ocp before the optimizer and simulator are created. Note that rterm penalizes the scaled
+    control movements, so its weighting changes with u_scaling """
+    ocp = model.ocp
+    x_typical = typical_values(ocp.x0, ocp.x_lb, ocp.x_ub)
+    u_typical = typical_values(ocp.u0, ocp.u_lb, ocp.u_ub)
+    if p_nominal is not None and t_sim > 0:
+        if tv_p_nominal is None:
+            tv_p_nominal = NP.zeros(model.tv_p.size1())
+        dae = {'x': model.x, 'p': vertcat(model.u, model.p, model.tv_p), 'ode': model.rhs}
+        t_grid = NP.linspace(0, t_sim, n_steps + 1)
+        simulator = integrator("scaling_simulator", 'cvodes', dae, {'grid': t_grid, 'output_t0': True})
+        x_sim = NP.array(simulator(x0 = ocp.x0, p = vertcat(ocp.u0, p_nominal, tv_p_nominal))['xf'])
+        x_typical = NP.maximum(x_typical, NP.max(NP.abs(x_sim), axis = 1))
+    x_scaling = typical_scaling(x_typical)
+    u_scaling = typical_scaling(u_typical)
+    # The constraints are scaled with their bounds
+    n_cons = SX(ocp.cons).size1()
+    n_cons_terminal = SX(ocp.cons_terminal).size1()
+    cons_scaling = typical_scaling(ocp.cons_ub) if n_cons > 0 else NP.ones(0)
+    cons_terminal_scaling = NP.ones(n_cons_terminal)
+    if n_cons_terminal > 0:
+        cons_terminal_scaling = typical_scaling(typical_values(NP.zeros(n_cons_terminal), ocp.cons_terminal_lb, ocp.cons_terminal_ub))
+    return x_scaling, u_scaling, cons_scaling, cons_terminal_scaling
+
+
+def collocation_error(configuration, poly_degree = None, n_fin_elem = None):
+    """ Estimate the error of the collocation discretization. The collocation equations are solved for the optimal
+    inputs of the nominal scenario of the last optimization and compared with a high-accuracy simulation of the same
+    inputs. Returns the maximum error of the scaled states, relative to (1 + |x|), over the prediction horizon """
+    model = configuration.model
+    optimizer = configuration.optimizer
+    if optimizer.state_discretization != 'collocation':
+        raise Exception("The collocation error can only be estimated for state_discretization = 'collocation'")
+    deg = optimizer.poly_degree if poly_degree is None else poly_degree
+    [t_steps, n_fin_elems, _] = setup_nlp.prediction_grid(optimizer)
+    if n_fin_elem is not None:
+        n_fin_elems = [n_fin_elem] * len(t_steps)
+    nx = model.x.size1()
+    nu = model.u.size1()
+    np = model.p.size1()
+    ntv_p = model.tv_p.size1()
+    nz = model.z.size1()
+    nk = optimizer.n_horizon
+    X_offset = optimizer.nlp_dict_out['X_offset']
+    U_offset = optimizer.nlp_dict_out['U_offset']
+    # Nominal scenario: first parameter realization
+    p_nominal = optimizer.nlp_dict_out['p_scenario'][0]
+    TV_P = NP.array(optimizer.arg['p']['TV_P'])
+    v_opt = NP.squeeze(optimizer.opt_result_step.optimal_solution)
+    # High-accuracy simulation with the scaled stage function
+    stage_fcn = setup_nlp.scale_model(model)['stage_fcn']
+    dae = setup_nlp.dae_dict(model)
+    reference_tool = 'cvodes' if nz == 0 else 'idas'
+    # Reference integrator and solution of the collocation equations for given inputs for each interval of the grid
+    simulators = {}
+    for key in zip(t_steps, n_fin_elems):
+        if key not in simulators:
+            reference = integrator("reference", reference_tool, dae, {'abstol': 1e-10, 'reltol': 1e-10, 'tf': key[0]})
+            [ifcn, n_ik] = setup_nlp.collocation_fcn(stage_fcn, nx, nu, np, ntv_p, key[0], deg, optimizer.collocation,
+                                                     key[1], nz)
+            simulators[key] = (reference, rootfinder("collocation_simulator", 'newton', ifcn), n_ik)
+    x_ref = v_opt[X_offset[0, 0]:X_offset[0, 0] + nx]
+    x_col = x_ref
+    error = 0.0
+    for k in range(nk):
+        [reference, collocation_simulator, n_ik] = simulators[t_steps[k], n_fin_elems[k]]
+        u_k = v_opt[U_offset[k, 0]:U_offset[k, 0] + nu]
+        p_k = vertcat(u_k, p_nominal, TV_P[:, k])
+        x_ref = NP.squeeze(reference(x0 = x_ref, p = p_k, z0 = model.ocp.z0)['xf'])
+        ik_guess = setup_nlp.collocation_guess(x_col, model.ocp.z0, n_ik, deg)
+        [_, x_col] = collocation_simulator(ik_guess, x_col, p_nominal, u_k, TV_P[:, k])
+        x_col = NP.squeeze(NP.array(x_col))
+        error = max(error, NP.max(NP.abs(x_col - x_ref) / (1 + NP.abs(x_ref))))
+    return error
+
+def recommend_collocation(configuration, tol = 1e-4, apply = False, max_degree = 5, max_fin_elem = 4):
+    """ Find the discretization with the smallest number of collocation states per control interval whose estimated
+    collocation error is below tol. Requires a previous optimization. If apply is True, the optimizer is updated and
+    the solver is set up and solved again for the same initial state and parameters (it can be called in the loop).
+    Returns the poly_degree, n_fin_elem and the estimated error """
+    candidates = sorted([(deg * ni, deg, ni) for deg in range(1, max_degree + 1) for ni in range(1, max_fin_elem + 1)])
+    best = None
+    for (_, deg, ni) in candidates:
+        error = collocation_error(configuration, deg, ni)
+        if best is None or error < best[2]:
+            best = (deg, ni, error)
+        if error <= tol:
+            best = (deg, ni, error)
+            break
+    else:
+        print("No collocation discretization meets the tolerance. The most accurate one is recommended")
+    [deg, ni, error] = best
+    print("Recommended collocation: poly_degree = " + str(deg) + ", n_fin_elem = " + str(ni) + " (estimated error " + str(error) + ")")
+    if apply and (deg, ni) != (configuration.optimizer.poly_degree, configuration.optimizer.n_fin_elem):
+        optimizer = configuration.optimizer
+        nx = configuration.model.x.size1()
+        # The initial state, the previous input and the forecast of the current problem are kept: setup_solver
+        # resets them to the values of the templates
+        k = optimizer.k_current
+        X_offset = optimizer.nlp_dict_out['X_offset']
+        x_current = NP.array(optimizer.arg['lbx'][X_offset[k,0]:X_offset[k,0]+nx])
+        param = optimizer.arg['p']
+        optimizer.poly_degree = deg
+        optimizer.n_fin_elem = ni
+        configuration.setup_solver()
+        if optimizer.shrinking_horizon and k > 0:
+            configuration.shrink_horizon(x_current, k)
+        X_offset = optimizer.nlp_dict_out['X_offset']
+        optimizer.arg['lbx'][X_offset[k,0]:X_offset[k,0]+nx] = x_current
+        optimizer.arg['ubx'][X_offset[k,0]:X_offset[k,0]+nx] = x_current
+        optimizer.arg['p'] = param
+        configuration.make_step_optimizer()
+    return deg, ni, error
+
+def tv_p_horizon(optimizer, step_index):
+    """ Values of the time-varying parameters for the intervals of the prediction horizon (ntv_p x n_horizon) at the
+    given step. The values of tv_p_values (a dense array or a forecast provider, see forecast_do_mpc) can be given
+    for each interval or sampled with t_step over the look-ahead of a non-uniform prediction grid. In the second case
+    each interval takes the mean of the samples it covers and the last sample is held if the forecast is too short """
+    tv_p = forecast_do_mpc.forecast(optimizer.tv_p_values, step_index)
+    nk = optimizer.n_horizon
+    if tv_p.shape[1] == nk:
+        return tv_p
+    t_grid = setup_nlp.prediction_grid(optimizer)[2]
+    sample_grid = NP.rint(t_grid / optimizer.t_step).astype(int)
+    n_samples = tv_p.shape[1]
+    TV_P = NP.zeros((tv_p.shape[0], nk))
+    for k in range(nk):
+        first = min(sample_grid[k], n_samples - 1)
+        last = max(min(sample_grid[k + 1], n_samples), first + 1)
+        TV_P[:, k] = NP.mean(tv_p[:, first:last], axis = 1)
+    return TV_P
+
+def initial_guess(model, optimizer, nlp_dict_out, u_profile = None):
+    """ Compute an initial guess for the NLP by simulating the model over the prediction horizon for each scenario
+    of the tree. The inputs are u0 or the given profile (n_horizon x nu, not scaled), with move blocking the input
+    of the first interval of each block. The states, the collocation states and the end states are filled
+    consistently and clipped to their bounds. Returns vars_init """
+    nx = model.x.size1()
+    nu = model.u.size1()
+    np = model.p.size1()
+    ntv_p = model.tv_p.size1()
+    nk = optimizer.n_horizon
+    vars_init = NP.array(nlp_dict_out['vars_init'])
+    vars_lb = nlp_dict_out['vars_lb']
+    vars_ub = nlp_dict_out['vars_ub']
+    X_offset = nlp_dict_out['X_offset']
+    U_offset = nlp_dict_out['U_offset']
+    I_offset = nlp_dict_out['I_offset']
+    n_scenarios = nlp_dict_out['n_scenarios']
+    n_branches = nlp_dict_out['n_branches']
+    child_scenario = nlp_dict_out['child_scenario']
+    branch_offset = nlp_dict_out['branch_offset']
+    p_scenario = nlp_dict_out['p_scenario']
+    block_start = nlp_dict_out['block_start']
+    if u_profile is None:
+        u_profile = NP.tile(model.ocp.u0, (nk, 1))
+    u_profile = NP.array(u_profile) / model.ocp.u_scaling
+    TV_P = tv_p_horizon(optimizer, 0)
+    [t_steps, n_fin_elems, _] = setup_nlp.prediction_grid(optimizer)
+    # One step of the chosen discretization (for each interval of the prediction grid)
+    stage_fcn = setup_nlp.scale_model(model)['stage_fcn']
+    if optimizer.state_discretization == 'collocation':
+        steps = {}
+        for key in zip(t_steps, n_fin_elems):
+            if key not in steps:
+                [ifcn, n_ik] = setup_nlp.collocation_fcn(stage_fcn, nx, nu, np, ntv_p, key[0], optimizer.poly_degree,
+                                                         optimizer.collocation, key[1], model.z.size1())
+                steps[key] = rootfinder("collocation_simulator", 'newton', ifcn)
+    elif optimizer.state_discretization == 'discrete-time':
+        step = stage_fcn
+    else:
+        step = integrator("initial_guess_simulator", 'cvodes', setup_nlp.dae_dict(model), {'tf': optimizer.t_step})
+    try:
+        for k in range(nk):
+            if optimizer.state_discretization == 'collocation':
+                step = steps[t_steps[k], n_fin_elems[k]]
+                n_ik = nlp_dict_out['n_ik'][k]
+            for s in range(n_scenarios[k]):
+                x_ks = NP.array(vars_init[X_offset[k, s]:X_offset[k, s] + nx])
+                if k == 0:
+                    # The initial state is fixed by its bounds
+                    x_ks = vars_lb[X_offset[k, s]:X_offset[k, s] + nx]
+                if block_start[k]:
+                    u_ks = NP.clip(u_profile[k], vars_lb[U_offset[k, s]:U_offset[k, s] + nu], vars_ub[U_offset[k, s]:U_offset[k, s] + nu])
+                    vars_init[U_offset[k, s]:U_offset[k, s] + nu] = u_ks
+                else:
+                    # The intervals inside a block share the control of its first interval
+                    u_ks = NP.array(vars_init[U_offset[k, s]:U_offset[k, s] + nu])
+                for b in range(n_branches[k]):
+                    p_ksb = p_scenario[b + branch_offset[k][s]]
+                    if optimizer.state_discretization == 'collocation':
+                        ik_guess = setup_nlp.collocation_guess(x_ks, model.ocp.z0, n_ik, optimizer.poly_degree)
+                        [ik, xf] = step(ik_guess, x_ks, p_ksb, u_ks, TV_P[:, k])
+                        ik = NP.clip(NP.squeeze(NP.array(ik)), vars_lb[I_offset[k, s, b]:I_offset[k, s, b] + n_ik],
+                                     vars_ub[I_offset[k, s, b]:I_offset[k, s, b] + n_ik])
+                        vars_init[I_offset[k, s, b]:I_offset[k, s, b] + n_ik] = ik
+                    elif optimizer.state_discretization == 'discrete-time':
+                        xf = step(x_ks, u_ks, p_ksb, TV_P[:, k], [])[0]
+                    else:
+                        xf = step(x0 = x_ks, p = vertcat(u_ks, p_ksb, TV_P[:, k]))['xf']
+                    offset = X_offset[k + 1, child_scenario[k][s][b]]
+                    xf = NP.clip(NP.squeeze(NP.array(xf)), vars_lb[offset:offset + nx], vars_ub[offset:offset + nx])
+                    if not NP.all(NP.isfinite(xf)):
+                        raise Exception("Non-finite states")
+                    vars_init[offset:offset + nx] = xf
+    except Exception as error:
+        # Keep the constant initial guess if the simulation fails
+        print("Simulation of the initial guess failed (" + str(error) + "). The constant initial guess is used")
+        return NP.array(nlp_dict_out['vars_init'])
+    return vars_init
+
+def kkt_function(nlp_dict_out):
+    """ Hessian of the Lagrangian and Jacobian of the constraints of the NLP, kkt(v, p, lam_g) -> [H, Jg] """
+    nlp_fcn = nlp_dict_out['nlp_fcn']
+    V = nlp_fcn['x']
+    P = nlp_fcn['p'].cat
+    lam_g = MX.sym("lam_g", nlp_fcn['g'].size1())
+    [H, _] = hessian(nlp_fcn['f'] + dot(lam_g, nlp_fcn['g']), V)
+    return Function("kkt", [V, P, lam_g], [H, jacobian(nlp_fcn['g'], V)]).expand()
+
+def input_sensitivity(configuration):
+    """ Sensitivity du0/dx0 (nu x nx, scaled) of the first optimal input with respect to the initial state.
+    The primal-dual KKT matrix of the interior point method at the last solution (the bounds and the
+    inequality constraints enter through their barrier terms) is factorized once and solved for each
+    state. Returns None if the KKT matrix is singular """
+    optimizer = configuration.optimizer
+    nlp_dict_out = optimizer.nlp_dict_out
+    arg = optimizer.arg
+    result = optimizer.opt_result_step
+    nx = configuration.model.x.size1()
+    nu = configuration.model.u.size1()
+    X0 = nlp_dict_out['X_offset'][0, 0]
+    U0 = nlp_dict_out['U_offset'][0, 0]
+    v = NP.ravel(result.optimal_solution)
+    p = arg['p'].cat if hasattr(arg['p'], 'cat') else arg['p']
+    [H, Jg] = optimizer.kkt_fcn(v, p, result.lam_g)
+    H = H.sparse()
+    Jg = Jg.sparse()
+    lbg, ubg = NP.ravel(NP.array(arg['lbg'])), NP.ravel(NP.array(arg['ubg']))
+    lbx, ubx = NP.ravel(NP.array(arg['lbx'])), NP.ravel(NP.array(arg['ubx']))
+    g = NP.ravel(result.constraints)
+    # Equality constraints and fixed variables are kept as constraints
+    equality = NP.where(lbg == ubg)[0]
+    inequality = NP.where(lbg != ubg)[0]
+    fixed = NP.where(lbx == ubx)[0]
+    # Barrier terms (multiplier over distance to the bound) of the bounds and of the inequality constraints
+    distance_x = NP.maximum(NP.minimum(NP.abs(v - lbx), NP.abs(v - ubx)), 1e-12)
+    sigma_x = NP.abs(NP.ravel(result.lam_x)) / distance_x
+    sigma_x[fixed] = 0
+    distance_g = NP.maximum(NP.minimum(NP.abs(g - lbg), NP.abs(g - ubg)), 1e-12)
+    sigma_g = NP.abs(NP.ravel(result.lam_g)) / distance_g
+    J_in = Jg[inequality, :]
+    W = H + scipy.sparse.diags(sigma_x) + J_in.T.dot(scipy.sparse.diags(sigma_g[inequality])).dot(J_in)
+    J_eq = Jg[equality, :]
+    E = scipy.sparse.csc_matrix((NP.ones(fixed.size), (NP.arange(fixed.size), fixed)), shape = (fixed.size, v.size))
+    K = scipy.sparse.bmat([[W, J_eq.T, E.T], [J_eq, None, None], [E, None, None]], format = 'csc')
+    # Right-hand side: unit perturbation of the (fixed) initial states
+    rhs = NP.zeros((K.shape[0], nx))
+    for i in range(nx):
+        rhs[v.size + equality.size + NP.searchsorted(fixed, X0 + i), i] = 1
+    try:
+        solution = scipy.sparse.linalg.splu(K).solve(rhs)
+    except RuntimeError:
+        return None
+    return solution[U0:U0 + nu, :]
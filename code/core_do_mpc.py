@@ -25,8 +25,81 @@ import setup_nlp
 from casadi import *
 from casadi.tools import *
 import data_do_mpc
+import aux_do_mpc
+import plant_do_mpc
+import decomposition_do_mpc
+import integrator_do_mpc
+import forecast_do_mpc
+import observer_do_mpc
 import numpy as NP
+import time
 import pdb
+
+# Optional parameters of the optimizer and their default values
+optimizer_optional_parameters = {
+    # Hessian of the Lagrangian: 'exact', 'gauss-newton' or 'limited-memory'
+    "hessian_approximation": 'exact',
+    # Initial guess of the first optimization: 'constant' (x0 and u0) or 'simulation' of the model
+    "initial_guess": 'constant',
+    # Input profile (n_horizon x nu) for the simulation of the initial guess. By default u0 is used
+    "u_init_profile": None,
+    # Maximum number of iterations of the NLP solver
+    "max_iter": 500,
+    # Wall-clock budget (in seconds) of each optimization. None means no limit
+    "time_budget": None,
+    # Control input applied if the budget is exceeded or the solver fails: 'shift' (previous optimal
+    # solution), 'safe' (u_safe) or a function of the configuration returning an (unscaled) input
+    "fallback": 'shift',
+    # Safe control input (unscaled). By default u0 is used
+    "u_safe": None,
+    # Solution of the multi-stage NLP: None (monolithic) or 'admm' (scenario decomposition)
+    "decomposition": None,
+    # Options of the decomposition: rho, tol, max_iter, n_workers (processes) and n_threads
+    "decomposition_options": {},
+    # Advanced-step NMPC: compute the sensitivity of the first input to the initial state after each
+    # optimization to correct the input with the measurement (see correct_advanced_step)
+    "advanced_step": False,
+    # Move blocking: number of intervals of each block sharing the same control input (None: one per interval)
+    "move_blocking": None,
+    # Non-uniform prediction grid: length of each of the n_horizon intervals, the first one is t_step (None: all
+    # the intervals have the length t_step). n_fin_elem can then also be given for each interval
+    "t_step_horizon": None,
+    # Shrinking-horizon mode for batch processes: the NLP covers the whole batch (n_horizon * t_step = t_end) and the
+    # elapsed intervals are deactivated at each step (see shrink_horizon)
+    "shrinking_horizon": False}
+
+# Optional parameters of the simulator and their default values
+simulator_optional_parameters = {
+    # Number of sub-steps of the integration of each simulator step (the states at the sub-steps are kept in x_substeps)
+    "n_substeps": 1,
+    # Generate and compile C code of the simulator (only for the integration tools 'rk4' and 'radau')
+    "generate_code": False}
+
+# Optional parameters of the observer and their default values
+observer_optional_parameters = {
+    # State estimation: 'state_feedback' (the measured states are used), 'ekf' (extended Kalman filter), 'ukf' (unscented
+    # Kalman filter) or 'mhe' (moving horizon estimation), see observer_do_mpc
+    "method": 'state_feedback',
+    # Measured outputs as an expression of x, u, p and tv_p of the model (not scaled). None: all the states are measured
+    "meas": None,
+    # Scaling factors of the measured outputs (one by default)
+    "meas_scaling": None,
+    # Initial estimate of the states (x0 of the model by default) and covariance of its error (Q by default)
+    "x0": None,
+    "P0": None,
+    # Covariances (matrices or diagonals, not scaled) of the process noise over one simulator step and of the measurement noise
+    "Q": None,
+    "R": None,
+    # Moving horizon estimation: number of past simulator steps of the window, indices of the parameters p of the model
+    # that are estimated and covariance of their initial estimate (half range of the uncertainty values by default)
+    "mhe_horizon": 10,
+    "estimated_parameters": [],
+    "P0_p": None}
+
+# Optional parameters of the model (the scaling of the constraints is one by default). The algebraic equations
+# alg(x, z, u, p, tv_p) = 0 of index-1 DAEs, the initial guess (zero by default) and the bounds of the algebraic states z
+model_optional_parameters = ["cons_scaling", "cons_terminal_scaling", "alg", "z0", "z_lb", "z_ub"]
+
 class ocp:
     """ A class that contains a full description of the optimal control problem and will be used in the model class. This is dependent on a specific element of a model class"""
     def __init__(self, param_dict, *opt):
@@ -42,6 +115,13 @@ class ocp:
         # Scaling factors
         self.x_scaling = param_dict["x_scaling"]
         self.u_scaling = param_dict["u_scaling"]
+        self.cons_scaling = param_dict.get("cons_scaling", NP.ones(SX(param_dict["cons"]).size1()))
+        self.cons_terminal_scaling = param_dict.get("cons_terminal_scaling", NP.ones(SX(param_dict["cons_terminal"]).size1()))
+        # Initial guess and bounds of the algebraic states (not scaled)
+        nz = NP.size(param_dict["z"])
+        self.z0 = NP.array(param_dict.get("z0", NP.zeros(nz)), dtype = float)
+        self.z_lb = NP.array(param_dict.get("z_lb", -inf * NP.ones(nz)), dtype = float)
+        self.z_ub = NP.array(param_dict.get("z_ub", inf * NP.ones(nz)), dtype = float)
         # Symbolic nonlinear constraints
         self.cons = param_dict["cons"]
         # Upper bounds (no lower bounds for nonlinear constraints)
@@ -63,18 +143,34 @@ class ocp:
 class model:
     """A class for the definition model equations and optimal control problem formulation"""
     def __init__(self, param_dict, *opt):
-        # Assert for define length of param_dict
-        required_dimension = 25
+        # Assert for define length of param_dict (optional parameters are not counted)
+        required_dimension = 25 + len([key for key in param_dict if key in model_optional_parameters])
         if not (len(param_dict) == required_dimension):            raise Exception("Model / OCP information is incomplete. The number of elements in the dictionary is not correct")
         # Assign the main variables describing the model equations
         self.x = param_dict["x"]
         self.u = param_dict["u"]
         self.p = param_dict["p"]
-        self.z = param_dict["z"]
+        self.z = param_dict["z"] if NP.size(param_dict["z"]) > 0 else SX.sym("z", 0)
         self.rhs = param_dict["rhs"] # Right hand side of the DAE equations
+        self.alg = param_dict.get("alg", SX(0, 1)) # Algebraic equations of the DAE
         self.tv_p = param_dict["tv_p"]
+        if SX(self.alg).numel() != self.z.size1():
+            raise Exception("The number of algebraic equations (alg) must be equal to the number of algebraic states (z)")
          # Assign the main variables that describe the OCP
         self.ocp = ocp(param_dict)
+        # The algebraic states only enter the right-hand side and the algebraic equations
+        ocp_terms = [self.ocp.lterm, self.ocp.mterm, self.ocp.cons, self.ocp.cons_terminal]
+        if self.z.size1() > 0 and depends_on(vertcat(*[SX(e) for e in ocp_terms]), self.z):
+            raise Exception("The cost terms and the constraints cannot depend on the algebraic states")
+        # Automatic scaling from the bounds and the typical values if chosen in the template ('auto')
+        scaling_names = ['x_scaling', 'u_scaling', 'cons_scaling', 'cons_terminal_scaling']
+        if any([isinstance(getattr(self.ocp, name), str) for name in scaling_names]):
+            auto_scaling = aux_do_mpc.auto_scaling(self)
+            for name, scaling in zip(scaling_names, auto_scaling):
+                if isinstance(getattr(self.ocp, name), str):
+                    setattr(self.ocp, name, scaling)
+        # Scaled model functions, generated once by setup_nlp.scale_model
+        self.scaled_model = None
 
     @classmethod
     def user_model(cls, param_dict, *opt):
@@ -85,17 +181,18 @@ class model:
 class simulator:
     """A class for the definition model equations and optimal control problem formulation"""
     def __init__(self, model_simulator, param_dict, *opt):
-        # Assert for define length of param_dict
-        required_dimension = 10
+        # Assert for define length of param_dict (optional parameters are not counted)
+        required_dimension = 10 + len([key for key in param_dict if key in simulator_optional_parameters])
         if not (len(param_dict) == required_dimension): raise Exception("Simulator information is incomplete. The number of elements in the dictionary is not correct")
-        # Unscale the states on the rhs
-        rhs_unscaled = substitute(model_simulator.rhs, model_simulator.x, model_simulator.x * model_simulator.ocp.x_scaling)/model_simulator.ocp.x_scaling
-        rhs_unscaled = substitute(rhs_unscaled, model_simulator.u, model_simulator.u * model_simulator.ocp.u_scaling)
-        dae = {'x':model_simulator.x, 'p':vertcat(model_simulator.u,model_simulator.p, model_simulator.tv_p), 'ode':rhs_unscaled}
-        opts = param_dict["integrator_opts"]
-        #NOTE: Check the scaling factors (appear to be fine)
-        simulator_do_mpc = integrator("simulator", param_dict["integration_tool"], dae,  opts)
+        # Optional parameters take their default value if not given in the template
+        for key in simulator_optional_parameters:
+            setattr(self, key, param_dict.get(key, simulator_optional_parameters[key]))
+        # Simulator of the scaled model (built once for each model, integration tool and options, see integrator_do_mpc)
+        simulator_do_mpc = integrator_do_mpc.simulator_function(model_simulator, param_dict["integration_tool"],
+                           param_dict["t_step_simulator"], param_dict["integrator_opts"], self.n_substeps, self.generate_code)
         self.simulator = simulator_do_mpc
+        self.integration_tool = param_dict["integration_tool"]
+        self.integrator_opts = param_dict["integrator_opts"]
         self.plot_states = param_dict["plot_states"]
         self.plot_control = param_dict["plot_control"]
         self.plot_anim = param_dict["plot_anim"]
@@ -109,8 +206,29 @@ class simulator:
         # NOTE:  The same initial condition than for the optimizer is imposed
         self.x0_sim = model_simulator.ocp.x0 / model_simulator.ocp.x_scaling
         self.xf_sim = 0
+        # Input applied in the last simulator step
+        self.u_sim = model_simulator.ocp.u0 / model_simulator.ocp.u_scaling
+        # Algebraic states of DAE models, consistent with the initial condition
+        self.z0_sim = integrator_do_mpc.consistent_algebraic_states(model_simulator, self.x0_sim,
+                      model_simulator.ocp.u0 / model_simulator.ocp.u_scaling, self.p_real_now(0), self.tv_p_real_now(0), model_simulator.ocp.z0)
+        self.zf_sim = self.z0_sim
+        # States at the sub-steps of the last simulator step (n_substeps x nx)
+        self.x_substeps = []
         # This is an index to account for the MPC iteration. Starts at 1
         self.mpc_iteration = 1
+        # Connection to a real plant (see application). None means that the model is simulated
+        self.plant = None
+        # Precomputed trajectories of the parameters and the noise (see disturbance_do_mpc). None means that
+        # p_real_now and tv_p_real_now are called at each step
+        self.disturbances = None
+
+    def real_parameters(self, t):
+        " Real values of the parameters and of the time-varying parameters at the time t"
+        if self.disturbances is None:
+            return self.p_real_now(t), self.tv_p_real_now(t)
+        index = self.disturbances.step_index(t)
+        return self.disturbances.p_real[index], self.disturbances.tv_p_real[index]
+
     @classmethod
     def user_simulator(cls, param_dict, *opt):
         " This is open for the implementation of a user-defined simulator class"
@@ -118,10 +236,13 @@ class simulator:
         return cls(dummy)
 
     @classmethod
-    def application(cls, param_dict, *opt):
-        " This is open for the implementation of connection to a real plant"
-        dummy = 1
-        return cls(dummy)
+    def application(cls, model_simulator, param_dict, address, **connector_opts):
+        " Simulator whose steps are applied to a real plant (or the stand-in plant server of plant_do_mpc) at the given address"
+        simulator_do_mpc = cls(model_simulator, param_dict)
+        # The plant answers with the (unscaled) states
+        connector_opts.setdefault('n_measurements', model_simulator.x.size1())
+        simulator_do_mpc.plant = plant_do_mpc.plant_connector(address, **connector_opts)
+        return simulator_do_mpc
 
 class optimizer:
     '''This is a class that defines a do-mpc optimizer. The class uses a local model, which
@@ -129,8 +250,8 @@ class optimizer:
     def __init__(self, optimizer_model, param_dict, *opt):
         # Set the local model to be used by the model
         self.optimizer_model = optimizer_model
-        # Assert for the required size of the parameters
-        required_dimension = 16
+        # Assert for the required size of the parameters (optional parameters are not counted)
+        required_dimension = 16 + len([key for key in param_dict if key in optimizer_optional_parameters])
         if not (len(param_dict) == required_dimension): raise Exception("The length of the parameter dictionary is not correct!")
         # Define optimizer parameters
         self.n_horizon = param_dict["n_horizon"]
@@ -148,15 +269,36 @@ class optimizer:
         self.qp_solver = param_dict["qp_solver"]
         # Define model uncertain parameters
         self.uncertainty_values = param_dict["uncertainty_values"]
-        # Define time varying optimizer parameters
-        self.tv_p_values = param_dict["tv_p_values"]
+        # Define time varying optimizer parameters: all the forecasts or a forecast provider (see forecast_do_mpc)
+        self.tv_p_values = forecast_do_mpc.provider(param_dict["tv_p_values"])
         self.parameters_nlp = param_dict["parameters_nlp"]
+        # Optional parameters take their default value if not given in the template
+        for key in optimizer_optional_parameters:
+            setattr(self, key, param_dict.get(key, optimizer_optional_parameters[key]))
         # Initialize empty methods for completion later
         self.solver = []
         self.arg = []
         self.nlp_dict_out = []
         self.opt_result_step = []
-        self.u_mpc = optimizer_model.ocp.u0
+        # Last optimal solution obtained within the time budget (used by the 'shift' fallback)
+        self.opt_result_success = []
+        # The first control input is the (scaled) initial input
+        self.u_mpc = optimizer_model.ocp.u0 / optimizer_model.ocp.u_scaling
+        # Status of the last optimization step
+        self.overrun = False
+        self.fallback_applied = False
+        # Number of consecutive steps in which a fallback was applied
+        self.n_fallback_steps = 0
+        # Sensitivity of the first input to the initial state and point of the last optimization (advanced step)
+        self.sensitivity = None
+        self.x_advanced = None
+        self.u_advanced = None
+        # Interval of the NLP at the current time (only different from zero in shrinking-horizon mode)
+        self.k_current = 0
+        # Number of simulator steps per sampling time of the optimizer (multi-rate loop, see setup_solver)
+        self.n_rate = 1
+        # Whether the optimizer was solved in the current simulator step
+        self.solved_step = False
     @classmethod
     def user_optimizer(cls, optimizer_model, param_dict, *opt):
         "This method is open for the impelmentation of a user defined optimizer"
@@ -166,7 +308,40 @@ class optimizer:
 class observer:
     """A class for the definition model equations and optimal control problem formulation"""
     def __init__(self, model_observer, param_dict, *opt):
+        # Assert for define length of param_dict (optional parameters are not counted)
+        required_dimension = 1 + len([key for key in param_dict if key in observer_optional_parameters])
+        if not (len(param_dict) == required_dimension): raise Exception("Observer information is incomplete. The number of elements in the dictionary is not correct")
         self.x = param_dict['x']
+        # Optional parameters take their default value if not given in the template
+        for key in observer_optional_parameters:
+            setattr(self, key, param_dict.get(key, observer_optional_parameters[key]))
+        # Scaled measurement function meas_fcn(x, u, p, tv_p) -> y. If all the states are measured y is the scaled state
+        if self.meas is None:
+            self.meas_scaling = model_observer.ocp.x_scaling
+        elif self.meas_scaling is None:
+            self.meas_scaling = NP.ones(SX(self.meas).size1())
+        self.meas_fcn = observer_do_mpc.measurement_function(model_observer, self.meas, self.meas_scaling)
+        # State estimator, built by the configuration (see setup_estimator)
+        self.estimator = None
+        self.observed_states = model_observer.ocp.x0 / model_observer.ocp.x_scaling
+        # Wall time of the last estimation
+        self.cpu_time = 0.0
+
+    def setup_estimator(self, configuration):
+        " Build the estimator of the chosen method"
+        if self.method == 'ekf':
+            self.estimator = observer_do_mpc.ekf(configuration)
+        elif self.method == 'ukf':
+            self.estimator = observer_do_mpc.ukf(configuration)
+        elif self.method == 'mhe':
+            self.estimator = observer_do_mpc.mhe(configuration)
+        elif self.method == 'state_feedback':
+            if self.meas is not None:
+                raise Exception("State feedback needs all the states to be measured (meas = None)")
+            self.estimator = None
+        else:
+            raise Exception('Unknown observer method ' + str(self.method))
+
     @classmethod
     def user_observer(cls, param_dict, *opt):
         " This is open for the implementation of a user-defined estimator class"
@@ -184,21 +359,69 @@ class configuration:
         self.simulator = simulator
         # The data structure
         self.mpc_data = data_do_mpc.mpc_data(self)
+        # State estimator of the observer
+        self.observer.setup_estimator(self)
+        # Optional store of past solutions for warm starting (see warmstart_do_mpc)
+        self.warm_start_store = None
 
     def setup_solver(self):
         # Call setup_nlp to generate the NLP
         nlp_dict_out = setup_nlp.setup_nlp(self.model, self.optimizer)
+        # Report the size of the NLP and the constraints that were imposed as bounds
+        print("NLP with " + str(nlp_dict_out['vars_init'].size) + " variables and " + str(nlp_dict_out['lbg'].size1()) +
+              " constraints (" + str(nlp_dict_out['n_bound_constraints']) + " rows of cons/cons_terminal imposed as bounds)")
         # Set options
         opts = {}
         opts["expand"] = True
         opts["ipopt.linear_solver"] = self.optimizer.linear_solver
-        #NOTE: this could be passed as parameters of the optimizer class
-        opts["ipopt.max_iter"] = 500
+        opts["ipopt.max_iter"] = self.optimizer.max_iter
         opts["ipopt.tol"] = 1e-6
-        # Setup the solver
-        solver = nlpsol("solver", self.optimizer.nlp_solver, nlp_dict_out['nlp_fcn'], opts)
+        # Real-time mode: limit the time spent by the solver
+        if self.optimizer.time_budget is not None:
+            opts["ipopt.max_cpu_time"] = self.optimizer.time_budget
+        # Approximation of the Hessian of the Lagrangian
+        if self.optimizer.hessian_approximation == 'gauss-newton':
+            opts["hess_lag"] = nlp_dict_out['hess_lag']
+        elif self.optimizer.hessian_approximation == 'limited-memory':
+            opts["ipopt.hessian_approximation"] = 'limited-memory'
+        elif self.optimizer.hessian_approximation != 'exact':
+            raise Exception('Unknown Hessian approximation ' + str(self.optimizer.hessian_approximation))
+        # Use the multipliers of the warm start
+        if self.warm_start_store is not None:
+            opts["ipopt.warm_start_init_point"] = 'yes'
+        # The NLP of the shrinking-horizon mode covers the whole batch with the intervals of a single scenario
+        if self.optimizer.shrinking_horizon:
+            if self.optimizer.n_robust != 0 or self.optimizer.t_step_horizon is not None:
+                raise Exception("The shrinking-horizon mode requires n_robust = 0 and a uniform prediction grid")
+            if abs(self.optimizer.n_horizon * self.optimizer.t_step - self.optimizer.t_end) > 1e-10 * self.optimizer.t_end:
+                raise Exception("In shrinking-horizon mode the prediction horizon must cover the batch (n_horizon * t_step = t_end)")
+        self.optimizer.k_current = 0
+        # Multi-rate loop: the optimizer runs every n_rate steps of the simulator
+        n_rate = int(round(self.optimizer.t_step / self.simulator.t_step_simulator))
+        if n_rate < 1 or abs(n_rate * self.simulator.t_step_simulator - self.optimizer.t_step) > 1e-10 * self.optimizer.t_step:
+            raise Exception("The sampling time of the optimizer must be a multiple of the sampling time of the simulator")
+        self.optimizer.n_rate = n_rate
+        # Hessian of the Lagrangian and Jacobian of the constraints for the sensitivity of the solution
+        if self.optimizer.advanced_step:
+            self.optimizer.kkt_fcn = aux_do_mpc.kkt_function(nlp_dict_out)
+        # Setup the solver (the worker processes of a previous decomposition are stopped)
+        if isinstance(self.optimizer.solver, decomposition_do_mpc.admm_solver):
+            self.optimizer.solver.close()
+        if self.optimizer.decomposition == 'admm':
+            # The decomposition does not assemble the multipliers of the monolithic NLP
+            if self.optimizer.advanced_step or self.warm_start_store is not None:
+                raise Exception("The decomposition 'admm' cannot be combined with advanced_step or a warm_start_store")
+            solver = decomposition_do_mpc.admm_solver(self.model, self.optimizer, nlp_dict_out, opts, **self.optimizer.decomposition_options)
+        elif self.optimizer.decomposition is None:
+            solver = nlpsol("solver", self.optimizer.nlp_solver, nlp_dict_out['nlp_fcn'], opts)
+        else:
+            raise Exception('Unknown decomposition ' + str(self.optimizer.decomposition))
         arg = {}
         # Initial condition
+        if self.optimizer.initial_guess == 'simulation':
+            nlp_dict_out['vars_init'] = aux_do_mpc.initial_guess(self.model, self.optimizer, nlp_dict_out, self.optimizer.u_init_profile)
+        elif self.optimizer.initial_guess != 'constant':
+            raise Exception('Unknown initial guess ' + str(self.optimizer.initial_guess))
         arg["x0"] = nlp_dict_out['vars_init']
         # Bounds on x
         arg["lbx"] = nlp_dict_out['vars_lb']
@@ -213,46 +436,153 @@ class configuration:
         parameters_setup_nlp = struct_symMX([entry("uk_prev",shape=(nu)), entry("TV_P",shape=(ntv_p,nk))])
         param = parameters_setup_nlp(0)
         # First value of the nlp parameters
-        param["uk_prev"] = self.model.ocp.u0
-        param["TV_P"] = self.optimizer.tv_p_values[0]
+        param["uk_prev"] = self.model.ocp.u0 / self.model.ocp.u_scaling
+        param["TV_P"] = aux_do_mpc.tv_p_horizon(self.optimizer, 0)
         arg["p"] = param
+        # Cold start from the nearest stored solution
+        if self.warm_start_store is not None:
+            X_offset = nlp_dict_out['X_offset']
+            nx = self.model.x.size(1)
+            x0 = NP.array(nlp_dict_out['vars_lb'][X_offset[0,0]:X_offset[0,0]+nx])
+            stored = self.warm_start_store.query(x0, param["TV_P"])
+            if stored is not None and stored[0].size == nlp_dict_out['vars_init'].size:
+                arg["x0"], arg["lam_x0"], arg["lam_g0"] = stored[0], stored[1], stored[2]
         # Add new attributes to the optimizer class
         self.optimizer.solver = solver
         self.optimizer.arg = arg
         self.optimizer.nlp_dict_out = nlp_dict_out
 
+    def optimizer_due(self):
+        """ Whether the optimizer runs in the current simulator step (every n_rate steps in a multi-rate loop) """
+        return (self.simulator.mpc_iteration - 1) % self.optimizer.n_rate == 0
+
     def make_step_optimizer(self):
+        # In a multi-rate loop the last input is held between the sampling times of the optimizer
+        self.optimizer.solved_step = self.optimizer_due()
+        if not self.optimizer.solved_step:
+            self.optimizer.overrun = False
+            return
         arg = self.optimizer.arg
-        result = self.optimizer.solver(x0=arg['x0'], lbx=arg['lbx'], ubx=arg['ubx'], lbg=arg['lbg'], ubg=arg['ubg'], p = arg['p'])
-        # Store the full solution
+        lam_x0 = arg['lam_x0'] if 'lam_x0' in arg else 0
+        lam_g0 = arg['lam_g0'] if 'lam_g0' in arg else 0
+        t_start = time.time()
+        result = self.optimizer.solver(x0=arg['x0'], lbx=arg['lbx'], ubx=arg['ubx'], lbg=arg['lbg'], ubg=arg['ubg'], p = arg['p'],
+                                       lam_x0 = lam_x0, lam_g0 = lam_g0)
+        t_solve = time.time() - t_start
+        success = self.optimizer.solver.stats()['success']
+        self.optimizer.overrun = self.optimizer.time_budget is not None and t_solve > self.optimizer.time_budget
+        # Store the full solution (also used as initial guess of the next optimization)
         self.optimizer.opt_result_step = data_do_mpc.opt_result(result)
+        # Apply a fallback if the solver failed or exceeded the budget
+        if not success or self.optimizer.overrun:
+            self.optimizer.sensitivity = None
+            self.apply_fallback()
+            return
+        self.optimizer.fallback_applied = False
+        self.optimizer.n_fallback_steps = 0
+        self.optimizer.opt_result_success = self.optimizer.opt_result_step
+        # Record the solution in the warm start store
+        if self.warm_start_store is not None:
+            X_offset = self.optimizer.nlp_dict_out['X_offset']
+            nx = self.model.x.size(1)
+            x0 = NP.array(arg['lbx'][X_offset[0,0]:X_offset[0,0]+nx])
+            self.warm_start_store.add(x0, arg['p']["TV_P"], result['x'], result['lam_x'], result['lam_g'])
         # Extract the optimal control input to be applied
         nu = len(self.optimizer.u_mpc)
         U_offset = self.optimizer.nlp_dict_out['U_offset']
         v_opt = self.optimizer.opt_result_step.optimal_solution
-        self.optimizer.u_mpc = NP.resize(NP.array(v_opt[U_offset[0][0]:U_offset[0][0]+nu]),(nu))
+        k = self.optimizer.k_current
+        self.optimizer.u_mpc = NP.resize(NP.array(v_opt[U_offset[k][0]:U_offset[k][0]+nu]),(nu))
+        # Sensitivity of the input for the correction with the measurement
+        if self.optimizer.advanced_step:
+            X_offset = self.optimizer.nlp_dict_out['X_offset']
+            nx = self.model.x.size(1)
+            self.optimizer.sensitivity = aux_do_mpc.input_sensitivity(self)
+            self.optimizer.x_advanced = NP.ravel(NP.array(arg['lbx'][X_offset[0,0]:X_offset[0,0]+nx]))
+            self.optimizer.u_advanced = NP.copy(self.optimizer.u_mpc)
+
+    def correct_advanced_step(self, observed_states = None):
+        """ Correct the input of the optimization solved in advance for a predicted initial state with
+        the sensitivity of the solution and the measured states (advanced-step NMPC) """
+        if observed_states is None:
+            observed_states = self.observer.observed_states
+        if self.optimizer.sensitivity is None:
+            return
+        nu = len(self.optimizer.u_mpc)
+        U_offset = self.optimizer.nlp_dict_out['U_offset']
+        du = NP.dot(self.optimizer.sensitivity, NP.ravel(observed_states) - self.optimizer.x_advanced)
+        # The corrected input is kept within the bounds
+        u_lb = NP.ravel(NP.array(self.optimizer.arg['lbx'][U_offset[0][0]:U_offset[0][0]+nu]))
+        u_ub = NP.ravel(NP.array(self.optimizer.arg['ubx'][U_offset[0][0]:U_offset[0][0]+nu]))
+        self.optimizer.u_mpc = NP.clip(self.optimizer.u_advanced + du, u_lb, u_ub)
+
+    def apply_fallback(self):
+        """ Control input used when the optimizer fails or exceeds its time budget """
+        self.optimizer.fallback_applied = True
+        self.optimizer.n_fallback_steps = self.optimizer.n_fallback_steps + 1
+        nu = len(self.optimizer.u_mpc)
+        nk = self.optimizer.n_horizon
+        U_offset = self.optimizer.nlp_dict_out['U_offset']
+        fallback = self.optimizer.fallback
+        # Without a previous optimal solution the shifted solution is not available
+        if fallback == 'shift' and self.optimizer.opt_result_success == []:
+            fallback = 'safe'
+        if fallback == 'shift':
+            # The last optimal solution is shifted by the number of consecutive fallback steps (the input is taken from
+            # the interval of the prediction grid that contains the current time)
+            v_opt = self.optimizer.opt_result_success.optimal_solution
+            t_grid = self.optimizer.nlp_dict_out['t_grid']
+            t_shift = self.optimizer.n_fallback_steps * self.optimizer.t_step
+            k = min(NP.searchsorted(t_grid, t_shift + 1e-10 * self.optimizer.t_step, side = 'right') - 1 + self.optimizer.k_current, nk - 1)
+            self.optimizer.u_mpc = NP.resize(NP.array(v_opt[U_offset[k][0]:U_offset[k][0]+nu]),(nu))
+            return
+        if fallback == 'safe':
+            u_safe = self.model.ocp.u0 if self.optimizer.u_safe is None else self.optimizer.u_safe
+        elif callable(fallback):
+            u_safe = fallback(self)
+        else:
+            raise Exception('Unknown fallback ' + str(fallback))
+        self.optimizer.u_mpc = NP.resize(NP.array(u_safe, dtype = float), (nu)) / self.model.ocp.u_scaling
 
     def make_step_observer(self):
         self.make_measurement()
-        self.observer.observed_states = self.simulator.measurement # NOTE: this is a dummy observer
+        if self.observer.estimator is None:
+            self.observer.observed_states = self.simulator.measurement
+        else:
+            t0 = time.time()
+            self.observer.observed_states = self.observer.estimator.make_step(self)
+            self.observer.cpu_time = time.time() - t0
 
-    def make_step_simulator(self):
-        # Extract the necessary information for the simulation
-        u_mpc = self.optimizer.u_mpc
+    def make_step_simulator(self, u_mpc = None):
+        # Extract the necessary information for the simulation (by default the last optimal input)
+        if u_mpc is None:
+            u_mpc = self.optimizer.u_mpc
         # Use the real parameters
-        p_real = self.simulator.p_real_now(self.simulator.t0_sim)
-        tv_p_real = self.simulator.tv_p_real_now(self.simulator.t0_sim)
-        if self.optimizer.state_discretization == 'discrete-time':
-            rhs_unscaled = substitute(self.model.rhs, self.model.x, self.model.x * self.model.ocp.x_scaling)/self.model.ocp.x_scaling
-            rhs_unscaled = substitute(rhs_unscaled, self.model.u, self.model.u * self.model.ocp.u_scaling)
-            rhs_fcn = Function('rhs_fcn',[self.model.x,vertcat(self.model.u,self.model.p)],[rhs_unscaled])
-            x_next = rhs_fcn(self.simulator.x0_sim,vertcat(u_mpc,p_real))
+        p_real, tv_p_real = self.simulator.real_parameters(self.simulator.t0_sim)
+        self.simulator.u_sim = u_mpc
+        if self.simulator.plant is not None:
+            # Send the (unscaled) control moves to the plant and receive the measured states
+            x_plant = self.simulator.plant.exchange(NP.ravel(u_mpc) * self.model.ocp.u_scaling, self.simulator.t0_sim)
+            self.simulator.xf_sim = x_plant / self.model.ocp.x_scaling
+        elif self.optimizer.state_discretization == 'discrete-time':
+            stage_fcn = setup_nlp.scale_model(self.model)['stage_fcn']
+            x_next = stage_fcn(self.simulator.x0_sim, u_mpc, p_real, tv_p_real, [])[0]
             self.simulator.xf_sim = NP.squeeze(NP.array(x_next))
         else:
-            result  = self.simulator.simulator(x0 = self.simulator.x0_sim, p = vertcat(u_mpc,p_real,tv_p_real))
-            self.simulator.xf_sim = NP.squeeze(result['xf'])
+            # The last algebraic states are the initial guess of the consistent initialization of DAE models
+            dae_arg = {'z0': self.simulator.z0_sim} if self.model.z.size1() > 0 else {}
+            result  = self.simulator.simulator(x0 = self.simulator.x0_sim, p = vertcat(u_mpc,p_real,tv_p_real), **dae_arg)
+            self.simulator.x_substeps = NP.array(result['xf']).T
+            self.simulator.xf_sim = NP.squeeze(self.simulator.x_substeps[-1])
+            if dae_arg:
+                self.simulator.zf_sim = NP.array(result['zf'])[:, -1]
+        # Additive process noise of the simulated plant
+        if self.simulator.disturbances is not None and self.simulator.plant is None:
+            index = self.simulator.disturbances.step_index(self.simulator.t0_sim)
+            self.simulator.xf_sim = self.simulator.xf_sim + self.simulator.disturbances.process_noise[index] / self.model.ocp.x_scaling
         # Update the initial condition for the next iteration
         self.simulator.x0_sim = self.simulator.xf_sim
+        self.simulator.z0_sim = self.simulator.zf_sim
         # Correction for sizes of arrays when dimension is 1
         if self.simulator.xf_sim.shape ==  ():
             self.simulator.xf_sim = NP.array([self.simulator.xf_sim])
@@ -262,12 +592,25 @@ class configuration:
         self.simulator.tf_sim = self.simulator.tf_sim + self.simulator.t_step_simulator
 
     def make_measurement(self):
-        # NOTE: Here implement the own measurement function (or load it)
-        # This is a dummy measurement
-        self.simulator.measurement = self.simulator.xf_sim
+        # The (scaled) measured outputs of the observer at the end of the last step. By default all the states are measured
+        if self.observer.meas is None:
+            self.simulator.measurement = self.simulator.xf_sim
+        else:
+            p_real, tv_p_real = self.simulator.real_parameters(self.simulator.t0_sim)
+            y = self.observer.meas_fcn(self.simulator.xf_sim, self.simulator.u_sim, p_real, tv_p_real)
+            self.simulator.measurement = NP.ravel(NP.array(y))
+        # Measurement noise of the simulated plant
+        if self.simulator.disturbances is not None and self.simulator.plant is None:
+            index = self.simulator.disturbances.step_index(self.simulator.t0_sim)
+            self.simulator.measurement = self.simulator.measurement + self.simulator.disturbances.measurement_noise[index] / self.observer.meas_scaling
 
-    def prepare_next_iter(self):
-        observed_states = self.observer.observed_states
+    def prepare_next_iter(self, observed_states = None, step_index = None):
+        # By default the observed states and the current step of the optimizer are used
+        if observed_states is None:
+            observed_states = self.observer.observed_states
+        # In a multi-rate loop the next optimization is only prepared at the sampling times of the optimizer
+        if step_index is None and not self.optimizer_due():
+            return
         X_offset = self.optimizer.nlp_dict_out['X_offset']
         nx = self.model.x.size(1)
         nu = self.model.u.size(1)
@@ -277,25 +620,153 @@ class configuration:
         param = parameters_setup_nlp(0)
         # First value of the nlp parameters
         param["uk_prev"] = self.optimizer.u_mpc
-        step_index = int(self.simulator.t0_sim / self.simulator.t_step_simulator)
-        param["TV_P"] = self.optimizer.tv_p_values[step_index]
+        if step_index is None:
+            step_index = (self.simulator.mpc_iteration - 1) // self.optimizer.n_rate
+        tv_p_values = aux_do_mpc.tv_p_horizon(self.optimizer, step_index)
+        # Interval of the last optimization
+        k_last = self.optimizer.k_current
+        if self.optimizer.shrinking_horizon:
+            self.shrink_horizon(observed_states, step_index)
+            # The forecast starts at the current interval of the batch
+            k = self.optimizer.k_current
+            tv_p_values = NP.hstack((NP.tile(tv_p_values[:, :1], (1, k)), tv_p_values[:, :nk - k]))
+        param["TV_P"] = tv_p_values
+        k = self.optimizer.k_current
         # Enforce the observed states as initial point for next optimization
 
-        self.optimizer.arg['lbx'][X_offset[0,0]:X_offset[0,0]+nx] = observed_states
-        self.optimizer.arg['ubx'][X_offset[0,0]:X_offset[0,0]+nx] = observed_states
+        self.optimizer.arg['lbx'][X_offset[k,0]:X_offset[k,0]+nx] = observed_states
+        self.optimizer.arg['ubx'][X_offset[k,0]:X_offset[k,0]+nx] = observed_states
         self.optimizer.arg["x0"] = self.optimizer.opt_result_step.optimal_solution
+        self.optimizer.arg["lam_x0"] = self.optimizer.opt_result_step.lam_x
+        self.optimizer.arg["lam_g0"] = self.optimizer.opt_result_step.lam_g
+        # Use the nearest stored solution if the measurement is far from the predicted state
+        if self.warm_start_store is not None:
+            x_predicted = NP.squeeze(self.optimizer.opt_result_step.optimal_solution[X_offset[k_last+1,0]:X_offset[k_last+1,0]+nx])
+            distance = NP.linalg.norm(x_predicted - observed_states)
+            if distance > self.warm_start_store.distance_threshold:
+                stored = self.warm_start_store.query(observed_states, param["TV_P"])
+                if stored is not None and stored[0].size == self.optimizer.arg["x0"].size and \
+                   NP.linalg.norm(stored[0][X_offset[k,0]:X_offset[k,0]+nx] - observed_states) < distance:
+                    self.optimizer.arg["x0"], self.optimizer.arg["lam_x0"], self.optimizer.arg["lam_g0"] = stored[0], stored[1], stored[2]
         # Pass as parameter the used control input
         self.optimizer.arg['p'] = param
 
-    def store_mpc_data(self):
+    def shrink_horizon(self, observed_states, step_index):
+        """ Shrinking-horizon mode: the intervals of the batch which have elapsed are deactivated through the bounds
+        of the NLP instead of rebuilding it. Their states and inputs are fixed (the solver removes fixed variables) and
+        their constraints are relaxed, so that the optimization covers the remaining batch time """
+        nlp_dict_out = self.optimizer.nlp_dict_out
+        X_offset = nlp_dict_out['X_offset']
+        U_offset = nlp_dict_out['U_offset']
+        I_offset = nlp_dict_out['I_offset']
+        G_offset = nlp_dict_out['G_offset']
+        nx = self.model.x.size(1)
+        nu = self.model.u.size(1)
+        arg = self.optimizer.arg
+        # The last interval (end of the batch) remains active
+        k_current = min(step_index, self.optimizer.n_horizon - 1)
+        for k in range(k_current):
+            n_ik = nlp_dict_out['n_ik'][k]
+            for bounds in (arg['lbx'], arg['ubx']):
+                bounds[X_offset[k,0]:X_offset[k,0]+nx] = observed_states
+                bounds[I_offset[k,0,0]:I_offset[k,0,0]+n_ik] = setup_nlp.collocation_guess(observed_states, self.model.ocp.z0, n_ik, self.optimizer.poly_degree)
+                # The last input is the previous input of the first active interval
+                bounds[U_offset[k,0]:U_offset[k,0]+nu] = self.optimizer.u_mpc
+            arg['lbg'][G_offset[k]:G_offset[k+1]] = -inf
+            arg['ubg'][G_offset[k]:G_offset[k+1]] = inf
+        self.optimizer.k_current = k_current
+
+    def solve_batch(self, x0, u_prev = None, tv_p = None, mode = 'serial', n_threads = 1, chain_warm_start = False):
+        """ Solve the NLP for stacked (unscaled) initial states x0 (n_points x nx), previous inputs u_prev
+        (n_points x nu, u0 by default) and forecasts tv_p (n_points x ntv_p x n_horizon, first values by default).
+        mode 'serial' solves the points one after the other, optionally warm starting each point with the
+        solution of the previous one (chain_warm_start). mode 'map' solves all points with a mapped solver
+        Function on n_threads threads. Returns the (unscaled) optimal inputs, the costs and the success of each point """
+        nlp_dict_out = self.optimizer.nlp_dict_out
+        X_offset = nlp_dict_out['X_offset']
+        U_offset = nlp_dict_out['U_offset']
+        nx = self.model.x.size(1)
+        nu = self.model.u.size(1)
+        ntv_p = self.model.tv_p.size(1)
+        nk = self.optimizer.n_horizon
+        x0 = NP.reshape(x0, (-1, nx)) / self.model.ocp.x_scaling
+        n_points = x0.shape[0]
+        if u_prev is None:
+            u_prev = NP.tile(self.model.ocp.u0, (n_points, 1))
+        u_prev = NP.reshape(u_prev, (n_points, nu)) / self.model.ocp.u_scaling
+        if tv_p is None:
+            tv_p = NP.tile(aux_do_mpc.tv_p_horizon(self.optimizer, 0), (n_points, 1, 1))
+        # Bounds and parameters of each point (one column per point)
+        vars_lb = NP.tile(NP.reshape(nlp_dict_out['vars_lb'], (-1, 1)), (1, n_points))
+        vars_ub = NP.tile(NP.reshape(nlp_dict_out['vars_ub'], (-1, 1)), (1, n_points))
+        vars_lb[X_offset[0,0]:X_offset[0,0]+nx, :] = x0.T
+        vars_ub[X_offset[0,0]:X_offset[0,0]+nx, :] = x0.T
+        parameters_setup_nlp = struct_symMX([entry("uk_prev",shape=(nu)), entry("TV_P",shape=(ntv_p,nk))])
+        param = parameters_setup_nlp(0)
+        p = NP.zeros((param.cat.numel(), n_points))
+        for i in range(n_points):
+            param["uk_prev"] = u_prev[i]
+            param["TV_P"] = NP.reshape(tv_p[i], (ntv_p, nk))
+            p[:, i] = NP.ravel(param.cat)
+        vars_init = NP.reshape(nlp_dict_out['vars_init'], (-1, 1))
+        solver = self.optimizer.solver
+        if mode == 'serial':
+            v_opt = NP.zeros((vars_init.size, n_points))
+            cost = NP.zeros(n_points)
+            success = NP.zeros(n_points, dtype = bool)
+            arg = {'x0': vars_init, 'lbg': nlp_dict_out['lbg'], 'ubg': nlp_dict_out['ubg']}
+            for i in range(n_points):
+                result = solver(lbx = vars_lb[:, i], ubx = vars_ub[:, i], p = p[:, i], **arg)
+                v_opt[:, i] = NP.ravel(result['x'])
+                cost[i] = float(result['f'])
+                success[i] = solver.stats()['success']
+                # Warm start the next point with the current solution
+                if chain_warm_start:
+                    arg = {'x0': result['x'], 'lam_x0': result['lam_x'], 'lam_g0': result['lam_g'],
+                           'lbg': nlp_dict_out['lbg'], 'ubg': nlp_dict_out['ubg']}
+        elif mode == 'map':
+            solver_map = solver.map(n_points, 'thread', n_threads)
+            lbg = NP.array(nlp_dict_out['lbg'])
+            ubg = NP.array(nlp_dict_out['ubg'])
+            result = solver_map(x0 = NP.tile(vars_init, (1, n_points)), lbx = vars_lb, ubx = vars_ub,
+                                lbg = NP.tile(lbg, (1, n_points)), ubg = NP.tile(ubg, (1, n_points)), p = p)
+            v_opt = NP.array(result['x'])
+            cost = NP.ravel(NP.array(result['f']))
+            # The statistics of the mapped solver are not available: check the feasibility of each solution
+            g = NP.array(result['g'])
+            violation = NP.maximum(NP.max(NP.maximum(g - ubg, lbg - g), axis = 0),
+                                   NP.max(NP.maximum(v_opt - vars_ub, vars_lb - v_opt), axis = 0))
+            success = violation <= 1e-6
+        else:
+            raise Exception('Unknown batch mode ' + str(mode))
+        u_opt = v_opt[U_offset[0][0]:U_offset[0][0]+nu, :].T * self.model.ocp.u_scaling
+        return {'u': u_opt, 'cost': cost, 'success': success}
+
+    def solve_statistics(self):
+        """ Cost, solver statistics, overrun and fallback of the last optimization (the solver statistics are only
+        recorded in the steps in which the optimizer was solved) """
+        stats = self.optimizer.solver.stats() if self.optimizer.solved_step else {'t_wall_solver': 0.0, 'iter_count': 0}
+        return {'cost': NP.array(self.optimizer.opt_result_step.optimal_cost), 'cpu': stats['t_wall_solver'],
+                'iter': stats['iter_count'], 'overrun': self.optimizer.overrun, 'fallback': self.optimizer.fallback_applied}
+
+    def store_mpc_data(self, u_mpc = None, statistics = None):
+        """ Store the results of the last step. By default the last optimal input was applied; the statistics of the
+        optimization that gave u_mpc (see solve_statistics) are needed if the optimizer has been called since then """
         mpc_iteration = self.simulator.mpc_iteration - 1 #Because already increased in the simulator
         data = self.mpc_data
+        if u_mpc is None:
+            u_mpc = self.optimizer.u_mpc
+        if statistics is None:
+            statistics = self.solve_statistics()
         data.mpc_states = NP.append(data.mpc_states, [self.simulator.xf_sim], axis = 0)
-        data.mpc_control = NP.append(data.mpc_control, [self.optimizer.u_mpc], axis = 0)
-        #data.mpc_alg = NP.append(data.mpc_alg, [NP.zeros(NP.size(self.model.z))], axis = 0) # TODO: To be completed for DAEs
+        data.mpc_control = NP.append(data.mpc_control, [u_mpc], axis = 0)
+        data.mpc_alg = NP.append(data.mpc_alg, [self.simulator.zf_sim], axis = 0)
         data.mpc_time = NP.append(data.mpc_time, [[self.simulator.t0_sim]], axis = 0)
-        data.mpc_cost = NP.append(data.mpc_cost, self.optimizer.opt_result_step.optimal_cost, axis = 0)
+        data.mpc_cost = NP.append(data.mpc_cost, statistics['cost'], axis = 0)
         #data.mpc_ref = NP.append(data.mpc_ref, [[0]], axis = 0) # TODO: To be completed
-        stats = self.optimizer.solver.stats()
-        data.mpc_cpu = NP.append(data.mpc_cpu, [[stats['t_wall_solver']]], axis = 0)
-        data.mpc_parameters = NP.append(data.mpc_parameters, [self.simulator.p_real_now(self.simulator.t0_sim)], axis = 0)
+        data.mpc_cpu = NP.append(data.mpc_cpu, [[statistics['cpu']]], axis = 0)
+        data.mpc_iter = NP.append(data.mpc_iter, [[statistics['iter']]], axis = 0)
+        data.mpc_cpu_observer = NP.append(data.mpc_cpu_observer, [[self.observer.cpu_time]], axis = 0)
+        data.mpc_overrun = NP.append(data.mpc_overrun, [[statistics['overrun']]], axis = 0)
+        data.mpc_fallback = NP.append(data.mpc_fallback, [[statistics['fallback']]], axis = 0)
+        data.mpc_parameters = NP.append(data.mpc_parameters, [self.simulator.real_parameters(self.simulator.t0_sim)[0]], axis = 0)
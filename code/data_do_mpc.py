@@ -50,10 +50,19 @@ class mpc_data:
         self.mpc_cost = NP.resize(NP.array([]),(1, 1))
         self.mpc_ref = NP.resize(NP.array([]),(1, 1))
         self.mpc_cpu = NP.resize(NP.array([]),(1, 1))
+        self.mpc_iter = NP.resize(NP.array([]),(1, 1))
+        # Wall time of the state estimation of the observer
+        self.mpc_cpu_observer = NP.resize(NP.array([]),(1, 1))
+        # Steps in which the time budget was exceeded and in which a fallback was applied
+        self.mpc_overrun = NP.resize(NP.array([]),(1, 1))
+        self.mpc_fallback = NP.resize(NP.array([]),(1, 1))
+        # Delay of the start of each sampling period (only filled by the real-time loop of realtime_do_mpc)
+        self.mpc_jitter = NP.resize(NP.array([]),(1, 1))
         self.mpc_parameters = NP.resize(NP.array([]),(1, np))
         # Initialize with initial conditions
         self.mpc_states[0,:] = configuration.model.ocp.x0 / configuration.model.ocp.x_scaling
         self.mpc_control[0,:] = configuration.model.ocp.u0 / configuration.model.ocp.u_scaling
+        self.mpc_alg[0,:] = configuration.simulator.z0_sim
         self.mpc_time[0] = 0
 
 class opt_result:
@@ -62,6 +71,9 @@ class opt_result:
         self.optimal_solution = NP.array(res["x"])
         self.optimal_cost = NP.array(res["f"])
         self.constraints = NP.array(res["g"])
+        # Lagrange multipliers of the bounds and the constraints
+        self.lam_x = NP.array(res["lam_x"])
+        self.lam_g = NP.array(res["lam_g"])
 
 
 
@@ -120,13 +132,12 @@ def plot_mpc(configuration):
 
 
 
-def plot_state_pred(v,t0,el,lineop, n_scenarios, n_branches, nk, child_scenario, X_offset, x_scaling, t_step):
+def plot_state_pred(v,t0,el,lineop, n_scenarios, n_branches, nk, child_scenario, X_offset, x_scaling, t_grid):
   # This function plots the prediction of a state
   #plt.clf()
   plt.hold(True)
-  # Time grid
-  tf = t_step * nk
-  tgrid = NP.linspace(t0,t0+tf,nk+1)
+  # Time grid (start times of the intervals of the prediction grid)
+  tgrid = t0 + NP.array(t_grid)
   # For all control intervals
   for k in range(nk):
     # For all scenarios
@@ -141,12 +152,11 @@ def plot_state_pred(v,t0,el,lineop, n_scenarios, n_branches, nk, child_scenario,
         plt.plot(tgrid[k:k+2],x_segment,lineop)
 
 
-def plot_control_pred(v,t0,el,lineop, n_scenarios, n_branches, nk, parent_scenario, U_offset, u_scaling, t_step, u_last_step):
+def plot_control_pred(v,t0,el,lineop, n_scenarios, n_branches, nk, parent_scenario, U_offset, u_scaling, t_grid, u_last_step):
 	# This function plots the prediction of a control input
 	plt.hold(True)
-	# Time grid
-	tf = t_step * nk
-	tgrid = NP.linspace(t0,t0+tf,nk+1)
+	# Time grid (start times of the intervals of the prediction grid)
+	tgrid = t0 + NP.array(t_grid)
 	# For all control intervals
 	for k in range(nk):
 		# For all scenarios
@@ -189,8 +199,10 @@ def plot_animation(configuration):
         child_scenario = configuration.optimizer.nlp_dict_out['child_scenario']
         parent_scenario = configuration.optimizer.nlp_dict_out['parent_scenario']
         nk = configuration.optimizer.n_horizon
-        t0 = configuration.simulator.t0_sim - configuration.simulator.t_step_simulator
-        t_step = configuration.simulator.t_step_simulator
+        # Start of the prediction: last sampling time of the optimizer (multi-rate loop)
+        n_held = (configuration.simulator.mpc_iteration - 2) % configuration.optimizer.n_rate + 1
+        t0 = configuration.simulator.t0_sim - n_held * configuration.simulator.t_step_simulator
+        t_grid = configuration.optimizer.nlp_dict_out['t_grid']
         v_opt = configuration.optimizer.opt_result_step.optimal_solution
         plt.ion()
         total_subplots = len(plot_states) + len(plot_control)
@@ -201,7 +213,7 @@ def plot_animation(configuration):
         for index in range(len(plot_states)):
         	plot = plt.subplot(total_subplots, 1, index + 1)
         	# First plot the prediction
-        	plot_state_pred(v_opt, t0, plot_states[index], '-b', n_scenarios, n_branches, nk, child_scenario, X_offset, x_scaling, t_step)
+        	plot_state_pred(v_opt, t0, plot_states[index], '-b', n_scenarios, n_branches, nk, child_scenario, X_offset, x_scaling, t_grid)
         	plt.plot(mpc_time[0:index_mpc], mpc_states[0:index_mpc,plot_states[index]] * x_scaling[plot_states[index]], '-k', linewidth=2.0)
         	plt.ylabel(str(x[plot_states[index]]))
         	plt.xlabel("Time")
@@ -212,7 +224,7 @@ def plot_animation(configuration):
         for index in range(len(plot_control)):
         	plot = plt.subplot(total_subplots, 1, len(plot_states) + index + 1)
         	# First plot the prediction
-        	plot_control_pred(v_opt, t0, plot_control[index], '-b', n_scenarios, n_branches, nk, parent_scenario, U_offset, u_scaling, t_step, mpc_control[index_mpc-1,plot_control[index]])
+        	plot_control_pred(v_opt, t0, plot_control[index], '-b', n_scenarios, n_branches, nk, parent_scenario, U_offset, u_scaling, t_grid, mpc_control[index_mpc-1,plot_control[index]])
         	plt.plot(mpc_time[0:index_mpc], mpc_control[0:index_mpc,plot_control[index]] * u_scaling[plot_control[index]],'-k' ,drawstyle='steps', linewidth=2.0)
         	plt.ylabel(str(u[plot_control[index]]))
         	plt.xlabel("Time")
@@ -0,0 +1,239 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import time
+import concurrent.futures
+import numpy as NP
+import setup_nlp
+from casadi import *
+
+# Subproblem solver of each worker process (built once by init_worker)
+worker_solver = None
+
+def init_worker(nlp_serialized, nlp_solver, opts):
+    global worker_solver
+    worker_solver = nlpsol("subproblem", nlp_solver, Function.deserialize(nlp_serialized), opts)
+
+def solve_worker(arg):
+    result = worker_solver(**arg)
+    return dict((key, NP.array(result[key])) for key in ('x', 'lam_x', 'lam_g')), worker_solver.stats()['success']
+
+class admm_solver:
+    """ Scenario decomposition of the multi-stage NLP. The scenario tree is split into one subproblem
+    per scenario (path from the root to a leaf) and the non-anticipativity of the controls of the
+    robust horizon (of all stages for open_loop) is enforced with ADMM (progressive hedging).
+    The subproblems are solved in parallel (n_workers processes or n_threads threads) and warm
+    started with the previous coordination iteration. The object is called like the solver of the
+    monolithic NLP and returns its solution in the layout of the scenario tree (without the multipliers,
+    which are returned as zeros) """
+    def __init__(self, model, optimizer, nlp_dict_out, opts, rho = 10.0, tol = 1e-4, max_iter = 50, n_workers = None, n_threads = 1):
+        self.tol = tol
+        self.max_iter = max_iter
+        self.n_threads = n_threads
+        self.nlp_dict_out = nlp_dict_out
+        nk = optimizer.n_horizon
+        nx = model.x.size(1)
+        nu = model.u.size(1)
+        self.nk, self.nx, self.nu = nk, nx, nu
+        self.soft_constraint = model.ocp.soft_constraint
+        parent_scenario = nlp_dict_out['parent_scenario']
+        child_scenario = nlp_dict_out['child_scenario']
+        branch_offset = nlp_dict_out['branch_offset']
+        self.n_leaves = nlp_dict_out['n_scenarios'][nk]
+        # Node of each stage and realization of the parameters along the path of each scenario
+        self.nodes = NP.zeros((self.n_leaves, nk + 1), dtype = int)
+        self.branches = NP.zeros((self.n_leaves, nk), dtype = int)
+        paths = NP.zeros((self.n_leaves, nk), dtype = int)
+        for leaf in range(self.n_leaves):
+            self.nodes[leaf, nk] = leaf
+            for k in range(nk - 1, -1, -1):
+                self.nodes[leaf, k] = parent_scenario[k + 1][self.nodes[leaf, k + 1]]
+                s = self.nodes[leaf, k]
+                self.branches[leaf, k] = list(child_scenario[k][s]).index(self.nodes[leaf, k + 1])
+                paths[leaf, k] = self.branches[leaf, k] + branch_offset[k][s]
+        # The NLP of all scenarios only differ in the bounds of the parameters of each stage
+        sub = setup_nlp.setup_nlp(model, optimizer, paths[0])
+        self.sub = sub
+        np = model.p.size(1)
+        self.sub_lb = NP.tile(sub['vars_lb'], (self.n_leaves, 1))
+        self.sub_ub = NP.tile(sub['vars_ub'], (self.n_leaves, 1))
+        for leaf in range(self.n_leaves):
+            for k in range(nk):
+                self.sub_lb[leaf, k*np:(k+1)*np] = sub['p_scenario'][paths[leaf, k]]
+                self.sub_ub[leaf, k*np:(k+1)*np] = sub['p_scenario'][paths[leaf, k]]
+        # Non-anticipative controls and the node (consensus group) they belong to
+        self.na_stages = list(range(nk)) if optimizer.open_loop == 1 else list(range(min(optimizer.n_robust, nk)))
+        self.na_index = NP.concatenate([NP.arange(sub['U_offset'][k, 0], sub['U_offset'][k, 0] + nu) for k in self.na_stages] + [NP.array([], dtype = int)])
+        self.groups = []
+        for k in self.na_stages:
+            key = self.nodes[:, k] if optimizer.open_loop != 1 else NP.zeros(self.n_leaves, dtype = int)
+            self.groups.append([NP.where(key == node)[0] for node in NP.unique(key)])
+        n_na = self.na_index.size
+        # Augmented Lagrangian of each subproblem: parameters of the NLP, multipliers, consensus and penalty
+        # (one penalty per control, adapted to balance its own residuals, so that inputs of very different
+        # magnitudes converge at the same rate)
+        V = sub['nlp_fcn']['x']
+        p_nlp = sub['nlp_fcn']['p'].cat
+        lam_na = MX.sym("lam_na", n_na)
+        v_bar = MX.sym("v_bar", n_na)
+        rho_sym = MX.sym("rho", n_na)
+        v_na = V[self.na_index.tolist()] if n_na > 0 else MX(0, 1)
+        f_aug = sub['nlp_fcn']['f'] + dot(lam_na, v_na) + dot(rho_sym, (v_na - v_bar) ** 2) / 2
+        nlp_aug = Function("nlp_aug", [V, vertcat(p_nlp, lam_na, v_bar, rho_sym)], [f_aug, sub['nlp_fcn']['g']], ['x', 'p'], ['f', 'g'])
+        # The Gauss-Newton Hessian of the monolithic NLP does not apply to the subproblems
+        sub_opts = dict((key, value) for key, value in opts.items() if key != "hess_lag")
+        sub_opts["ipopt.warm_start_init_point"] = 'yes'
+        sub_opts["ipopt.mu_init"] = 1e-3
+        sub_opts["ipopt.print_level"] = 0
+        sub_opts["print_time"] = False
+        if n_workers is None:
+            self.executor = None
+            self.solver = nlpsol("subproblem", optimizer.nlp_solver, nlp_aug, sub_opts)
+        else:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = n_workers, initializer = init_worker,
+                                                                   initargs = (nlp_aug.serialize(), optimizer.nlp_solver, sub_opts))
+        # Cost and constraints of the monolithic NLP to evaluate the assembled solution
+        nlp_fcn = nlp_dict_out['nlp_fcn']
+        self.nlp_eval = Function("nlp_eval", [nlp_fcn['x'], nlp_fcn['p'].cat], [nlp_fcn['f'], nlp_fcn['g']])
+        # Iterates of the subproblems and multipliers (kept as warm start of the next call)
+        self.iterates = [{'x': sub['vars_init'], 'lam_x': NP.zeros(sub['vars_init'].size), 'lam_g': NP.zeros(sub['lbg'].size1())}
+                         for leaf in range(self.n_leaves)]
+        self.lam_na = NP.zeros((self.n_leaves, n_na))
+        self.v_bar = NP.zeros((self.n_leaves, n_na))
+        self.rho = rho * NP.ones(n_na)
+        self.last_stats = {}
+
+    def consensus(self, v_na):
+        """ Average of the non-anticipative controls over the scenarios sharing a node """
+        v_bar = NP.zeros(v_na.shape)
+        nu = self.nu
+        for i, groups in enumerate(self.groups):
+            for leaves in groups:
+                v_bar[NP.ix_(leaves, range(i*nu, (i+1)*nu))] = NP.mean(v_na[leaves, i*nu:(i+1)*nu], axis = 0)
+        return v_bar
+
+    def solve_subproblems(self, p, x_init):
+        sub = self.sub
+        X0 = sub['X_offset'][0, 0]
+        args = []
+        for leaf in range(self.n_leaves):
+            lbx = NP.copy(self.sub_lb[leaf])
+            ubx = NP.copy(self.sub_ub[leaf])
+            lbx[X0:X0+self.nx] = x_init
+            ubx[X0:X0+self.nx] = x_init
+            p_aug = NP.concatenate((p, self.lam_na[leaf], self.v_bar[leaf], self.rho))
+            args.append({'x0': self.iterates[leaf]['x'], 'lam_x0': self.iterates[leaf]['lam_x'], 'lam_g0': self.iterates[leaf]['lam_g'],
+                         'lbx': lbx, 'ubx': ubx, 'lbg': sub['lbg'], 'ubg': sub['ubg'], 'p': p_aug})
+        if self.executor is not None:
+            results = list(self.executor.map(solve_worker, args))
+        elif self.n_threads > 1:
+            solver_map = self.solver.map(self.n_leaves, 'thread', self.n_threads)
+            stacked = dict((key, horzcat(*[DM(arg[key]) for arg in args])) for key in args[0])
+            result = solver_map(**stacked)
+            results = [(dict((key, NP.array(result[key][:, leaf])) for key in ('x', 'lam_x', 'lam_g')), True) for leaf in range(self.n_leaves)]
+        else:
+            results = []
+            for arg in args:
+                result = self.solver(**arg)
+                results.append((dict((key, NP.array(result[key])) for key in ('x', 'lam_x', 'lam_g')), self.solver.stats()['success']))
+        self.iterates = [result[0] for result in results]
+        return all(result[1] for result in results)
+
+    def __call__(self, x0 = None, lbx = None, ubx = None, lbg = None, ubg = None, p = None, lam_x0 = None, lam_g0 = None):
+        t_start = time.time()
+        nlp_dict_out = self.nlp_dict_out
+        p = NP.ravel(NP.array(p.cat if hasattr(p, 'cat') else DM(p)))
+        X_offset = nlp_dict_out['X_offset']
+        x_init = NP.ravel(NP.array(lbx))[X_offset[0, 0]:X_offset[0, 0]+self.nx]
+        converged = False
+        n_iter = 0
+        r_primal = r_dual = inf
+        while n_iter < self.max_iter:
+            n_iter += 1
+            success = self.solve_subproblems(p, x_init)
+            v_na = NP.array([NP.ravel(iterate['x'])[self.na_index] for iterate in self.iterates])
+            v_bar = self.consensus(v_na)
+            # Primal and dual residuals of the consensus of each control
+            r_primal_na = NP.max(NP.abs(v_na - v_bar), axis = 0)
+            r_dual_na = self.rho * NP.max(NP.abs(v_bar - self.v_bar), axis = 0)
+            r_primal = NP.max(r_primal_na) if v_na.size > 0 else 0.0
+            r_dual = NP.max(r_dual_na) if v_na.size > 0 else 0.0
+            self.lam_na = self.lam_na + self.rho * (v_na - v_bar)
+            self.v_bar = v_bar
+            if success and r_primal < self.tol and r_dual < self.tol:
+                converged = True
+                break
+            # Balance the primal and dual residuals
+            self.rho = NP.where(r_primal_na > 2 * r_dual_na, 2 * self.rho, self.rho)
+            self.rho = NP.where(r_dual_na > 2 * r_primal_na, self.rho / 2, self.rho)
+        v_opt = self.assemble(x0, lbx)
+        [f, g] = self.nlp_eval(v_opt, p)
+        self.last_stats = {'success': converged, 'iter_count': n_iter, 'r_primal': r_primal, 'r_dual': r_dual,
+                           'return_status': 'Converged' if converged else 'Maximum_Iterations_Exceeded',
+                           't_wall_solver': time.time() - t_start, 't_wall_total': time.time() - t_start}
+        return {'x': DM(v_opt), 'f': f, 'g': g, 'lam_x': DM.zeros(v_opt.size), 'lam_g': DM.zeros(g.size1())}
+
+    def assemble(self, x0, lbx):
+        """ Solution of the subproblems in the layout of the scenario tree (the consensus is used for the shared controls) """
+        nlp_dict_out = self.nlp_dict_out
+        sub = self.sub
+        nk, nx, nu = self.nk, self.nx, self.nu
+        X_offset, U_offset, I_offset = nlp_dict_out['X_offset'], nlp_dict_out['U_offset'], nlp_dict_out['I_offset']
+        # Parameters (fixed by their bounds) and possibly unused variables are taken from the initial guess
+        v_opt = NP.ravel(NP.array(x0, dtype = float)).copy()
+        lbx = NP.ravel(NP.array(lbx))
+        n_p_vars = len(nlp_dict_out['p_scenario']) * nlp_dict_out['p_scenario'].shape[1]
+        v_opt[:n_p_vars] = lbx[:n_p_vars]
+        # The violation of the soft constraints is the largest of all scenarios
+        if self.soft_constraint:
+            E_offset = nlp_dict_out['E_offset']
+            v_opt[E_offset:] = 0
+        for leaf in range(self.n_leaves):
+            v_sub = NP.ravel(self.iterates[leaf]['x'])
+            for k in range(nk):
+                s = self.nodes[leaf, k]
+                v_opt[X_offset[k, s]:X_offset[k, s]+nx] = v_sub[sub['X_offset'][k, 0]:sub['X_offset'][k, 0]+nx]
+                if k in self.na_stages:
+                    i = self.na_stages.index(k)
+                    v_opt[U_offset[k, s]:U_offset[k, s]+nu] = self.v_bar[leaf, i*nu:(i+1)*nu]
+                else:
+                    v_opt[U_offset[k, s]:U_offset[k, s]+nu] = v_sub[sub['U_offset'][k, 0]:sub['U_offset'][k, 0]+nu]
+                # Collocation variables of the interval (none for the other discretizations)
+                n_ik = nlp_dict_out['n_ik'][k]
+                if n_ik:
+                    b = self.branches[leaf, k]
+                    v_opt[I_offset[k, s, b]:I_offset[k, s, b]+n_ik] = v_sub[sub['I_offset'][k, 0, 0]:sub['I_offset'][k, 0, 0]+n_ik]
+            v_opt[X_offset[nk, leaf]:X_offset[nk, leaf]+nx] = v_sub[sub['X_offset'][nk, 0]:sub['X_offset'][nk, 0]+nx]
+            if self.soft_constraint:
+                v_opt[E_offset:] = NP.maximum(v_opt[E_offset:], v_sub[sub['E_offset']:])
+        return v_opt
+
+    def stats(self):
+        return self.last_stats
+
+    def close(self):
+        """ Stop the worker processes """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
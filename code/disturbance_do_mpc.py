@@ -0,0 +1,98 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy as NP
+from scipy.signal import lfilter
+
+def generate_trajectory(rng, n_rows, n, kind = 'correlated', std = 0.0, hold = 1, correlation = 0.0, lb = -NP.inf, ub = NP.inf, nominal = 0.0):
+    """ Random trajectory (n_rows x n) around the nominal values (or starting at them) with the standard deviation std of each
+    component: 'piecewise_constant' (normal values held for hold steps), 'random_walk' (cumulative sum of normal
+    increments) or 'correlated' (first-order autoregressive noise with the given correlation between two steps,
+    white noise for correlation = 0). The trajectory is added to the nominal values and the sum is clipped to [lb, ub],
+    so that the bounds are those of the disturbed signal (e.g. the physical range of a parameter) """
+    std = NP.resize(NP.array(std, dtype = float), n)
+    if kind == 'piecewise_constant':
+        n_holds = -(-n_rows // hold)
+        values = NP.repeat(rng.standard_normal((n_holds, n)), hold, axis = 0)[:n_rows] * std
+    elif kind == 'random_walk':
+        values = NP.cumsum(rng.standard_normal((n_rows, n)), axis = 0) * std
+    elif kind == 'correlated':
+        if not 0.0 <= correlation < 1.0:
+            raise Exception("The correlation of the noise must be in [0, 1)")
+        # Stationary AR(1) process x[i] = correlation * x[i-1] + sqrt(1 - correlation^2) * e[i] with x[0] = e[0]
+        scale = NP.sqrt(1.0 - correlation ** 2)
+        innovation = rng.standard_normal((n_rows, n))
+        innovation[0] /= scale
+        values = lfilter([scale], [1.0, -correlation], innovation, axis = 0) * std
+    else:
+        raise Exception('Unknown disturbance type ' + str(kind))
+    return NP.clip(nominal + values, lb, ub)
+
+class disturbance_scenario:
+    """ Whole-run trajectories of the real parameters (p_real), the time-varying parameters (tv_p_real), the measurement
+    noise and the additive process noise of the simulator, generated once from one seed. Row i holds the values at the
+    time i * t_step_simulator. It is attached to the simulator (simulator.disturbances), which then indexes the arrays
+    instead of calling p_real_now and tv_p_real_now.
+    Each signal is given as None (the closures of the simulator for p_real and tv_p_real, no noise), an array with the
+    whole trajectory or a dictionary with the options of generate_trajectory (kind, std, hold, correlation, lb, ub).
+    The random trajectories of p_real and tv_p_real are added to the values of the closures (lb and ub bound the sum).
+    The noise is not scaled """
+    def __init__(self, configuration, seed = 0, n_steps = None, p_real = None, tv_p_real = None,
+                 measurement_noise = None, process_noise = None):
+        simulator = configuration.simulator
+        nx = configuration.model.x.size1()
+        # Number of measured outputs of the observer
+        n_meas = configuration.observer.meas_fcn.size1_out(0)
+        self.seed = seed
+        self.t_step = simulator.t_step_simulator
+        if n_steps is None:
+            n_steps = int(NP.ceil(configuration.optimizer.t_end / self.t_step - 1e-10))
+        self.n_steps = n_steps
+        # One independent random stream for each signal: changing the options of one signal does not change the others
+        rngs = [NP.random.default_rng(seed_sequence) for seed_sequence in NP.random.SeedSequence(seed).spawn(4)]
+        # The values are also needed at the end of the last step
+        times = NP.arange(n_steps + 1) * self.t_step
+        self.p_real = self.signal(rngs[0], p_real, NP.array([NP.ravel(simulator.p_real_now(t)) for t in times], dtype = float))
+        self.tv_p_real = self.signal(rngs[1], tv_p_real, NP.array([NP.ravel(simulator.tv_p_real_now(t)) for t in times], dtype = float))
+        self.measurement_noise = self.signal(rngs[2], measurement_noise, NP.zeros((n_steps + 1, n_meas)))
+        self.process_noise = self.signal(rngs[3], process_noise, NP.zeros((n_steps + 1, nx)))
+
+    @staticmethod
+    def signal(rng, options, nominal):
+        """ Trajectory of one signal with the shape of its nominal values """
+        if options is None:
+            return nominal
+        if isinstance(options, dict):
+            return generate_trajectory(rng, nominal.shape[0], nominal.shape[1], nominal = nominal, **options)
+        trajectory = NP.array(options, dtype = float)
+        if trajectory.shape != nominal.shape:
+            raise Exception("The trajectory of a disturbance must have the shape " + str(nominal.shape))
+        return trajectory
+
+    def step_index(self, t):
+        """ Row of the trajectories at the time t """
+        index = int(round(t / self.t_step))
+        if index > self.n_steps:
+            raise Exception("The disturbance trajectories end at t = " + str(self.n_steps * self.t_step))
+        return index
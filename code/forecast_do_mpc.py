@@ -0,0 +1,140 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import threading
+from collections.abc import Iterator
+import numpy as NP
+
+def forecast(tv_p_values, step_index):
+    """ Forecast of the time-varying parameters at the given step (ntv_p x number of samples). tv_p_values is the
+    dense array of all the steps (number_steps x ntv_p x number of samples) or a forecast provider: a callable of the
+    step index, e.g. one of the providers of this module """
+    if callable(tv_p_values):
+        return NP.array(tv_p_values(step_index), dtype = float)
+    return NP.array(tv_p_values[step_index])
+
+def provider(tv_p_values):
+    """ Forecast provider of the tv_p_values of the optimizer template: generators and other iterators are wrapped in
+    a generator_forecast, arrays and callables are used as they are """
+    if isinstance(tv_p_values, Iterator):
+        return generator_forecast(tv_p_values)
+    return tv_p_values
+
+class generator_forecast:
+    """ Forecast provider of a generator that yields the forecast (ntv_p x number of samples) of each step in turn.
+    The last forecast is repeated until the next step is requested """
+    def __init__(self, generator):
+        self.generator = generator
+        self.step_index = None
+        self.values = None
+
+    def __call__(self, step_index):
+        if self.step_index is None or step_index > self.step_index:
+            # Skipped steps (e.g. of a multi-rate loop) are consumed from the generator
+            for i in range(1 if self.step_index is None else step_index - self.step_index):
+                self.values = NP.array(next(self.generator), dtype = float)
+            self.step_index = step_index
+        return self.values
+
+class memmap_forecast:
+    """ Forecast provider reading a .npy file through a memory map, so that only the forecast of the current step is
+    loaded. The file holds the forecasts of all the steps (number_steps x ntv_p x number of samples) or a time series of
+    the time-varying parameters sampled with t_step (number of times x ntv_p), from which the window of n_samples
+    samples starting at each step is taken (holding the last value at the end of the series) """
+    def __init__(self, file_name, n_samples = None):
+        self.data = NP.load(file_name, mmap_mode = 'r')
+        if self.data.ndim == 2 and n_samples is None:
+            raise Exception("The number of samples of the forecast is needed to read a time series")
+        self.n_samples = n_samples
+
+    def __call__(self, step_index):
+        if self.data.ndim == 3:
+            return NP.array(self.data[step_index])
+        rows = NP.minimum(NP.arange(step_index, step_index + self.n_samples), self.data.shape[0] - 1)
+        return NP.array(self.data[rows]).T
+
+    @staticmethod
+    def save(file_name, tv_p_values, n_rows = None):
+        """ Write forecasts or a time series (given as an array or an iterable of rows) to a .npy file for memmap_forecast.
+        The rows of an iterable are written one by one as they are produced: the number of rows n_rows is then needed
+        (unless the iterable has a length), the shape of a row is taken from the first one """
+        if isinstance(tv_p_values, NP.ndarray):
+            NP.save(file_name, tv_p_values)
+            return
+        if n_rows is None:
+            if not hasattr(tv_p_values, '__len__'):
+                raise Exception("The number of rows is needed to write an iterator")
+            n_rows = len(tv_p_values)
+        rows = iter(tv_p_values)
+        first_row = NP.array(next(rows), dtype = float)
+        data = NP.lib.format.open_memmap(file_name, mode = 'w+', dtype = float, shape = (n_rows,) + first_row.shape)
+        data[0] = first_row
+        n_written = 1
+        for row in rows:
+            if n_written == n_rows:
+                raise Exception("The iterable has more than n_rows = " + str(n_rows) + " rows")
+            data[n_written] = row
+            n_written += 1
+        if n_written != n_rows:
+            raise Exception("The iterable has " + str(n_written) + " rows instead of n_rows = " + str(n_rows))
+        data.flush()
+
+class sliding_window_forecast:
+    """ Forecast provider with a fixed-size buffer of the time series of the time-varying parameters (ntv_p x capacity
+    samples, sampled with t_step). New values can be pushed at any time, e.g. from another thread when a new weather or
+    price forecast arrives, and overwrite the buffer from their first step on. The forecast of a step is the window of
+    n_samples samples starting at the step, holding the last received value beyond the end of the buffer """
+    def __init__(self, ntv_p, n_samples, capacity = None):
+        self.n_samples = n_samples
+        self.capacity = 2 * n_samples if capacity is None else capacity
+        if self.capacity < n_samples:
+            raise Exception("The capacity of the buffer must be at least the number of samples of the forecast")
+        self.buffer = NP.zeros((ntv_p, self.capacity))
+        # Steps of the first and one past the last sample in the buffer
+        self.first = 0
+        self.last = 0
+        self.lock = threading.Lock()
+
+    def push(self, step_index, values):
+        """ Store the values (ntv_p x number of samples) of the time series from the given step on """
+        values = NP.array(values, dtype = float)
+        n = values.shape[1]
+        if n > self.capacity:
+            raise Exception("The forecast is longer than the capacity of the buffer")
+        with self.lock:
+            if step_index > self.last or step_index < self.first:
+                # The new values are not contiguous with the buffer: it restarts at step_index
+                self.first = self.last = step_index
+            self.buffer[:, NP.arange(step_index, step_index + n) % self.capacity] = values
+            self.last = step_index + n
+            self.first = max(self.first, self.last - self.capacity)
+
+    def __call__(self, step_index):
+        with self.lock:
+            if self.last == self.first:
+                raise Exception("No forecast of the time-varying parameters has been received")
+            if step_index < self.first:
+                raise Exception("The forecast of step " + str(step_index) + " is no longer in the buffer")
+            steps = NP.minimum(NP.arange(step_index, step_index + self.n_samples), self.last - 1)
+            return self.buffer[:, steps % self.capacity].copy()
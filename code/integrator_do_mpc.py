@@ -0,0 +1,155 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import shutil
+import tempfile
+from casadi import *
+import numpy as NP
+import setup_nlp
+
+# Simulator functions already built, indexed by the scaled stage function and the options
+simulator_cache = {}
+
+def rk4_step(stage_fcn, nx, nu, np, ntv_p, t_step, n_steps):
+    """ Fixed-step explicit Runge-Kutta (RK4) integration of the scaled model over t_step with n_steps steps,
+    F(x0, p) -> xf where p = [u, p, tv_p] """
+    x0 = SX.sym("x0", nx)
+    p = SX.sym("p", nu + np + ntv_p)
+    [u, p_model, tv_p] = vertsplit(p, [0, nu, nu + np, nu + np + ntv_p])
+    h = t_step / n_steps
+    xk = x0
+    for i in range(n_steps):
+        k1 = stage_fcn(xk, u, p_model, tv_p, [])[0]
+        k2 = stage_fcn(xk + h / 2 * k1, u, p_model, tv_p, [])[0]
+        k3 = stage_fcn(xk + h / 2 * k2, u, p_model, tv_p, [])[0]
+        k4 = stage_fcn(xk + h * k3, u, p_model, tv_p, [])[0]
+        xk = xk + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+    return Function("rk4_step", [x0, p], [xk])
+
+def radau_step(stage_fcn, nx, nu, np, ntv_p, t_step, n_steps, deg, n_newton = None):
+    """ Implicit Radau collocation of degree deg over t_step with n_steps finite elements (the collocation
+    equations of the optimizer solved with a Newton method), F(x0, p) -> xf where p = [u, p, tv_p].
+    By default the rootfinder of CasADi is used. If n_newton is given, a fixed number of Newton iterations
+    is unrolled instead, which can be compiled to C code """
+    [ifcn, n_ik] = setup_nlp.collocation_fcn(stage_fcn, nx, nu, np, ntv_p, t_step, deg, 'radau', n_steps)
+    if n_newton is None:
+        collocation_simulator = rootfinder("collocation_simulator", 'newton', ifcn)
+        x0 = MX.sym("x0", nx)
+        p = MX.sym("p", nu + np + ntv_p)
+        [u, p_model, tv_p] = vertsplit(p, [0, nu, nu + np, nu + np + ntv_p])
+        # The initial state is the initial guess of all the collocation states
+        [_, xf] = collocation_simulator(repmat(x0, n_ik // nx, 1), x0, p_model, u, tv_p)
+        return Function("radau_step", [x0, p], [xf])
+    ifcn = ifcn.expand()
+    ik = SX.sym("ik", n_ik)
+    x0 = SX.sym("x0", nx)
+    p = SX.sym("p", nu + np + ntv_p)
+    [u, p_model, tv_p] = vertsplit(p, [0, nu, nu + np, nu + np + ntv_p])
+    [gk, xf] = ifcn(ik, x0, p_model, u, tv_p)
+    newton_fcn = Function("newton_fcn", [ik, x0, p], [gk, jacobian(gk, ik), xf])
+    ik_k = repmat(x0, n_ik // nx, 1)
+    for i in range(n_newton):
+        [gk, jac_gk, _] = newton_fcn(ik_k, x0, p)
+        ik_k = ik_k - solve(jac_gk, gk)
+    xf = newton_fcn(ik_k, x0, p)[2]
+    return Function("radau_step", [x0, p], [xf])
+
+def compile_function(fcn):
+    """ Generate C code of the function, compile it and load it as an external function. The generated code is
+    removed once compiled (the compiled library is removed by CasADi when it is unloaded) """
+    directory = tempfile.mkdtemp(prefix = "do_mpc_")
+    try:
+        code_generator = CodeGenerator(fcn.name() + ".c")
+        code_generator.add(fcn)
+        code_generator.generate(directory + os.sep)
+        importer = Importer(os.path.join(directory, fcn.name() + ".c"), 'shell')
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    return external(fcn.name(), importer)
+
+def simulator_function(model, integration_tool, t_step, opts, n_substeps = 1, generate_code = False):
+    """ Function simulator(x0, p) -> xf of the scaled model over one simulator step with p = [u, p, tv_p]. xf holds
+    the states at the end of each of the n_substeps sub-steps (nx x n_substeps). integration_tool is a CasADi
+    integrator plugin ('cvodes', 'idas', ...) with the options opts, or one of the fixed-step integrators built from
+    the model: 'rk4' (explicit) or 'radau' (implicit). DAE models need an integrator plugin for DAEs ('idas' or
+    'collocation'), whose simulator also takes the initial guess z0 and returns the algebraic states zf. Their number of steps per sub-step is given by the option
+    number_of_finite_elements (1 by default) and the degree of 'radau' by interpolation_order (3 by default). The
+    fixed-step integrators can be compiled to C code (generate_code), 'radau' then uses newton_iterations (4 by
+    default) unrolled Newton iterations. The functions are built once and cached """
+    stage_fcn = setup_nlp.scale_model(model)['stage_fcn']
+    key = (id(stage_fcn), integration_tool, t_step, n_substeps, generate_code, repr(sorted(opts.items())))
+    if key in simulator_cache and simulator_cache[key][0] is stage_fcn:
+        return simulator_cache[key][1]
+    nx = model.x.size1()
+    nu = model.u.size1()
+    np = model.p.size1()
+    ntv_p = model.tv_p.size1()
+    h = t_step / n_substeps
+    if integration_tool in ('rk4', 'radau') and model.z.size1() > 0:
+        raise Exception("DAE models can only be simulated with an integrator of CasADi for DAEs, e.g. 'idas'")
+    if integration_tool in ('rk4', 'radau'):
+        n_steps = opts.get('number_of_finite_elements', 1)
+        if integration_tool == 'rk4':
+            step = rk4_step(stage_fcn, nx, nu, np, ntv_p, h, n_steps)
+        else:
+            n_newton = opts.get('newton_iterations', 4) if generate_code else None
+            step = radau_step(stage_fcn, nx, nu, np, ntv_p, h, n_steps, opts.get('interpolation_order', 3), n_newton)
+        x0 = MX.sym("x0", nx)
+        p = MX.sym("p", nu + np + ntv_p)
+        xk = x0
+        x_substeps = []
+        for i in range(n_substeps):
+            xk = step(xk, p)
+            x_substeps.append(xk)
+        simulator = Function("simulator", [x0, p], [horzcat(*x_substeps)], ['x0', 'p'], ['xf'])
+        # Steps without a rootfinder are expanded to a single SX function (lower call overhead)
+        if step.is_a('SXFunction'):
+            simulator = simulator.expand()
+        if generate_code:
+            simulator = compile_function(simulator)
+    elif generate_code:
+        raise Exception("C code can only be generated for the simulators 'rk4' and 'radau'")
+    else:
+        dae = setup_nlp.dae_dict(model)
+        if n_substeps > 1:
+            # Dense output at the end of each sub-step of the simulator step
+            opts = {name: opts[name] for name in opts if name not in ('t0', 'tf')}
+            simulator = integrator("simulator", integration_tool, dae, 0, NP.linspace(h, t_step, n_substeps), opts)
+        else:
+            simulator = integrator("simulator", integration_tool, dae, opts)
+    simulator_cache[key] = (stage_fcn, simulator)
+    return simulator
+
+def consistent_algebraic_states(model, x, u, p, tv_p, z_guess):
+    """ Algebraic states z which fulfill the algebraic equations alg(x, z, u, p, tv_p) = 0 of the scaled model for
+    the given (scaled) states and inputs, computed with a Newton method from z_guess """
+    nz = model.z.size1()
+    if nz == 0:
+        return NP.zeros(0)
+    alg = setup_nlp.scale_model(model)['alg']
+    alg_fcn = Function("alg_fcn", [model.z, vertcat(model.x, model.u, model.p, model.tv_p)], [alg])
+    z_fcn = rootfinder("z_fcn", 'newton', alg_fcn)
+    z = z_fcn(z_guess, vertcat(x, u, p, tv_p))
+    return NP.reshape(NP.array(z, dtype = float), (nz))
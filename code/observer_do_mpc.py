@@ -0,0 +1,417 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from casadi import *
+from casadi.tools import *
+import numpy as NP
+import setup_nlp
+import integrator_do_mpc
+
+def measurement_function(model, meas, meas_scaling):
+    """ Function meas_fcn(x, u, p, tv_p) -> y of the scaled measured outputs of the scaled model. meas is an expression
+    of the model variables (not scaled) or None if all the states are measured (y is then the scaled state) """
+    x = model.x
+    u = model.u
+    if meas is None:
+        y = x
+    else:
+        y = substitute(SX(meas), vertcat(x, u), vertcat(x * model.ocp.x_scaling, u * model.ocp.u_scaling)) / meas_scaling
+    return Function('meas_fcn', [x, u, model.p, model.tv_p], [y], ['x', 'u', 'p', 'tv_p'], ['y'])
+
+def scaled_covariance(covariance, scaling):
+    """ Covariance of the scaled variables from the covariance (matrix or diagonal) of the variables """
+    covariance = NP.array(covariance, dtype = float)
+    if covariance.ndim < 2:
+        covariance = NP.diag(NP.resize(covariance, NP.size(scaling)))
+    return covariance / NP.outer(scaling, scaling)
+
+def transition_function(configuration):
+    """ Function F(x, u, p, tv_p) -> xf of the scaled model over one simulator step, with the same discretization
+    as the simulator """
+    model = configuration.model
+    simulator = configuration.simulator
+    x = MX.sym("x", model.x.size1())
+    u = MX.sym("u", model.u.size1())
+    p = MX.sym("p", model.p.size1())
+    tv_p = MX.sym("tv_p", model.tv_p.size1())
+    if configuration.optimizer.state_discretization == 'discrete-time':
+        xf = setup_nlp.scale_model(model)['stage_fcn'](x, u, p, tv_p, [])[0]
+        is_sx = True
+    else:
+        if model.z.size1() > 0:
+            raise Exception("The estimators are only available for ODE models")
+        step = integrator_do_mpc.simulator_function(model, simulator.integration_tool, simulator.t_step_simulator,
+                                                    simulator.integrator_opts, simulator.n_substeps, simulator.generate_code)
+        # The states at the end of the last sub-step
+        xf = step(x0 = x, p = vertcat(u, p, tv_p))['xf'][:, -1]
+        is_sx = step.is_a('SXFunction')
+    return Function("transition_fcn", [x, u, p, tv_p], [xf], ['x', 'u', 'p', 'tv_p'], ['xf']), is_sx
+
+def nominal_parameters(configuration):
+    """ Nominal values of the uncertain parameters (first value of each parameter) """
+    return NP.array([values[0] for values in configuration.optimizer.uncertainty_values], dtype = float)
+
+class ekf:
+    """ Extended Kalman filter of the scaled states. The prediction with the discretized model, the Jacobians of the
+    transition and of the measurement function and the update are built once as a single CasADi function
+    ekf_fcn(x0, P0, y, u, p, tv_p) -> [xf, Pf], which is built in SX and compiled to C code like the simulator """
+    def __init__(self, configuration):
+        model = configuration.model
+        observer = configuration.observer
+        nx = model.x.size1()
+        if observer.Q is None or observer.R is None:
+            raise Exception("The extended Kalman filter needs the covariances Q and R of the observer")
+        Q = scaled_covariance(observer.Q, model.ocp.x_scaling)
+        R = scaled_covariance(observer.R, observer.meas_scaling)
+        self.P = Q if observer.P0 is None else scaled_covariance(observer.P0, model.ocp.x_scaling)
+        x0 = model.ocp.x0 if observer.x0 is None else observer.x0
+        self.x = NP.array(x0, dtype = float) / model.ocp.x_scaling
+        self.p_nominal = nominal_parameters(configuration)
+        [transition_fcn, is_sx] = transition_function(configuration)
+        meas_fcn = observer.meas_fcn
+        # Integrators of CasADi (e.g. cvodes) cannot be expanded: the filter is then built in MX
+        sym = SX if is_sx else MX
+        if is_sx:
+            transition_fcn = transition_fcn.expand()
+        x = sym.sym("x", nx)
+        P = sym.sym("P", nx, nx)
+        y = sym.sym("y", meas_fcn.size1_out(0))
+        u = sym.sym("u", model.u.size1())
+        p = sym.sym("p", model.p.size1())
+        tv_p = sym.sym("tv_p", model.tv_p.size1())
+        # Prediction over the last simulator step
+        x_pred = transition_fcn(x, u, p, tv_p)
+        A = jacobian(x_pred, x)
+        P_pred = mtimes([A, P, A.T]) + Q
+        # Update with the measurement at the end of the step (Joseph form of the covariance)
+        x_lin = sym.sym("x_lin", nx)
+        y_lin = meas_fcn(x_lin, u, p, tv_p)
+        meas_jac_fcn = Function("meas_jac_fcn", [x_lin, u, p, tv_p], [y_lin, jacobian(y_lin, x_lin)])
+        [y_pred, H] = meas_jac_fcn(x_pred, u, p, tv_p)
+        S = mtimes([H, P_pred, H.T]) + R
+        K = solve(S, mtimes(H, P_pred)).T
+        x_new = x_pred + mtimes(K, y - y_pred)
+        I_KH = DM.eye(nx) - mtimes(K, H)
+        P_new = mtimes([I_KH, P_pred, I_KH.T]) + mtimes([K, R, K.T])
+        ekf_fcn = Function("ekf_fcn", [x, P, y, u, p, tv_p], [x_new, P_new], ['x0', 'P0', 'y', 'u', 'p', 'tv_p'], ['xf', 'Pf'])
+        if is_sx and configuration.simulator.generate_code:
+            ekf_fcn = integrator_do_mpc.compile_function(ekf_fcn)
+        self.ekf_fcn = ekf_fcn
+
+    def make_step(self, configuration):
+        """ Estimate of the (scaled) states after the last simulator step from its input and the measurement """
+        simulator = configuration.simulator
+        # Time-varying parameters of the last simulator step
+        tv_p = simulator.real_parameters(simulator.t0_sim - simulator.t_step_simulator)[1]
+        [x, P] = self.ekf_fcn(self.x, self.P, simulator.measurement, simulator.u_sim, self.p_nominal, tv_p)
+        self.x = NP.ravel(NP.array(x))
+        self.P = NP.array(P)
+        return self.x
+
+class mhe:
+    """ Moving horizon estimation of the scaled states and of the chosen uncertain parameters (estimated_parameters)
+    of the observer. The estimation NLP over the past mhe_horizon simulator steps is discretized with the collocation
+    of setup_nlp (poly_degree, collocation and n_fin_elem of the optimizer) and solved with IPOPT. The measurements,
+    inputs and time-varying parameters of the window are kept in preallocated buffers that are shifted at each step,
+    and the solver is warm started with the shifted previous solution """
+    def __init__(self, configuration):
+        model = configuration.model
+        optimizer = configuration.optimizer
+        observer = configuration.observer
+        simulator = configuration.simulator
+        nx = model.x.size1()
+        nu = model.u.size1()
+        np = model.p.size1()
+        ntv_p = model.tv_p.size1()
+        nz = model.z.size1()
+        ny = observer.meas_fcn.size1_out(0)
+        nk = observer.mhe_horizon
+        p_est = list(observer.estimated_parameters)
+        n_est = len(p_est)
+        if observer.Q is None or observer.R is None:
+            raise Exception("The moving horizon estimation needs the covariances Q and R of the observer")
+        if optimizer.state_discretization not in ('collocation', 'discrete-time'):
+            raise Exception("The moving horizon estimation supports the collocation and discrete-time discretizations")
+        Q = scaled_covariance(observer.Q, model.ocp.x_scaling)
+        R = scaled_covariance(observer.R, observer.meas_scaling)
+        P0 = Q if observer.P0 is None else scaled_covariance(observer.P0, model.ocp.x_scaling)
+        # The estimated parameters are scaled with their nominal values. Their initial uncertainty is by default
+        # the half range of the uncertainty values of the optimizer
+        self.p_nominal = nominal_parameters(configuration)
+        p_values = [NP.array(configuration.optimizer.uncertainty_values[i], dtype = float) for i in p_est]
+        self.p_scaling = NP.array([abs(self.p_nominal[i]) if self.p_nominal[i] != 0 else 1.0 for i in p_est])
+        if observer.P0_p is None:
+            P0_p = NP.diag([max((NP.max(v) - NP.min(v)) / 2.0, 1e-3 * s) ** 2 for v, s in zip(p_values, self.p_scaling)])
+        else:
+            P0_p = observer.P0_p
+        P0_p = scaled_covariance(P0_p, self.p_scaling) if n_est > 0 else NP.zeros((0, 0))
+        Q_inv, R_inv, P0_inv, P0_p_inv = [NP.linalg.inv(M) for M in (Q, R, P0, P0_p)]
+
+        # Discretization of the steps of the window (one simulator step each)
+        stage_fcn = setup_nlp.scale_model(model)['stage_fcn']
+        if optimizer.state_discretization == 'collocation':
+            deg = optimizer.poly_degree
+            ni = optimizer.n_fin_elem[0] if NP.ndim(optimizer.n_fin_elem) > 0 else optimizer.n_fin_elem
+            [ifcn, n_ik] = setup_nlp.collocation_fcn(stage_fcn, nx, nu, np, ntv_p, simulator.t_step_simulator, deg,
+                                                     optimizer.collocation, ni, nz)
+        else:
+            if nz > 0:
+                raise Exception("DAE models are only supported with the collocation discretization")
+            deg = 0
+            n_ik = 0
+
+        # Variables: states at the nodes of the window, collocation variables and process noise of each step and
+        # the estimated parameters
+        n_vars = (nk + 1) * nx + nk * (n_ik + nx) + n_est
+        V = MX.sym("V", n_vars)
+        x_lb, x_ub = [NP.array(i, dtype = float) / model.ocp.x_scaling for i in (model.ocp.x_lb, model.ocp.x_ub)]
+        vars_lb = -inf * NP.ones(n_vars)
+        vars_ub = inf * NP.ones(n_vars)
+        X_offset = NP.zeros(nk + 1, dtype = int)
+        I_offset = NP.zeros(nk, dtype = int)
+        W_offset = NP.zeros(nk, dtype = int)
+        offset = 0
+        for k in range(nk + 1):
+            X_offset[k] = offset
+            vars_lb[offset:offset + nx] = x_lb
+            vars_ub[offset:offset + nx] = x_ub
+            offset += nx
+        for k in range(nk):
+            I_offset[k] = offset
+            if n_ik > 0:
+                vars_lb[offset:offset + n_ik] = setup_nlp.collocation_guess(x_lb, model.ocp.z_lb, n_ik, deg)
+                vars_ub[offset:offset + n_ik] = setup_nlp.collocation_guess(x_ub, model.ocp.z_ub, n_ik, deg)
+            offset += n_ik
+            W_offset[k] = offset
+            offset += nx
+        P_offset = offset
+        offset += n_est
+        assert(offset == n_vars)
+        X = [V[X_offset[k]:X_offset[k] + nx] for k in range(nk + 1)]
+        W = [V[W_offset[k]:W_offset[k] + nx] for k in range(nk)]
+        P = V[P_offset:P_offset + n_est]
+
+        # Parameters: arrival cost, buffers of the window and weights of the terms (the steps before the start of
+        # the simulation are not part of the estimation, see make_step)
+        parameters_mhe = struct_symMX([entry("x_arrival", shape = (nx)), entry("p_arrival", shape = (n_est)),
+            entry("Y", shape = (ny, nk + 1)), entry("U", shape = (nu, nk)), entry("TV_P", shape = (ntv_p, nk)),
+            entry("p_fixed", shape = (np)), entry("arrival_node", shape = (nk + 1)),
+            entry("y_weight", shape = (nk + 1)), entry("w_weight", shape = (nk))])
+        # Model parameters with the estimated ones taken from the variables
+        p_full = vertcat(*[P[p_est.index(i)] * self.p_scaling[p_est.index(i)] if i in p_est else parameters_mhe["p_fixed"][i]
+                           for i in range(np)])
+        g = []
+        G_offset = NP.zeros(nk + 1, dtype = int)
+        n_g = 0
+        J = 0
+        for k in range(nk):
+            G_offset[k] = n_g
+            uk = parameters_mhe["U"][:, k]
+            tv_pk = parameters_mhe["TV_P"][:, k]
+            if n_ik > 0:
+                [gk, xf] = ifcn.call([V[I_offset[k]:I_offset[k] + n_ik], X[k], p_full, uk, tv_pk])
+                g.append(gk)
+                n_g += n_ik
+            else:
+                xf = stage_fcn.call([X[k], uk, p_full, tv_pk, []])[0]
+            g.append(X[k + 1] - xf - W[k])
+            n_g += nx
+            J += parameters_mhe["w_weight"][k] * mtimes([W[k].T, Q_inv, W[k]])
+        G_offset[nk] = n_g
+        for k in range(nk + 1):
+            e = parameters_mhe["Y"][:, k] - observer.meas_fcn.call([X[k], parameters_mhe["U"][:, max(k - 1, 0)],
+                                                                    p_full, parameters_mhe["TV_P"][:, max(k - 1, 0)]])[0]
+            J += parameters_mhe["y_weight"][k] * mtimes([e.T, R_inv, e])
+        # Arrival cost at the first node of the window that is estimated
+        x_start = mtimes(horzcat(*X), parameters_mhe["arrival_node"])
+        J += mtimes([(x_start - parameters_mhe["x_arrival"]).T, P0_inv, x_start - parameters_mhe["x_arrival"]])
+        J += mtimes([(P - parameters_mhe["p_arrival"]).T, P0_p_inv, P - parameters_mhe["p_arrival"]])
+        g = vertcat(*g)
+
+        opts = {}
+        opts["expand"] = True
+        opts["ipopt.linear_solver"] = optimizer.linear_solver
+        opts["ipopt.max_iter"] = optimizer.max_iter
+        opts["ipopt.tol"] = 1e-6
+        opts["ipopt.print_level"] = 0
+        opts["print_time"] = False
+        self.solver = nlpsol("mhe_solver", "ipopt", {'x': V, 'f': J, 'g': g, 'p': parameters_mhe}, opts)
+        self.parameters_mhe = parameters_mhe
+        self.X_offset, self.I_offset, self.W_offset, self.P_offset, self.G_offset = X_offset, I_offset, W_offset, P_offset, G_offset
+        self.nk, self.n_ik, self.deg, self.p_est = nk, n_ik, deg, p_est
+        self.vars_lb, self.vars_ub = vars_lb, vars_ub
+
+        # Initial estimate, preallocated buffers of the window and initial guess
+        x0 = model.ocp.x0 if observer.x0 is None else observer.x0
+        self.x = NP.array(x0, dtype = float) / model.ocp.x_scaling
+        self.x_arrival = self.x.copy()
+        self.p_arrival = NP.ones(n_est)
+        self.estimated_parameters = self.p_nominal[p_est]
+        self.Y = NP.zeros((ny, nk + 1))
+        self.U = NP.zeros((nu, nk))
+        self.TV_P = NP.zeros((ntv_p, nk))
+        self.n_measurements = 0
+        self.vars_init = NP.zeros(n_vars)
+        self.ik_init = setup_nlp.collocation_guess(self.x, model.ocp.z0, n_ik, deg) if n_ik > 0 else NP.zeros(0)
+        for k in range(nk + 1):
+            self.vars_init[X_offset[k]:X_offset[k] + nx] = self.x
+        for k in range(nk):
+            self.vars_init[I_offset[k]:I_offset[k] + n_ik] = self.ik_init
+        self.vars_init[P_offset:P_offset + n_est] = self.p_arrival
+        self.solved = False
+
+    def shift(self):
+        """ Shift the buffers and the previous solution (initial guess) by one step """
+        nx = self.x.size
+        nk = self.nk
+        for buffer in (self.Y, self.U, self.TV_P):
+            buffer[:, :-1] = buffer[:, 1:]
+        v = self.vars_init
+        X_offset, I_offset, W_offset = self.X_offset, self.I_offset, self.W_offset
+        # The state at the second node of the previous window is the new arrival state
+        if self.solved and self.n_measurements >= nk:
+            self.x_arrival = v[X_offset[1]:X_offset[1] + nx].copy()
+            self.p_arrival = v[self.P_offset:self.P_offset + len(self.p_est)].copy()
+        v[X_offset[0]:X_offset[nk]] = v[X_offset[1]:X_offset[nk] + nx]
+        for k in range(nk - 1):
+            v[I_offset[k]:I_offset[k] + self.n_ik] = v[I_offset[k + 1]:I_offset[k + 1] + self.n_ik]
+            v[W_offset[k]:W_offset[k] + nx] = v[W_offset[k + 1]:W_offset[k + 1] + nx]
+        v[W_offset[nk - 1]:W_offset[nk - 1] + nx] = 0.0
+
+    def make_step(self, configuration):
+        """ Estimate of the (scaled) states after the last simulator step from its input and the measurement """
+        simulator = configuration.simulator
+        nx = self.x.size
+        nk = self.nk
+        self.shift()
+        self.n_measurements += 1
+        self.Y[:, -1] = NP.ravel(simulator.measurement)
+        self.U[:, -1] = NP.ravel(simulator.u_sim)
+        self.TV_P[:, -1] = NP.ravel(simulator.real_parameters(simulator.t0_sim - simulator.t_step_simulator)[1])
+        # Node of the window at the start of the simulation, or first node of the window once it is filled. The steps
+        # before this node are fixed to the initial estimate and the measurement at this node is summarized in the
+        # arrival cost
+        first = max(nk - self.n_measurements, 0)
+        param = self.parameters_mhe(0)
+        param["x_arrival"] = self.x_arrival
+        param["p_arrival"] = self.p_arrival
+        param["Y"] = self.Y
+        param["U"] = self.U
+        param["TV_P"] = self.TV_P
+        param["p_fixed"] = self.p_nominal
+        arrival_node = NP.zeros(nk + 1)
+        arrival_node[first] = 1.0
+        param["arrival_node"] = arrival_node
+        param["y_weight"] = (NP.arange(nk + 1) > first).astype(float)
+        param["w_weight"] = (NP.arange(nk) >= first).astype(float)
+        vars_lb = self.vars_lb.copy()
+        vars_ub = self.vars_ub.copy()
+        lbg = NP.zeros(self.G_offset[nk])
+        ubg = NP.zeros(self.G_offset[nk])
+        for k in range(first):
+            X_offset, I_offset, W_offset = self.X_offset[k], self.I_offset[k], self.W_offset[k]
+            vars_lb[X_offset:X_offset + nx] = vars_ub[X_offset:X_offset + nx] = self.x_arrival
+            vars_lb[I_offset:I_offset + self.n_ik] = vars_ub[I_offset:I_offset + self.n_ik] = self.ik_init
+            vars_lb[W_offset:W_offset + nx] = vars_ub[W_offset:W_offset + nx] = 0.0
+            lbg[self.G_offset[k]:self.G_offset[k + 1]] = -inf
+            ubg[self.G_offset[k]:self.G_offset[k + 1]] = inf
+        result = self.solver(x0 = self.vars_init, lbx = vars_lb, ubx = vars_ub, lbg = lbg, ubg = ubg, p = param)
+        self.solved = True
+        self.vars_init = NP.ravel(NP.array(result["x"]))
+        self.x = self.vars_init[self.X_offset[nk]:self.X_offset[nk] + nx].copy()
+        self.estimated_parameters = self.vars_init[self.P_offset:self.P_offset + len(self.p_est)] * self.p_scaling
+        return self.x
+
+class ukf:
+    """ Unscented Kalman filter of the scaled states. The 2 nx + 1 sigma points are propagated with a single call of
+    the transition function mapped over the sigma points (built in SX and compiled like the simulator when possible)
+    and the measurement function is mapped in the same way. The weights, the Cholesky factor of the covariance and the
+    update are computed with NumPy """
+    def __init__(self, configuration, alpha = 1.0, beta = 2.0, kappa = 0.0):
+        model = configuration.model
+        observer = configuration.observer
+        nx = model.x.size1()
+        if observer.Q is None or observer.R is None:
+            raise Exception("The unscented Kalman filter needs the covariances Q and R of the observer")
+        self.Q = scaled_covariance(observer.Q, model.ocp.x_scaling)
+        self.R = scaled_covariance(observer.R, observer.meas_scaling)
+        self.P = self.Q if observer.P0 is None else scaled_covariance(observer.P0, model.ocp.x_scaling)
+        x0 = model.ocp.x0 if observer.x0 is None else observer.x0
+        self.x = NP.array(x0, dtype = float) / model.ocp.x_scaling
+        self.p_nominal = nominal_parameters(configuration)
+        # Weights of the mean and of the covariance of the sigma points
+        n_sigma = 2 * nx + 1
+        lam = alpha ** 2 * (nx + kappa) - nx
+        self.sigma_scaling = nx + lam
+        self.w_mean = NP.hstack(([lam / (nx + lam)], NP.ones(n_sigma - 1) / (2 * (nx + lam))))
+        self.w_cov = self.w_mean.copy()
+        self.w_cov[0] += 1 - alpha ** 2 + beta
+        # Transition and measurement functions evaluated for all the sigma points at once (u, p and tv_p are shared)
+        [transition_fcn, is_sx] = transition_function(configuration)
+        if is_sx:
+            transition_fcn = transition_fcn.expand()
+        transition_map = transition_fcn.map(n_sigma)
+        meas_map = configuration.observer.meas_fcn.map(n_sigma)
+        if is_sx and configuration.simulator.generate_code:
+            transition_map = integrator_do_mpc.compile_function(transition_map)
+            meas_map = integrator_do_mpc.compile_function(meas_map)
+        self.transition_map = transition_map
+        self.meas_map = meas_map
+
+    def covariance_factor(self):
+        """ Square root S (S S^T = sigma_scaling P) of the covariance of the sigma points. If round-off made the
+        covariance indefinite, its eigenvalues are clipped to a small positive value """
+        try:
+            return NP.linalg.cholesky(self.sigma_scaling * self.P)
+        except NP.linalg.LinAlgError:
+            [eigenvalues, eigenvectors] = NP.linalg.eigh(self.P)
+            eigenvalues = NP.maximum(eigenvalues, 1e-12 * max(NP.max(eigenvalues), 1.0))
+            self.P = NP.dot(eigenvectors * eigenvalues, eigenvectors.T)
+            return eigenvectors * NP.sqrt(self.sigma_scaling * eigenvalues)
+
+    def make_step(self, configuration):
+        """ Estimate of the (scaled) states after the last simulator step from its input and the measurement """
+        simulator = configuration.simulator
+        # Time-varying parameters of the last simulator step
+        tv_p = simulator.real_parameters(simulator.t0_sim - simulator.t_step_simulator)[1]
+        u = simulator.u_sim
+        # Sigma points of the last estimate (one per column)
+        S = self.covariance_factor()
+        sigma = self.x[:, NP.newaxis] + NP.hstack((NP.zeros((self.x.size, 1)), S, -S))
+        # Prediction over the last simulator step
+        sigma_pred = NP.array(self.transition_map(sigma, u, self.p_nominal, tv_p))
+        x_pred = NP.dot(sigma_pred, self.w_mean)
+        dx = sigma_pred - x_pred[:, NP.newaxis]
+        P_pred = NP.dot(dx * self.w_cov, dx.T) + self.Q
+        # Update with the measurement at the end of the step
+        y_sigma = NP.array(self.meas_map(sigma_pred, u, self.p_nominal, tv_p))
+        y_pred = NP.dot(y_sigma, self.w_mean)
+        dy = y_sigma - y_pred[:, NP.newaxis]
+        P_yy = NP.dot(dy * self.w_cov, dy.T) + self.R
+        P_xy = NP.dot(dx * self.w_cov, dy.T)
+        K = NP.linalg.solve(P_yy, P_xy.T).T
+        self.x = x_pred + NP.dot(K, NP.ravel(simulator.measurement) - y_pred)
+        P = P_pred - NP.dot(NP.dot(K, P_yy), K.T)
+        self.P = (P + P.T) / 2
+        return self.x
@@ -0,0 +1,206 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import sys
+import random
+import socket
+import struct
+import time
+import numpy as NP
+
+# Binary frame: magic, kind, sequence number, time, number of values and the values (float64, little endian)
+FRAME_HEADER = struct.Struct('<4sBIdI')
+FRAME_MAGIC = b'DMPC'
+# Kinds of frames: session of the client (its id in the sequence number), control moves (to the plant) and
+# measurements (from the plant)
+FRAME_HELLO = 0
+FRAME_CONTROL = 1
+FRAME_MEASUREMENT = 2
+
+def parse_address(address):
+    """ 'host:port' or ('host', port) is a TCP address, any other string the path of a Unix socket """
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+def encode_frame(kind, sequence, t, values):
+    values = NP.ascontiguousarray(NP.ravel(values), dtype = '<f8')
+    return FRAME_HEADER.pack(FRAME_MAGIC, kind, sequence, t, values.size) + values.tobytes()
+
+def receive_exactly(sock, n_bytes):
+    buffer = bytearray()
+    while len(buffer) < n_bytes:
+        chunk = sock.recv(n_bytes - len(buffer))
+        if not chunk:
+            raise ConnectionError("The connection was closed")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+def receive_frame(sock, expected = None):
+    """ Read one frame and return its kind, sequence number, time and values. If expected ({kind: number
+    of values}) is given, frames of other kinds or sizes are rejected before their values are read """
+    magic, kind, sequence, t, n_values = FRAME_HEADER.unpack(receive_exactly(sock, FRAME_HEADER.size))
+    if magic != FRAME_MAGIC:
+        raise ConnectionError("Invalid frame received")
+    if expected is not None and expected.get(kind) != n_values:
+        raise ConnectionError("Unexpected frame of kind " + str(kind) + " with " + str(n_values) + " values received")
+    values = NP.frombuffer(receive_exactly(sock, 8 * n_values), dtype = '<f8')
+    return kind, sequence, t, values
+
+class plant_connector:
+    """ Client side of the connection to a plant. Each call of exchange sends the control moves
+    and waits (at most timeout seconds) for the measurement. If the connection fails it is
+    reopened and the frame is sent again up to n_retries times. Each connection starts with the id of the
+    session, so that the plant only discards repeated frames of the same client. Values are in physical
+    (unscaled) units. If n_measurements is given, measurements of another size are rejected """
+    def __init__(self, address, timeout = 1.0, n_retries = 3, retry_delay = 0.1, n_measurements = None):
+        self.family, self.address = parse_address(address)
+        self.timeout = timeout
+        self.n_retries = n_retries
+        self.retry_delay = retry_delay
+        self.sock = None
+        self.sequence = 0
+        self.session = random.getrandbits(32)
+        self.expected = None if n_measurements is None else {FRAME_MEASUREMENT: n_measurements}
+        # Round trip time of each exchange and number of reconnections
+        self.latency = []
+        self.n_reconnections = 0
+        self.t_first_exchange = None
+
+    def connect(self):
+        self.close()
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(self.address)
+        self.sock = sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def exchange(self, u, t):
+        """ Send the control moves applied at time t and return the measurement at the end of the interval """
+        self.sequence = self.sequence + 1
+        frame = encode_frame(FRAME_CONTROL, self.sequence, t, u)
+        t_start = time.time()
+        if self.t_first_exchange is None:
+            self.t_first_exchange = t_start
+        for attempt in range(self.n_retries + 1):
+            try:
+                if self.sock is None:
+                    self.connect()
+                    self.sock.sendall(encode_frame(FRAME_HELLO, self.session, t, []))
+                self.sock.sendall(frame)
+                kind, sequence, t_plant, values = receive_frame(self.sock, self.expected)
+                # Discard answers to frames of a previous connection
+                while sequence != self.sequence:
+                    kind, sequence, t_plant, values = receive_frame(self.sock, self.expected)
+                if kind != FRAME_MEASUREMENT:
+                    raise ConnectionError("Unexpected frame received from the plant")
+                self.latency.append(time.time() - t_start)
+                return NP.array(values)
+            except (OSError, ConnectionError) as error:
+                self.close()
+                if attempt == self.n_retries:
+                    raise Exception("No measurement received from the plant at " + str(self.address) + ": " + str(error))
+                self.n_reconnections = self.n_reconnections + 1
+                time.sleep(self.retry_delay)
+
+    def statistics(self):
+        """ Mean and maximum round trip time and number of exchanges per second """
+        if len(self.latency) == 0:
+            return {'mean_latency': 0.0, 'max_latency': 0.0, 'throughput': 0.0, 'reconnections': self.n_reconnections}
+        elapsed = time.time() - self.t_first_exchange
+        return {'mean_latency': float(NP.mean(self.latency)), 'max_latency': float(NP.max(self.latency)),
+                'throughput': len(self.latency) / elapsed, 'reconnections': self.n_reconnections}
+
+def serve_plant(address, simulator, model):
+    """ Stand-in plant: integrate the model with the simulator of a template for each control frame
+    received and answer with the measured (unscaled) states. The state is kept between connections.
+    A malformed frame only closes its connection """
+    import casadi
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(address):
+        os.remove(address)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address)
+    server.listen(1)
+    x_scaling = NP.ravel(model.ocp.x_scaling)
+    u_scaling = NP.ravel(model.ocp.u_scaling)
+    x = NP.ravel(simulator.x0_sim)
+    # Algebraic states of DAE models (initial guess of the next step)
+    z = simulator.z0_sim
+    # Session of the last client and sequence number of its last control frame
+    session = None
+    last_sequence = None
+    measurement = x * x_scaling
+    print("Plant server listening on " + str(address))
+    while True:
+        connection, _ = server.accept()
+        if family == socket.AF_INET:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            # A new client starts its own sequence of frames, a reconnecting client resumes its session
+            kind, session_id, t, _ = receive_frame(connection, {FRAME_HELLO: 0})
+            if session_id != session:
+                session = session_id
+                last_sequence = None
+            while True:
+                kind, sequence, t, u = receive_frame(connection, {FRAME_CONTROL: u_scaling.size})
+                # A repeated frame (after a reconnection) is not applied twice
+                if sequence != last_sequence:
+                    p = casadi.vertcat(u / u_scaling, simulator.p_real_now(t), simulator.tv_p_real_now(t))
+                    dae_arg = {'z0': z} if NP.size(z) > 0 else {}
+                    result = simulator.simulator(x0 = x, p = p, **dae_arg)
+                    # The states at the end of the last sub-step
+                    x = NP.array(result['xf'])[:, -1]
+                    if dae_arg:
+                        z = NP.array(result['zf'])[:, -1]
+                    measurement = x * x_scaling
+                    last_sequence = sequence
+                connection.sendall(encode_frame(FRAME_MEASUREMENT, sequence, t + simulator.t_step_simulator, measurement))
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            connection.close()
+
+if __name__ == '__main__':
+    # Usage: python plant_do_mpc.py <example directory> [address]
+    example_path = os.path.abspath(sys.argv[1])
+    address = sys.argv[2] if len(sys.argv) > 2 else 'localhost:50000'
+    sys.path.append(example_path)
+    import template_model
+    import template_simulator
+    model_1 = template_model.model()
+    simulator_1 = template_simulator.simulator(model_1)
+    serve_plant(address, simulator_1, model_1)
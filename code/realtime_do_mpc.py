@@ -0,0 +1,97 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import asyncio
+import concurrent.futures
+import numpy as NP
+import setup_nlp
+from casadi import *
+
+def predict_state(configuration, x, u, t):
+    """ Predict the (scaled) state after one sampling time with the nominal model """
+    p_nominal = NP.array([values[0] for values in configuration.optimizer.uncertainty_values])
+    tv_p = configuration.simulator.real_parameters(t)[1]
+    if configuration.optimizer.state_discretization == 'discrete-time':
+        stage_fcn = setup_nlp.scale_model(configuration.model)['stage_fcn']
+        x_next = stage_fcn(x, u, p_nominal, tv_p, [])[0]
+    else:
+        # The states at the end of the last sub-step
+        x_next = NP.array(configuration.simulator.simulator(x0 = x, p = vertcat(u, p_nominal, tv_p))['xf'])[:, -1]
+    return NP.reshape(NP.array(x_next), NP.shape(x))
+
+def jitter_statistics(configuration):
+    """ Mean, standard deviation and maximum of the delay of the sampling periods """
+    jitter = configuration.mpc_data.mpc_jitter[1:]
+    if jitter.size == 0:
+        return {'mean': 0.0, 'std': 0.0, 'max': 0.0}
+    return {'mean': float(NP.mean(jitter)), 'std': float(NP.std(jitter)), 'max': float(NP.max(jitter))}
+
+async def run(configuration, t_sample, n_steps = None):
+    """ Real-time MPC loop with a sampling period of t_sample seconds (wall-clock).
+    While the plant (simulator or application) executes the interval k, the optimizer solves the
+    problem of the interval k+1 for the state predicted with the nominal model from the last
+    measurement, which corrects the prediction at every interval. With the advanced_step option of the
+    optimizer, the input is also corrected with the sensitivity of the solution. The plant and the
+    solver run in executor threads so that the event loop keeps the timers responsive.
+    If the solver needs more than t_sample the period is extended (see the optimizer time_budget) """
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers = 2)
+    data = configuration.mpc_data
+    t_step = configuration.simulator.t_step_simulator
+    if configuration.optimizer.n_rate != 1:
+        raise Exception("The real-time loop requires the same sampling time for the optimizer and the simulator")
+    if n_steps is None:
+        n_steps = int(round(configuration.optimizer.t_end / t_step))
+    # The first optimization is solved before the loop starts
+    await loop.run_in_executor(executor, configuration.make_step_optimizer)
+    x_measured = configuration.model.ocp.x0 / configuration.model.ocp.x_scaling
+    t_start = loop.time()
+    for k in range(n_steps):
+        # Wait for the beginning of the sampling period
+        delay = t_start + k * t_sample - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        data.mpc_jitter = NP.append(data.mpc_jitter, [[loop.time() - (t_start + k * t_sample)]], axis = 0)
+        # Control input applied during this interval and statistics of the optimization that gave it (the
+        # optimization of the next interval runs concurrently)
+        u_mpc = NP.copy(configuration.optimizer.u_mpc)
+        statistics = configuration.solve_statistics()
+        if k < n_steps - 1:
+            # Prepare the next optimization with the predicted state
+            x_predicted = predict_state(configuration, x_measured, u_mpc, configuration.simulator.t0_sim)
+            configuration.prepare_next_iter(x_predicted, k + 1)
+        plant = loop.run_in_executor(executor, configuration.make_step_simulator, u_mpc)
+        if k < n_steps - 1:
+            solve = loop.run_in_executor(executor, configuration.make_step_optimizer)
+            await asyncio.gather(plant, solve)
+        else:
+            await plant
+        # Measurement at the end of the interval
+        configuration.make_step_observer()
+        configuration.store_mpc_data(u_mpc, statistics)
+        x_measured = configuration.observer.observed_states
+        if configuration.optimizer.advanced_step and k < n_steps - 1:
+            configuration.correct_advanced_step(x_measured)
+    executor.shutdown()
+    return jitter_statistics(configuration)
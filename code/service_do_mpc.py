@@ -0,0 +1,207 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import sys
+import socket
+import asyncio
+import importlib.util
+import concurrent.futures
+import numpy as NP
+import core_do_mpc
+import plant_do_mpc
+from plant_do_mpc import FRAME_HEADER, FRAME_MAGIC, encode_frame, receive_frame, parse_address
+
+# Kinds of frames of the service (the sequence number of the frame header is the id of the plant)
+FRAME_SOLVE = 3
+FRAME_SOLUTION = 4
+FRAME_RESET = 5
+FRAME_ERROR = 6
+
+def load_template(example_path, name):
+    """ Import a template module from an example directory """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(example_path, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_configuration(example_path, setup_solver = True):
+    """ Create the configuration defined by the templates of an example directory """
+    model_1 = load_template(example_path, 'template_model').model()
+    optimizer_1 = load_template(example_path, 'template_optimizer').optimizer(model_1)
+    observer_1 = load_template(example_path, 'template_observer').observer(model_1)
+    simulator_1 = load_template(example_path, 'template_simulator').simulator(model_1)
+    configuration_1 = core_do_mpc.configuration(model_1, optimizer_1, observer_1, simulator_1)
+    if setup_solver:
+        configuration_1.setup_solver()
+    return configuration_1
+
+# Configuration of each worker process, loaded once by init_worker
+worker_configuration = None
+
+def init_worker(example_path):
+    global worker_configuration
+    worker_configuration = load_configuration(example_path)
+
+def solve_worker(x, u_prev, tv_p, warm_start):
+    """ Solve the MPC problem for the (unscaled) state x and previous input u_prev with the tv_p forecast.
+    The warm start of the plant (last results of the optimizer) is passed and returned, so that any
+    worker can serve any plant. Returns the (unscaled) optimal input and the new warm start """
+    configuration_1 = worker_configuration
+    model_1 = configuration_1.model
+    optimizer_1 = configuration_1.optimizer
+    arg = optimizer_1.arg
+    nlp_dict_out = optimizer_1.nlp_dict_out
+    X_offset = nlp_dict_out['X_offset']
+    nx = model_1.x.size(1)
+    ntv_p = model_1.tv_p.size(1)
+    nk = optimizer_1.n_horizon
+    # Initial state and parameters of the NLP
+    x_scaled = NP.ravel(x) / model_1.ocp.x_scaling
+    arg['lbx'][X_offset[0,0]:X_offset[0,0]+nx] = x_scaled
+    arg['ubx'][X_offset[0,0]:X_offset[0,0]+nx] = x_scaled
+    u_prev_scaled = NP.ravel(u_prev) / model_1.ocp.u_scaling
+    arg['p']["uk_prev"] = u_prev_scaled
+    if ntv_p > 0:
+        arg['p']["TV_P"] = NP.reshape(tv_p, (ntv_p, nk))
+    # Warm start of the plant
+    if warm_start is None:
+        arg['x0'] = nlp_dict_out['vars_init']
+        arg.pop('lam_x0', None)
+        arg.pop('lam_g0', None)
+        optimizer_1.opt_result_success = []
+        optimizer_1.n_fallback_steps = 0
+    else:
+        optimizer_1.opt_result_step, optimizer_1.opt_result_success, optimizer_1.n_fallback_steps = warm_start
+        arg['x0'] = optimizer_1.opt_result_step.optimal_solution
+        arg['lam_x0'] = optimizer_1.opt_result_step.lam_x
+        arg['lam_g0'] = optimizer_1.opt_result_step.lam_g
+    optimizer_1.u_mpc = u_prev_scaled
+    configuration_1.make_step_optimizer()
+    u_opt = NP.ravel(optimizer_1.u_mpc) * model_1.ocp.u_scaling
+    warm_start = (optimizer_1.opt_result_step, optimizer_1.opt_result_success, optimizer_1.n_fallback_steps)
+    return u_opt, warm_start
+
+class solve_service:
+    """ Local MPC solve service. A pool of worker processes holds prebuilt solvers of one configuration
+    and serves the solve requests of many plants (clients). The warm start of each plant is kept here """
+    def __init__(self, example_path, address, n_workers = None):
+        self.example_path = os.path.abspath(example_path)
+        self.family, self.address = parse_address(address)
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.dimensions = None
+        self.warm_starts = {}
+        self.n_requests = 0
+
+    async def handle_client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        nx, nu, n_tv_p = self.dimensions
+        try:
+            while True:
+                magic, kind, plant_id, t, n_values = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                if magic != FRAME_MAGIC:
+                    break
+                # The header is checked before the body is read: after an unexpected kind or size the frames
+                # cannot be delimited and the connection is closed
+                n_expected = {FRAME_RESET: 0, FRAME_SOLVE: nx + nu + n_tv_p}.get(kind)
+                if n_values != n_expected:
+                    writer.write(encode_frame(FRAME_ERROR, plant_id, t, []))
+                    await writer.drain()
+                    break
+                values = NP.frombuffer(await reader.readexactly(8 * n_values), dtype = '<f8')
+                if kind == FRAME_RESET:
+                    self.warm_starts.pop(plant_id, None)
+                    writer.write(encode_frame(FRAME_SOLUTION, plant_id, t, []))
+                else:
+                    try:
+                        u_opt, warm_start = await loop.run_in_executor(self.executor, solve_worker, values[:nx],
+                                                                       values[nx:nx+nu], values[nx+nu:], self.warm_starts.get(plant_id))
+                        self.warm_starts[plant_id] = warm_start
+                        self.n_requests = self.n_requests + 1
+                        writer.write(encode_frame(FRAME_SOLUTION, plant_id, t, u_opt))
+                    except Exception as error:
+                        print("Solve request of plant " + str(plant_id) + " failed: " + str(error))
+                        writer.write(encode_frame(FRAME_ERROR, plant_id, t, []))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def serve(self):
+        # The dimensions of the requests are read from a configuration without solver
+        configuration_1 = load_configuration(self.example_path, setup_solver = False)
+        nk = configuration_1.optimizer.n_horizon
+        self.dimensions = (configuration_1.model.x.size(1), configuration_1.model.u.size(1), configuration_1.model.tv_p.size(1) * nk)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = self.n_workers, initializer = init_worker,
+                                                               initargs = (self.example_path,))
+        # Build the solvers of all workers before accepting requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for i in range(self.n_workers)])
+        if self.family == socket.AF_UNIX:
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            server = await asyncio.start_unix_server(self.handle_client, path = self.address)
+        else:
+            server = await asyncio.start_server(self.handle_client, host = self.address[0], port = self.address[1])
+        print("Solve service with " + str(self.n_workers) + " workers listening on " + str(self.address))
+        async with server:
+            await server.serve_forever()
+
+class service_client:
+    """ Client of the solve service for one plant. Values are in physical (unscaled) units """
+    def __init__(self, address, plant_id, timeout = 10.0):
+        self.connector = plant_do_mpc.plant_connector(address, timeout = timeout)
+        self.plant_id = plant_id
+
+    def request(self, kind, t, values):
+        connector = self.connector
+        try:
+            if connector.sock is None:
+                connector.connect()
+            connector.sock.sendall(encode_frame(kind, self.plant_id, t, values))
+            kind, plant_id, t, values = receive_frame(connector.sock)
+        except (OSError, ConnectionError):
+            # The connection is opened again at the next request
+            connector.close()
+            raise
+        if kind == FRAME_ERROR:
+            raise Exception("The solve service could not solve the request of plant " + str(self.plant_id))
+        return NP.array(values)
+
+    def solve(self, x, u_prev, tv_p = [], t = 0.0):
+        """ Optimal (unscaled) input for the measured state x, the previous input and the tv_p forecast (ntv_p x n_horizon) """
+        return self.request(FRAME_SOLVE, t, NP.concatenate((NP.ravel(x), NP.ravel(u_prev), NP.ravel(tv_p))))
+
+    def reset(self):
+        """ Discard the warm start of the plant """
+        self.request(FRAME_RESET, 0.0, [])
+
+    def close(self):
+        self.connector.close()
+
+if __name__ == '__main__':
+    # Usage: python service_do_mpc.py <example directory> [address] [number of workers]
+    address = sys.argv[2] if len(sys.argv) > 2 else 'localhost:50001'
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    asyncio.run(solve_service(sys.argv[1], address, n_workers).serve())
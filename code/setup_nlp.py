@@ -26,27 +26,309 @@
 
 from casadi import *
 from casadi.tools import *
+import casadi
 import numpy as NP
 import core_do_mpc
 from copy import deepcopy
 import pdb
 
 
-def setup_nlp(model, optimizer):
+def split_squares(expr):
+    """ Split a scalar expression into a vector of residuals r and a remainder such that
+    expr = sum(r**2) + remainder. Used for the Gauss-Newton approximation of the Hessian """
+    residuals = []
+    remainder = 0
+    # Walk through the sums and the constant factors of the expression
+    stack = [(SX(expr), 1.0)]
+    while stack:
+        e, w = stack.pop()
+        if e.is_zero():
+            pass
+        elif e.is_op(OP_ADD):
+            stack += [(e.dep(0), w), (e.dep(1), w)]
+        elif e.is_op(OP_SUB):
+            stack += [(e.dep(0), w), (e.dep(1), -w)]
+        elif e.is_op(OP_NEG):
+            stack.append((e.dep(0), -w))
+        elif e.is_op(OP_MUL) and e.dep(0).is_constant():
+            stack.append((e.dep(1), w * float(e.dep(0))))
+        elif e.is_op(OP_MUL) and e.dep(1).is_constant():
+            stack.append((e.dep(0), w * float(e.dep(1))))
+        elif e.is_op(OP_DIV) and e.dep(1).is_constant():
+            stack.append((e.dep(0), w / float(e.dep(1))))
+        elif w > 0 and e.is_op(OP_SQ):
+            residuals.append(sqrt(w) * e.dep(0))
+        elif w > 0 and (e.is_op(OP_POW) or e.is_op(OP_CONSTPOW)) and e.dep(1).is_constant() and float(e.dep(1)) == 2:
+            residuals.append(sqrt(w) * e.dep(0))
+        else:
+            # Terms which are not a weighted square are kept with their exact Hessian
+            remainder += w * e
+    return vertcat(*residuals), remainder
+
+
+def split_bound_constraints(cons, cons_lb, cons_ub, x, u, p):
+    """ Find the rows of cons(x,u,p) that are affine in a single state or control and do not depend
+    on the parameters p. These rows are returned as bounds on the variables together with the
+    indices of the remaining rows """
+    nx = x.size1()
+    xu = vertcat(x, u)
+    xu_lb = -inf * NP.ones(xu.size1())
+    xu_ub = inf * NP.ones(xu.size1())
+    keep = []
+    for i in range(cons.size1()):
+        row = cons[i]
+        jac_row = jacobian(row, xu)
+        dependencies = jac_row.sparsity().get_col()
+        # Keep rows with parameters, several variables or nonlinear terms
+        if len(dependencies) != 1 or depends_on(jac_row, xu) or depends_on(row, p):
+            keep.append(i)
+            continue
+        j = dependencies[0]
+        # row = a * xu[j] + b
+        [b, a] = Function('row_fcn', [xu], [row, jac_row[j]])(NP.zeros(xu.size1()))
+        a = float(a)
+        b = float(b)
+        if a == 0:
+            keep.append(i)
+            continue
+        lb = (cons_lb[i] - b) / a
+        ub = (cons_ub[i] - b) / a
+        if a < 0:
+            [lb, ub] = [ub, lb]
+        xu_lb[j] = max(xu_lb[j], lb)
+        xu_ub[j] = min(xu_ub[j], ub)
+    return keep, xu_lb[:nx], xu_ub[:nx], xu_lb[nx:], xu_ub[nx:]
+
+
+def scale_model(model):
+    """ Substitute the scaled states and controls in all the model expressions in a single pass and
+    build one fused stage function with the right-hand side, the cost terms, the constraints and the
+    algebraic equations. The result is cached in the model and reused by the optimizer, simulator and observer """
+    x_scaling = model.ocp.x_scaling
+    u_scaling = model.ocp.u_scaling
+    cons_scaling = model.ocp.cons_scaling
+    cons_terminal_scaling = model.ocp.cons_terminal_scaling
+    scaled_model = model.scaled_model
+    if scaled_model is not None and NP.array_equal(scaled_model['x_scaling'], x_scaling) \
+            and NP.array_equal(scaled_model['u_scaling'], u_scaling) \
+            and NP.array_equal(scaled_model['cons_scaling'], cons_scaling) \
+            and NP.array_equal(scaled_model['cons_terminal_scaling'], cons_terminal_scaling):
+        return scaled_model
+    x = model.x
+    u = model.u
+    p = model.p
+    tv_p = model.tv_p
+    z = model.z
+    expressions = [model.rhs, model.ocp.lterm, model.ocp.cons, model.ocp.mterm, model.ocp.cons_terminal, model.alg]
+    expressions = substitute([SX(e) for e in expressions], [x, u], [x * x_scaling, u * u_scaling])
+    expressions[0] = expressions[0] / x_scaling
+    if expressions[2].size1() > 0:
+        expressions[2] = expressions[2] / cons_scaling
+    if expressions[4].size1() > 0:
+        expressions[4] = expressions[4] / cons_terminal_scaling
+    # Common subexpression elimination (not available in older versions of CasADi)
+    if hasattr(casadi, 'cse'):
+        expressions = casadi.cse(expressions)
+    [rhs, lterm, cons, mterm, cons_terminal, alg] = expressions
+    stage_fcn = Function('stage_fcn', [x, u, p, tv_p, z], expressions, ['x', 'u', 'p', 'tv_p', 'z'],
+                         ['rhs', 'lterm', 'cons', 'mterm', 'cons_terminal', 'alg'])
+    model.scaled_model = {
+        'x_scaling': deepcopy(x_scaling),
+        'u_scaling': deepcopy(u_scaling),
+        'cons_scaling': deepcopy(cons_scaling),
+        'cons_terminal_scaling': deepcopy(cons_terminal_scaling),
+        'rhs': rhs,
+        'lterm': lterm,
+        'cons': cons,
+        'mterm': mterm,
+        'cons_terminal': cons_terminal,
+        'alg': alg,
+        'stage_fcn': stage_fcn}
+    return model.scaled_model
+
+
+def dae_dict(model):
+    """ DAE of the scaled model for the integrators of CasADi with p = [u, p, tv_p] """
+    scaled_model = scale_model(model)
+    return {'x': model.x, 'z': model.z, 'p': vertcat(model.u, model.p, model.tv_p),
+            'ode': scaled_model['rhs'], 'alg': scaled_model['alg']}
+
+
+def lagrange_coefficients(tau_root):
+    """ Coefficients of the collocation equation (C) and of the continuity equation (D) for the
+    Lagrange polynomials with the given roots """
+    deg = len(tau_root) - 1
+    C = NP.zeros((deg + 1, deg + 1))
+    D = NP.zeros(deg + 1)
+    for j in range(deg + 1):
+        # Lagrange polynomial which is one at tau_root[j] and zero at the other collocation points
+        L = NP.poly1d([1.0])
+        for r in range(deg + 1):
+            if r != j:
+                L *= NP.poly1d([1.0, -tau_root[r]]) / (tau_root[j] - tau_root[r])
+        D[j] = L(1.0)
+        # Time derivative of the polynomial at all the collocation points
+        dL = NP.polyder(L)
+        for r in range(deg + 1):
+            C[j, r] = dL(tau_root[r])
+    return C, D
+
+
+# Precomputed collocation points and coefficients for Legendre and Radau collocation of degree 1 to 5
+collocation_tables = {}
+for coll_scheme in ('legendre', 'radau'):
+    for coll_degree in range(1, 6):
+        tau_root_table = [0] + collocation_points(coll_degree, coll_scheme)
+        collocation_tables[coll_scheme, coll_degree] = (tau_root_table,) + lagrange_coefficients(tau_root_table)
+
+
+def collocation_fcn(ffcn, nx, nu, np, ntv_p, t_step, deg, coll, ni, nz = 0):
+    """ Build the collocation and continuity equations of one control interval of length t_step with ni finite
+    elements. ffcn(x, u, p, tv_p, z) returns the right-hand side of the DAE as first output and the nz algebraic
+    equations as last output, which are imposed at each collocation point. Returns the function
+    ifcn(ik, xk0, pk, uk, tv_pk) -> [gk, xkf] and the number of implicitly defined variables ik (the differential
+    states followed by the algebraic states at the collocation points, see collocation_guess) """
+    # Choose collocation points and coefficients
+    if (coll, deg) in collocation_tables:
+        [tau_root, C, D] = collocation_tables[coll, deg]
+    elif coll in ('legendre', 'radau'):
+        tau_root = [0] + collocation_points(deg, coll)
+        [C, D] = lagrange_coefficients(tau_root)
+    else:
+        raise Exception('Unknown collocation scheme')
+
+    # Size of the finite elements
+    h = t_step / ni
+
+    # Initial condition
+    xk0 = MX.sym("xk0", nx)
+
+    # Parameter
+    pk = MX.sym("pk", np)
+    tv_pk = MX.sym("tv_pk", ntv_p)
+    # Control
+    uk = MX.sym("uk", nu)
+    # State trajectory
+    n_ik = ni * (deg + 1) * nx + ni * deg * nz
+    ik = MX.sym("ik", n_ik)
+    ik_split = NP.resize(NP.array([], dtype=MX), (ni, deg + 1))
+    zk_split = NP.resize(NP.array([], dtype=MX), (ni, deg + 1))
+    offset = 0
+
+    # Store initial condition
+    ik_split[0, 0] = xk0
+    first_j = 1  # Skip allocating x for the first collocation point for the first finite element
+
+    # For each finite element
+    for i in range(ni):
+        # For each collocation point
+        for j in range(first_j, deg + 1):
+            # Get the expression for the state vector
+            ik_split[i, j] = ik[offset:offset + nx]
+            offset += nx
+
+        # All collocation points in subsequent finite elements
+        first_j = 0
+
+    # Get the state at the end of the control interval
+    xkf = ik[offset:offset + nx]
+    offset += nx
+
+    # Algebraic states at the collocation points
+    for i in range(ni):
+        for j in range(1, deg + 1):
+            zk_split[i, j] = ik[offset:offset + nz]
+            offset += nz
+
+    # Check offset for consistency
+    assert(offset == n_ik)
+
+    # Constraints in the control interval
+    gk = []
+
+    # For all finite elements
+    for i in range(ni):
+
+        # For all collocation points
+        for j in range(1, deg + 1):
+
+            # Get an expression for the state derivative at the
+            # collocation point
+            xp_ij = 0
+            for r in range(deg + 1):
+                xp_ij += C[r, j] * ik_split[i, r]
+
+            # Add collocation equations to the NLP
+            ffcn_ij = ffcn.call([ik_split[i, j], uk, pk, tv_pk, zk_split[i, j]])
+            gk.append(h * ffcn_ij[0] - xp_ij)
+            # Add the algebraic equations
+            gk.append(ffcn_ij[-1])
+
+        # Get an expression for the state at the end of the finite element
+        xf_i = 0
+        for r in range(deg + 1):
+            xf_i += D[r] * ik_split[i, r]
+
+        # Add continuity equation to NLP
+        x_next = ik_split[i + 1, 0] if i + 1 < ni else xkf
+        gk.append(x_next - xf_i)
+
+    # Concatenate constraints
+    gk = vertcat(*gk)
+    assert(gk.size() == ik.size())
+
+    # Create the integrator function
+    ifcn = Function("ifcn", [ik, xk0, pk, uk, tv_pk], [gk, xkf])
+    return ifcn, n_ik
+
+
+def collocation_guess(x_value, z_value, n_ik, deg):
+    """ Values of the implicitly defined variables of collocation_fcn (n_ik variables, polynomials of degree deg)
+    with the differential states equal to x_value and the algebraic states equal to z_value """
+    nx = NP.size(x_value)
+    nz = NP.size(z_value)
+    ni = n_ik // ((deg + 1) * nx + deg * nz)
+    return NP.hstack((NP.tile(NP.ravel(x_value), ni * (deg + 1)), NP.tile(NP.ravel(z_value), ni * deg)))
+
+
+def prediction_grid(optimizer):
+    """ Length and number of finite elements of each interval of the prediction horizon. All the intervals have the
+    length t_step unless a non-uniform grid t_step_horizon is given. n_fin_elem is a number or a list with one value
+    per interval. Returns the lists t_steps and n_fin_elems and the start times t_grid (n_horizon + 1) """
+    nk = optimizer.n_horizon
+    t_steps = [optimizer.t_step] * nk if optimizer.t_step_horizon is None else list(optimizer.t_step_horizon)
+    n_fin_elems = list(optimizer.n_fin_elem) if NP.ndim(optimizer.n_fin_elem) > 0 else [optimizer.n_fin_elem] * nk
+    if len(t_steps) != nk or len(n_fin_elems) != nk:
+        raise Exception("The prediction grid must have n_horizon intervals")
+    # The first interval is the sampling time of the controller
+    if abs(t_steps[0] - optimizer.t_step) > 1e-10 * optimizer.t_step:
+        raise Exception("The first interval of the prediction grid must have the length t_step")
+    t_grid = NP.concatenate(([0.0], NP.cumsum(t_steps)))
+    return t_steps, n_fin_elems, t_grid
+
+
+def setup_nlp(model, optimizer, scenario_path = None):
+    """ Build the NLP of the multi-stage scenario tree. If a scenario_path (index of the parameter
+    realization at each stage) is given, the NLP of this single scenario is built instead: the
+    parameters of each stage are variables fixed by their bounds, so that the NLP of all
+    scenarios only differ in the bounds (see decomposition_do_mpc) """
 
     # Decode all the necessary parameters from the model and optimizer information
     # NOTE: The names of some variables are not consistent. But not critical
     # Parameters from optimizer
     nk = optimizer.n_horizon
-    n_robust = optimizer.n_robust
+    n_robust = optimizer.n_robust if scenario_path is None else 0
     t_step = optimizer.t_step
     deg = optimizer.poly_degree
     coll = optimizer.collocation
-    ni = optimizer.n_fin_elem
+    # Length and number of finite elements of each interval (non-uniform prediction grid)
+    [t_steps, n_fin_elems, t_grid] = prediction_grid(optimizer)
     open_loop = optimizer.open_loop
     uncertainty_values = optimizer.uncertainty_values
     #parameters_nlp = optimizer.parameters_nlp
     state_discretization = optimizer.state_discretization
+    hessian_approximation = optimizer.hessian_approximation
+    move_blocking = optimizer.move_blocking
     # Parameters from model
     x0 = model.ocp.x0
     u0 = model.ocp.u0
@@ -72,7 +354,6 @@ def setup_nlp(model, optimizer):
     p = model.p
     z = model.z
     tv_p = model.tv_p
-    xdot = model.rhs
 
     # Size of the state, control and parameter vector
 
@@ -80,51 +361,78 @@ def setup_nlp(model, optimizer):
     nu = u.size(1)
     np = p.size(1)
     ntv_p = tv_p.size(1)
+    nz = z.size(1)
+    # The algebraic states are variables of the NLP at the collocation points
+    if nz > 0 and state_discretization != 'collocation':
+        raise Exception("DAE models can only be discretized with collocation")
 
     # Generate, scale and initialize all the necessary functions
     # Consider as initial guess the initial conditions
     x_init = deepcopy(x0)
     u_init = deepcopy(u0)
-    up = vertcat(u, p)
-
-    # Right hand side of the ODEs
-    # NOTE: look scaling (appears to be fine)
-    for i in (x0, x_ub, x_lb, x_init):
-        i /= x_scaling
-    xdot = substitute(xdot, x, x * x_scaling) / x_scaling
-    for i in (u_ub, u_lb, u_init):
-        i /= u_scaling
-    xdot = substitute(xdot, u, u * u_scaling)
-    ffcn = Function('ffcn', [x, up, tv_p], [xdot])
-
-    # Constraints, possibly soft
-    # Epsilon for the soft constraints
-    cons = substitute(cons, x, x * x_scaling)
-    cons = substitute(cons, u, u * u_scaling)
+
+    # Scale the initial condition, the bounds and the initial guess
+    # NOTE: the arrays of the model are not modified
+    x0, x_ub, x_lb, x_init = [i / x_scaling for i in (x0, x_ub, x_lb, x_init)]
+    u_ub, u_lb, u_init = [i / u_scaling for i in (u_ub, u_lb, u_init)]
+    # Scale the bounds of the constraints
+    cons_ub = NP.array(cons_ub) / model.ocp.cons_scaling
+    cons_terminal_lb = NP.array(cons_terminal_lb) / model.ocp.cons_terminal_scaling
+    cons_terminal_ub = NP.array(cons_terminal_ub) / model.ocp.cons_terminal_scaling
+    # The soft constraints are scaled such that the penalty in the cost function is not modified
     if soft_constraint:
-        epsilon = SX.sym("epsilon", cons.size1())
-        cons = cons - epsilon
-        cfcn = Function('cfcn', [x, u, p, epsilon, tv_p], [cons])
+        maximum_violation = maximum_violation / model.ocp.cons_scaling
+        penalty_term_cons = penalty_term_cons * model.ocp.cons_scaling ** 2
+    # Fused stage function with the scaled right-hand side, cost terms and constraints
+    scaled_model = scale_model(model)
+    stage_fcn = scaled_model['stage_fcn']
+    cons = scaled_model['cons']
+    cons_terminal = scaled_model['cons_terminal']
+    mterm = scaled_model['mterm']
+    lterm = scaled_model['lterm']
+
+    # Hard constraints which are affine in a single state or control are not added to g
+    # but are imposed as bounds of the corresponding variables
+    n_cons = cons.size1()
+    n_cons_terminal = cons_terminal.size1()
+    cons_rows = list(range(n_cons))
+    cons_terminal_rows = list(range(n_cons_terminal))
+    x_lb_path, x_ub_path, u_lb_path, u_ub_path = x_lb, x_ub, u_lb, u_ub
+    if not soft_constraint and n_cons > 0:
+        [cons_rows, x_lb_cons, x_ub_cons, u_lb_cons, u_ub_cons] = split_bound_constraints(
+            cons, -inf * NP.ones(n_cons), cons_ub, x, u, vertcat(p, tv_p))
+        cons_ub = NP.array(cons_ub)[cons_rows]
+        x_lb_path = NP.maximum(x_lb, x_lb_cons)
+        x_ub_path = NP.minimum(x_ub, x_ub_cons)
+        u_lb_path = NP.maximum(u_lb, u_lb_cons)
+        u_ub_path = NP.minimum(u_ub, u_ub_cons)
+    if n_cons_terminal > 0:
+        [cons_terminal_rows, x_lb_cons, x_ub_cons, u_lb_cons, u_ub_cons] = split_bound_constraints(
+            cons_terminal, cons_terminal_lb, cons_terminal_ub, x, u, vertcat(p, tv_p))
+        cons_terminal_lb = NP.array(cons_terminal_lb)[cons_terminal_rows]
+        cons_terminal_ub = NP.array(cons_terminal_ub)[cons_terminal_rows]
+        x_lb_terminal = NP.maximum(x_lb_path, x_lb_cons)
+        x_ub_terminal = NP.minimum(x_ub_path, x_ub_cons)
+        u_lb_terminal = NP.maximum(u_lb_path, u_lb_cons)
+        u_ub_terminal = NP.minimum(u_ub_path, u_ub_cons)
     else:
-        cfcn = Function('cfcn', [x, u, p, tv_p], [cons])
-    cons_terminal = substitute(cons_terminal, x, x * x_scaling)
-    cons_terminal = substitute(cons_terminal, u, u * u_scaling)
-    cfcn_terminal = Function('cfcn', [x, u, p], [cons_terminal])
-    # Mayer term of the cost functions
-    mterm = substitute(mterm, x, x * x_scaling)
-    mterm = substitute(mterm, u, u * u_scaling)
-    mfcn = Function('mfcn', [x, u, p, tv_p], [mterm])
-    # Lagrange term of the cost function
-    lterm = substitute(lterm, x, x * x_scaling)
-    lterm = substitute(lterm, u, u * u_scaling)
-    lagrange_fcn = Function('lagrange_fcn', [x, u, p, tv_p], [lterm])
+        x_lb_terminal, x_ub_terminal = x_lb_path, x_ub_path
+        u_lb_terminal, u_ub_terminal = u_lb_path, u_ub_path
+    n_bound_constraints = n_cons + n_cons_terminal - len(cons_rows) - len(cons_terminal_rows)
+    # Number of nonlinear constraints in g (possibly soft) at each stage
+    n_cons = len(cons_rows)
     # Penalty term for the control inputs
     u_prev = SX.sym("u_prev", nu)
     du = u - u_prev
     R = diag(SX(rterm))
-    rterm = substitute(rterm, x, x * x_scaling)
-    rterm = substitute(rterm, u, u * u_scaling)
     rfcn = Function('rfcn', [u_prev, u], [mtimes(du.T, mtimes(R, du))])
+    # Residual form of the cost terms for the Gauss-Newton Hessian
+    if hessian_approximation == 'gauss-newton':
+        [lterm_res, lterm_rest] = split_squares(lterm)
+        lagrange_res_fcn = Function('lagrange_res_fcn', [x, u, p, tv_p], [lterm_res, lterm_rest])
+        [mterm_res, mterm_rest] = split_squares(mterm)
+        mres_fcn = Function('mres_fcn', [x, u, p, tv_p], [mterm_res, mterm_rest])
+        rres_fcn = Function('rres_fcn', [u_prev, u], [sqrt(SX(rterm)) * du])
     """
     -----------------------------------------------------------------------------------
     Build the scenario tree given the possible values of the uncertain parmeters
@@ -172,150 +480,17 @@ def setup_nlp(model, optimizer):
     # Collocation discretization
     if state_discretization == 'collocation':
 
-        # Choose collocation points
-        if coll == 'legendre':    # Legendre collocation points
-            tau_root = [0] + collocation_points(deg, 'legendre')
-        elif coll == 'radau':     # Radau collocation points
-            tau_root = [0] + collocation_points(deg, 'radau')
-        else:
-            raise Exception('Unknown collocation scheme')
-
-        # Size of the finite elements
-        h = t_step / ni
-
-        # Coefficients of the collocation equation
-        C = NP.zeros((deg + 1, deg + 1))
-
-        # Coefficients of the continuity equation
-        D = NP.zeros(deg + 1)
-
-        # Dimensionless time inside one control interval
-        tau = SX.sym("tau")
-
-        # All collocation time points
-        T = NP.zeros((nk, ni, deg + 1))
-        for k in range(nk):
-            for i in range(ni):
-                for j in range(deg + 1):
-                    T[k, i, j] = h * (k * ni + i + tau_root[j])
-
-        # For all collocation points
-        for j in range(deg + 1):
-            # Construct Lagrange polynomials to get the polynomial basis at the
-            # collocation point
-            L = 1
-            for r in range(deg + 1):
-                if r != j:
-                    L *= (tau - tau_root[r]) / (tau_root[j] - tau_root[r])
-            lfcn = Function('lfcn', [tau], [L])
-            D[j] = lfcn(1.0)
-            # Evaluate the time derivative of the polynomial at all collocation
-            # points to get the coefficients of the continuity equation
-            tfcn = Function('tfcn', [tau], [tangent(L, tau)])
-            for r in range(deg + 1):
-                C[j, r] = tfcn(tau_root[r])
-
-        # Initial condition
-        xk0 = MX.sym("xk0", nx)
-
-        # Parameter
-        pk = MX.sym("pk", np)
-        tv_pk = MX.sym("tv_pk", ntv_p)
-        # Control
-        uk = MX.sym("uk", nu)
-        #uk_prev = MX.sym ("uk_prev",nu)
-        # State trajectory
-        n_ik = ni * (deg + 1) * nx
-        ik = MX.sym("ik", n_ik)
-        ik_split = NP.resize(NP.array([], dtype=MX), (ni, deg + 1))
-
-        # All variables with bounds and initial guess
-        ik_lb = NP.zeros(n_ik)
-        ik_ub = NP.zeros(n_ik)
-        ik_init = NP.zeros(n_ik)
-        offset = 0
-
-        # Store initial condition
-        ik_split[0, 0] = xk0
-        first_j = 1  # Skip allocating x for the first collocation point for the first finite element
+        # Create the integrator functions with the collocation and continuity equations (one for each
+        # different length and number of finite elements of the intervals)
+        ifcn_grid = {}
+        for key in zip(t_steps, n_fin_elems):
+            if key not in ifcn_grid:
+                ifcn_grid[key] = collocation_fcn(stage_fcn, nx, nu, np, ntv_p, key[0], deg, coll, key[1], nz)
+        ifcn = [ifcn_grid[key][0] for key in zip(t_steps, n_fin_elems)]
+        n_ik = [ifcn_grid[key][1] for key in zip(t_steps, n_fin_elems)]
 
         # Penalty terms for the soft constraints
-        EPSILON = NP.resize(NP.array([], dtype=MX), (cons.size1()))
-
-        # For each finite element
-        for i in range(ni):
-            # For each collocation point
-            for j in range(first_j, deg + 1):
-                # Get the expression for the state vector
-                ik_split[i, j] = ik[offset:offset + nx]
-
-                # Add the initial condition
-                ik_init[offset:offset + nx] = x_init
-
-                # Add bounds
-                ik_lb[offset:offset + nx] = x_lb
-                ik_ub[offset:offset + nx] = x_ub
-                offset += nx
-
-            # All collocation points in subsequent finite elements
-            first_j = 0
-
-        # Get the state at the end of the control interval
-        xkf = ik[offset:offset + nx]
-
-        # Add the initial condition
-        ik_init[offset:offset + nx] = x_init
-
-        # Add bounds
-        ik_lb[offset:offset + nx] = x_lb
-        ik_ub[offset:offset + nx] = x_ub
-        offset += nx
-
-        # Check offset for consistency
-        assert(offset == n_ik)
-
-        # Constraints in the control interval
-        gk = []
-        lbgk = []
-        ubgk = []
-
-        # For all finite elements
-        for i in range(ni):
-
-            # For all collocation points
-            for j in range(1, deg + 1):
-
-                    # Get an expression for the state derivative at the
-                    # collocation point
-                xp_ij = 0
-                for r in range(deg + 1):
-                    xp_ij += C[r, j] * ik_split[i, r]
-
-                # Add collocation equations to the NLP
-                [f_ij] = ffcn.call([ik_split[i, j], vertcat(uk, pk), tv_pk])
-                gk.append(h * f_ij - xp_ij)
-                lbgk.append(NP.zeros(nx))  # equality constraints
-                ubgk.append(NP.zeros(nx))  # equality constraints
-
-            # Get an expression for the state at the end of the finite element
-            xf_i = 0
-            for r in range(deg + 1):
-                xf_i += D[r] * ik_split[i, r]
-
-            # Add continuity equation to NLP
-            x_next = ik_split[i + 1, 0] if i + 1 < ni else xkf
-            gk.append(x_next - xf_i)
-            lbgk.append(NP.zeros(nx))
-            ubgk.append(NP.zeros(nx))
-
-        # Concatenate constraints
-        gk = vertcat(*gk)
-        lbgk = NP.concatenate(lbgk)
-        ubgk = NP.concatenate(ubgk)
-        assert(gk.size() == ik.size())
-
-        # Create the integrator function
-        ifcn = Function("ifcn", [ik, xk0, pk, uk, tv_pk], [gk, xkf])
+        EPSILON = NP.resize(NP.array([], dtype=MX), (n_cons))
     # FIXME: update so that multiple_shooting works
     elif state_discretization == 'multiple-shooting':
 
@@ -340,17 +515,19 @@ def setup_nlp(model, optimizer):
         ifcn = integrator("simulator_ms", 'cvodes', dae, opts)
 
         # No implicitly defined variables
-        n_ik = 0
+        n_ik = [0] * nk
         # Penalty terms for the soft constraints
-        EPSILON = NP.resize(NP.array([], dtype=MX), (cons.size1()))
+        EPSILON = NP.resize(NP.array([], dtype=MX), (n_cons))
         #uk_prev = MX.sym ("uk_prev",nu)
 
     elif state_discretization == 'discrete-time':
         # no need to define an integrator for the discrete-time case
+        if optimizer.t_step_horizon is not None:
+            raise Exception("A non-uniform prediction grid is not possible for discrete-time models")
         # No implicitly defined variables
-        n_ik = 0
+        n_ik = [0] * nk
         # Penalty terms for the soft constraints
-        EPSILON = NP.resize(NP.array([], dtype=MX), (cons.size1()))
+        EPSILON = NP.resize(NP.array([], dtype=MX), (n_cons))
         #uk_prev = MX.sym ("uk_prev",nu)
         pass
 
@@ -359,6 +536,20 @@ def setup_nlp(model, optimizer):
 
     # Calculate the number of scenarios for x and u
     n_scenarios = [len(p_scenario)**min(k, n_robust) for k in range(nk + 1)]
+    # Move blocking: new control variables only at the first interval of each block, the other
+    # intervals share the control of the previous interval (of the parent scenario)
+    if move_blocking is None:
+        move_blocking = [1] * nk
+    if sum(move_blocking) != nk:
+        raise Exception("The move blocking " + str(move_blocking) + " does not cover the prediction horizon")
+    block_start = [False] * nk
+    block_last = [False] * nk
+    k_start = 0
+    for block in move_blocking:
+        block_start[k_start] = True
+        # The terminal bounds of the inputs apply to the control of the last block
+        block_last[k_start] = (k_start + block == nk)
+        k_start += block
     # Scenaro tree structure
     child_scenario = NP.resize(
         NP.array([-1], dtype=int), (nk, n_scenarios[-1], n_branches[0]))
@@ -384,19 +575,35 @@ def setup_nlp(model, optimizer):
             else:
                 branch_offset[k][s] = s % n_branches[0]
 
-    # Count the total number of variables
-    NV = len(p_scenario) * np
+    # Count the total number of variables (the parameters of each realization or of each stage of the scenario path)
+    n_p_vars = len(p_scenario) if scenario_path is None else nk
+    NV = n_p_vars * np
     for k in range(nk):
-        NV += n_scenarios[k] * (nu + nx + n_branches[k] * n_ik)
+        NV += n_scenarios[k] * (nu * block_start[k] + nx + n_branches[k] * n_ik[k])
     NV += n_scenarios[nk] * nx  # End point
 
     if soft_constraint:
                     # If soft constraints are implemented
-        NV += cons.size1()
+        NV += n_cons
     # Weighting factor for every scenario
     omega = [1. / n_scenarios[k + 1] for k in range(nk)]
     omega_delta_u = [1. / n_scenarios[k + 1] for k in range(nk)]
     #omega_delta_u[0] =1./n_scenarios[0+1]
+    # Weight of the penalty of the soft constraints of each interval
+    omega_soft = [1. for k in range(nk)]
+    # The NLP of a single scenario gets its share of the cost of the scenario tree, so that the sum of the
+    # NLP of all the scenarios is the NLP of the tree (the input changes of the robust stages are penalized
+    # n_branches times per branch and the soft constraints of each node once)
+    if scenario_path is not None:
+        n_robust_tree = min(optimizer.n_robust, nk)
+        n_branches_tree = [len(p_scenario) if k < n_robust_tree else 1 for k in range(nk)]
+        n_scenarios_tree = [len(p_scenario) ** min(k, n_robust_tree) for k in range(nk + 1)]
+        n_leaves = float(n_scenarios_tree[nk])
+        omega = [1. / n_leaves for k in range(nk)]
+        omega_delta_u = [n_branches_tree[k] / n_leaves for k in range(nk)]
+        omega_soft = [n_scenarios_tree[k + 1] / n_leaves for k in range(nk)]
+    # The Lagrange term of the coarse intervals of a non-uniform grid is weighted with their length
+    omega_lterm = [omega[k] * t_steps[k] / t_step for k in range(nk)]
 
     # NLP variable vector
     V = MX.sym("V", NV)
@@ -408,11 +615,12 @@ def setup_nlp(model, optimizer):
     offset = 0
 
     # Get parameters
-    P = NP.resize(NP.array([], dtype=MX), (len(p_scenario)))
-    for b in range(len(p_scenario)):
+    P = NP.resize(NP.array([], dtype=MX), (n_p_vars))
+    for b in range(n_p_vars):
         P[b] = V[offset:offset + np]
-        vars_lb[offset:offset + np] = p_scenario[b]
-        vars_ub[offset:offset + np] = p_scenario[b]
+        p_value = p_scenario[b] if scenario_path is None else p_scenario[scenario_path[b]]
+        vars_lb[offset:offset + np] = p_value
+        vars_ub[offset:offset + np] = p_value
         offset += np
 
     # Get collocated states and parametrized control
@@ -430,6 +638,7 @@ def setup_nlp(model, optimizer):
     X_offset = NP.resize(NP.array([-1], dtype=int), X.shape)
     U_offset = NP.resize(NP.array([-1], dtype=int), U.shape)
     E_offset = NP.resize(NP.array([-1], dtype=int), EPSILON.shape)
+    I_offset = NP.resize(NP.array([-1], dtype=int), (nk, n_scenarios[-1], n_branches[0]))
     for k in range(nk):
         # For all scenarios
         for s in range(n_scenarios[k]):
@@ -445,8 +654,8 @@ def setup_nlp(model, optimizer):
                 vars_ub[offset:offset + nx] = x0
 
             else:
-                vars_lb[offset:offset + nx] = x_lb
-                vars_ub[offset:offset + nx] = x_ub
+                vars_lb[offset:offset + nx] = x_lb_path
+                vars_ub[offset:offset + nx] = x_ub_path
             offset += nx
 
             # State trajectory if collocation
@@ -455,19 +664,24 @@ def setup_nlp(model, optimizer):
                 # For all uncertainty realizations
                 for b in range(n_branches[k]):
                     # Get an expression for the implicitly defined variables
-                    I[k, s, b] = V[offset:offset + n_ik]
-
-                    # Add the initial condition and bounds
-                    vars_init[offset:offset + n_ik] = ik_init
-                    vars_lb[offset:offset + n_ik] = ik_lb
-                    vars_ub[offset:offset + n_ik] = ik_ub
-                    offset += n_ik
-
-            # Parametrized controls
+                    I[k, s, b] = V[offset:offset + n_ik[k]]
+                    I_offset[k, s, b] = offset
+
+                    # Add the initial condition and bounds (all the collocation states have the same bounds)
+                    vars_init[offset:offset + n_ik[k]] = collocation_guess(x_init, model.ocp.z0, n_ik[k], deg)
+                    vars_lb[offset:offset + n_ik[k]] = collocation_guess(x_lb, model.ocp.z_lb, n_ik[k], deg)
+                    vars_ub[offset:offset + n_ik[k]] = collocation_guess(x_ub, model.ocp.z_ub, n_ik[k], deg)
+                    offset += n_ik[k]
+
+            # Parametrized controls (shared with the previous interval inside a block)
+            if not block_start[k]:
+                U[k, s] = U[k - 1, parent_scenario[k][s]]
+                U_offset[k, s] = U_offset[k - 1, parent_scenario[k][s]]
+                continue
             U[k, s] = V[offset:offset + nu]
             U_offset[k, s] = offset
-            vars_lb[offset:offset + nu] = u_lb
-            vars_ub[offset:offset + nu] = u_ub
+            vars_lb[offset:offset + nu] = u_lb_path if not block_last[k] else u_lb_terminal
+            vars_ub[offset:offset + nu] = u_ub_path if not block_last[k] else u_ub_terminal
             vars_init[offset:offset + nu] = u_init
             offset += nu
 
@@ -476,18 +690,18 @@ def setup_nlp(model, optimizer):
     for s in range(n_scenarios[nk]):
         X[nk, s] = V[offset:offset + nx]
         X_offset[nk, s] = offset
-        vars_lb[offset:offset + nx] = x_lb
-        vars_ub[offset:offset + nx] = x_ub
+        vars_lb[offset:offset + nx] = x_lb_terminal
+        vars_ub[offset:offset + nx] = x_ub_terminal
         vars_init[offset:offset + nx] = x_init
         offset += nx
     if soft_constraint:
             # Last elements (epsilon) for soft constraints
-        EPSILON = V[offset:offset + cons.size1()]
+        EPSILON = V[offset:offset + n_cons]
         E_offset = offset
-        vars_lb[offset:offset + cons.size1()] = NP.zeros(cons.size1())
-        vars_ub[offset:offset + cons.size1()] = maximum_violation
-        vars_init[offset:offset + cons.size1()] = 0
-        offset += cons.size1()
+        vars_lb[offset:offset + n_cons] = NP.zeros(n_cons)
+        vars_ub[offset:offset + n_cons] = maximum_violation
+        vars_init[offset:offset + n_cons] = 0
+        offset += n_cons
 
     # Check offset for consistency
     assert(offset == NV)
@@ -499,9 +713,16 @@ def setup_nlp(model, optimizer):
 
     # Objective function in the NLP
     J = 0
+    # Residuals and remainder of the objective (only for the Gauss-Newton Hessian)
+    J_res = []
+    J_rest = 0
+
+    # First row of the constraints of each interval (the non-anticipativity constraints follow the last one)
+    G_offset = NP.resize(NP.array([-1], dtype=int), (nk + 1))
 
     # For all control intervals
     for k in range(nk):
+        G_offset[k] = NP.sum([NP.size(lbg_i) for lbg_i in lbg], dtype=int)
         # For all scenarios
         for s in range(n_scenarios[k]):
 
@@ -513,19 +734,19 @@ def setup_nlp(model, optimizer):
             for b in range(n_branches[k]):
 
                 # Parameter realization
-                P_ksb = P[b + branch_offset[k][s]]
+                P_ksb = P[b + branch_offset[k][s]] if scenario_path is None else P[k]
 
                 if state_discretization == 'collocation':
 
                     # Call the inlined integrator
-                    [g_ksb, xf_ksb] = ifcn.call(
+                    [g_ksb, xf_ksb] = ifcn[k].call(
                         [I[k, s, b], X_ks, P_ksb, U_ks, TV_P[:, k]])
 
                     # Add equations defining the implicitly defined variables
                     # (i.e. collocation and continuity equations) to the NLP
                     g.append(g_ksb)
-                    lbg.append(NP.zeros(n_ik))  # equality constraints
-                    ubg.append(NP.zeros(n_ik))  # equality constraints
+                    lbg.append(NP.zeros(n_ik[k]))  # equality constraints
+                    ubg.append(NP.zeros(n_ik[k]))  # equality constraints
 
                 elif state_discretization == 'multiple-shooting':
 
@@ -536,55 +757,68 @@ def setup_nlp(model, optimizer):
                     xf_ksb = ifcn_out['xf']
 
                 elif state_discretization == 'discrete-time':
-                    [xf_ksb] = ffcn.call(
-                        [X_ks, vertcat(U_ks, P_ksb), TV_P[:, k]])
+                    xf_ksb = stage_fcn.call(
+                        [X_ks, U_ks, P_ksb, TV_P[:, k], NP.zeros(nz)])[0]
 
                 # Add continuity equation to NLP
                 g.append(X[k + 1, child_scenario[k][s][b]] - xf_ksb)
                 lbg.append(NP.zeros(nx))
                 ubg.append(NP.zeros(nx))
 
+                # Evaluate the cost terms and the constraints at the end of the interval (they do not depend
+                # on the algebraic states)
+                [_, lterm_ksb, cons_ksb, mterm_ksb, cons_terminal_ksb, _] = stage_fcn.call(
+                    [xf_ksb, U_ks, P_ksb, TV_P[:, k], NP.zeros(nz)])
+
                 # Add extra constraints depending on other states
-                # pdb.set_trace()
+                residual = cons_ksb[cons_rows]
                 if soft_constraint:
-                    [residual] = cfcn.call(
-                        [xf_ksb, U_ks, P_ksb, EPSILON, TV_P[:, k]])
-                else:
-                    [residual] = cfcn.call(
-                        [xf_ksb, U_ks, P_ksb, TV_P[:, k]])
+                    residual = residual - EPSILON
                 g.append(residual)
-                lbg.append(NP.ones(cons.size1()) * (-inf))
+                lbg.append(NP.ones(n_cons) * (-inf))
                 ubg.append(cons_ub)
 
                 # Add terminal constraints
                 if k == nk - 1:
-                    [residual_terminal] = cfcn_terminal.call(
-                        [xf_ksb, U_ks, P_ksb])
-                    g.append(residual_terminal)
+                    g.append(cons_terminal_ksb[cons_terminal_rows])
                     lbg.append(cons_terminal_lb)
                     ubg.append(cons_terminal_ub)
                 # Add contribution to the cost
-                if k < nk - 1:
-                    [J_ksb] = lagrange_fcn.call(
-                        [xf_ksb, U_ks, P_ksb, TV_P[:, k]])
-                else:
-                    [J_ksb] = mfcn.call([xf_ksb, U_ks, P_ksb, TV_P[:, k]])
-                J += omega[k] * J_ksb
+                J_ksb = lterm_ksb if k < nk - 1 else mterm_ksb
+                omega_ksb = omega_lterm[k] if k < nk - 1 else omega[k]
+                J += omega_ksb * J_ksb
+                if hessian_approximation == 'gauss-newton':
+                    if k < nk - 1:
+                        [res_ksb, rest_ksb] = lagrange_res_fcn.call(
+                            [xf_ksb, U_ks, P_ksb, TV_P[:, k]])
+                    else:
+                        [res_ksb, rest_ksb] = mres_fcn.call(
+                            [xf_ksb, U_ks, P_ksb, TV_P[:, k]])
+                    J_res.append(sqrt(omega_ksb) * res_ksb)
+                    J_rest += omega_ksb * rest_ksb
 
                 # Add contribution to the cost of the soft constraints penalty
                 # term
                 if soft_constraint:
                         # pdb.set_trace()
-                    for index_soft in range(cons.size1()):
+                    for index_soft in range(n_cons):
                         J_ksb_soft = penalty_term_cons[index_soft] * \
                             (EPSILON[index_soft])**2
-                        J += J_ksb_soft
-                # Penalize deviations in u
+                        J += omega_soft[k] * J_ksb_soft
+                    if hessian_approximation == 'gauss-newton':
+                        J_res.append(sqrt(omega_soft[k] * DM(penalty_term_cons)) * EPSILON)
+                # Penalize deviations in u (they are zero inside a block)
+                if not block_start[k]:
+                    continue
                 s_parent = parent_scenario[k][s]
                 u_prev = U[k - 1, s_parent] if k > 0 else uk_prev
                 [du_k] = rfcn.call([u_prev, U[k, s]])
                 J += omega_delta_u[k] * n_branches[k] * du_k
+                if hessian_approximation == 'gauss-newton':
+                    [res_du_k] = rres_fcn.call([u_prev, U[k, s]])
+                    J_res.append(sqrt(omega_delta_u[k] * n_branches[k]) * res_du_k)
 
+    G_offset[nk] = NP.sum([NP.size(lbg_i) for lbg_i in lbg], dtype=int)
     # Add non-anticipativity constraints for open-loop multi-stage NMPC
     if open_loop == 1:
         for kk in range(1, nk):
@@ -600,11 +834,30 @@ def setup_nlp(model, optimizer):
 
     nlp_fcn = {'f': J, 'x': V, 'p': parameters_setup_nlp, 'g': g}
 
+    # Generalized Gauss-Newton Hessian: the curvature of the squared residuals is
+    # approximated with first derivatives only and the curvature of the constraints is neglected
+    if hessian_approximation == 'gauss-newton':
+        J_res = vertcat(*J_res)
+        sigma = MX.sym("sigma")
+        lam_g = MX.sym("lam_g", g.size1())
+        jac_res = jacobian(J_res, V)
+        [hess_rest, _] = hessian(J_rest, V)
+        hess_gn = sigma * (2 * mtimes(jac_res.T, jac_res) + hess_rest)
+        hess_lag = Function('nlp_hess_l', [V, parameters_setup_nlp, sigma, lam_g], [triu(hess_gn)],
+                            ['x', 'p', 'lam_f', 'lam_g'], ['triu_hess_gamma_x_x'])
+        hess_lag = hess_lag.expand()
+    else:
+        hess_lag = None
+
     nlp_dict_out = {
         'nlp_fcn': nlp_fcn,
         'X_offset': X_offset,
         'U_offset': U_offset,
         'E_offset': E_offset,
+        'I_offset': I_offset,
+        'G_offset': G_offset,
+        'n_ik': n_ik,
+        't_grid': t_grid,
         'vars_lb': vars_lb,
         'vars_ub': vars_ub,
         'vars_init': vars_init,
@@ -614,6 +867,10 @@ def setup_nlp(model, optimizer):
         'child_scenario': child_scenario,
         'n_branches': n_branches,
         'n_scenarios': n_scenarios,
-        'p_scenario': p_scenario}
+        'branch_offset': branch_offset,
+        'p_scenario': p_scenario,
+        'hess_lag': hess_lag,
+        'n_bound_constraints': n_bound_constraints,
+        'block_start': block_start}
 
     return nlp_dict_out
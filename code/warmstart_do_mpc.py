@@ -0,0 +1,128 @@
+#
+#   This file is part of do-mpc
+#
+#   do-mpc: An environment for the easy, modular and efficient implementation of
+#        robust nonlinear model predictive control
+#
+#   Copyright (c) 2014-2016 Sergio Lucia, Alexandru Tatulea-Codrean
+#                        TU Dortmund. All rights reserved
+#
+#   do-mpc is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as
+#   published by the Free Software Foundation, either version 3
+#   of the License, or (at your option) any later version.
+#
+#   do-mpc is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with do-mpc.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import numpy as NP
+from scipy.spatial import cKDTree
+
+class warm_start_store:
+    """ A store of optimal solutions (primal and dual) of past runs indexed by the observed (scaled) states and the
+    forecast of the time-varying parameters. It is attached to a configuration (configuration.warm_start_store) and
+    used to warm start the optimizer after a cold start or when the shifted guess is far from the measurement """
+    def __init__(self, file_name, max_size = 1000, distance_threshold = 0.1, tv_p_weight = 1.0, save_every = 20):
+        self.file_name = file_name
+        # Maximum number of stored solutions. The least recently used solution is evicted
+        self.max_size = max_size
+        # Distance (in scaled states) between the measurement and the predicted state above which the store is queried
+        self.distance_threshold = distance_threshold
+        # Weight of the tv_p forecast in the distance (0 to index only the states)
+        self.tv_p_weight = tv_p_weight
+        # Number of new solutions after which the store is written to disk
+        self.save_every = save_every
+        self.keys = None
+        self.primal = None
+        self.lam_x = None
+        self.lam_g = None
+        self.last_used = None
+        self.counter = 0
+        self.n_unsaved = 0
+        self.tree = None
+        if os.path.isfile(self.file_name):
+            self.load()
+
+    def __len__(self):
+        return 0 if self.keys is None else self.keys.shape[0]
+
+    def key(self, states, tv_p):
+        """ Key of the index: scaled states and weighted tv_p forecast """
+        return NP.concatenate((NP.ravel(states), self.tv_p_weight * NP.ravel(tv_p)))
+
+    def add(self, states, tv_p, primal, lam_x, lam_g):
+        """ Add an optimal solution to the store, evicting the least recently used one if the store is full """
+        key = self.key(states, tv_p)
+        primal = NP.ravel(primal)
+        lam_x = NP.ravel(lam_x)
+        lam_g = NP.ravel(lam_g)
+        # Discard the stored solutions if they belong to a different NLP
+        if len(self) > 0 and (self.keys.shape[1] != key.size or self.primal.shape[1] != primal.size or self.lam_g.shape[1] != lam_g.size):
+            self.keys = None
+        self.counter += 1
+        if len(self) == 0:
+            self.keys = NP.array([key])
+            self.primal = NP.array([primal])
+            self.lam_x = NP.array([lam_x])
+            self.lam_g = NP.array([lam_g])
+            self.last_used = NP.array([self.counter])
+        elif len(self) < self.max_size:
+            self.keys = NP.vstack((self.keys, key))
+            self.primal = NP.vstack((self.primal, primal))
+            self.lam_x = NP.vstack((self.lam_x, lam_x))
+            self.lam_g = NP.vstack((self.lam_g, lam_g))
+            self.last_used = NP.append(self.last_used, self.counter)
+        else:
+            index = NP.argmin(self.last_used)
+            self.keys[index] = key
+            self.primal[index] = primal
+            self.lam_x[index] = lam_x
+            self.lam_g[index] = lam_g
+            self.last_used[index] = self.counter
+        # The KD-tree is rebuilt at the next query
+        self.tree = None
+        self.n_unsaved += 1
+        if self.n_unsaved >= self.save_every:
+            self.save()
+
+    def query(self, states, tv_p):
+        """ Return the primal and dual solution stored for the nearest key and its distance, or None if the store is empty """
+        key = self.key(states, tv_p)
+        if len(self) == 0 or self.keys.shape[1] != key.size:
+            return None
+        if self.tree is None:
+            self.tree = cKDTree(self.keys)
+        [distance, index] = self.tree.query(key)
+        self.counter += 1
+        self.last_used[index] = self.counter
+        return self.primal[index], self.lam_x[index], self.lam_g[index], distance
+
+    def save(self):
+        """ Write the store to disk """
+        if len(self) > 0:
+            NP.savez_compressed(self.file_name, keys = self.keys, primal = self.primal, lam_x = self.lam_x,
+                                lam_g = self.lam_g, last_used = self.last_used)
+        self.n_unsaved = 0
+
+    def load(self):
+        """ Read the store from disk """
+        data = NP.load(self.file_name)
+        self.keys = data['keys']
+        self.primal = data['primal']
+        self.lam_x = data['lam_x']
+        self.lam_g = data['lam_g']
+        self.last_used = data['last_used']
+        self.counter = int(NP.max(self.last_used))
+        # Respect the size cap if it was reduced
+        if len(self) > self.max_size:
+            index = NP.argsort(self.last_used)[-self.max_size:]
+            self.keys, self.primal, self.lam_x, self.lam_g, self.last_used = \
+                self.keys[index], self.primal[index], self.lam_x[index], self.lam_g[index], self.last_used[index]
+        self.tree = None
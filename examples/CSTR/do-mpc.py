@@ -59,6 +59,14 @@ observer_1 = template_observer.observer(model_1)
 simulator_1 = template_simulator.simulator(model_1)
 # Create a configuration
 configuration_1 = core_do_mpc.configuration(model_1, optimizer_1, observer_1, simulator_1)
+# Optionally warm start from the solutions of past runs stored on disk
+#import warmstart_do_mpc
+#configuration_1.warm_start_store = warmstart_do_mpc.warm_start_store('warm_start_CSTR.npz')
+# Optionally simulate reproducible random parameters and noise (one seed for the whole run)
+#import disturbance_do_mpc
+#simulator_1.disturbances = disturbance_do_mpc.disturbance_scenario(configuration_1, seed = 1,
+#    p_real = {'kind': 'piecewise_constant', 'std': [0.05, 0.05], 'hold': 10},
+#    measurement_noise = {'kind': 'correlated', 'std': [0.01, 0.01, 0.1, 0.1], 'correlation': 0.5})
 
 # Set up the solvers
 configuration_1.setup_solver()
@@ -141,6 +141,7 @@ def model():
     u0 = NP.array([30.0,-6000.0])
 
     # Scaling factors for the states and control inputs. Important if the system is ill-conditioned
+    # Use 'auto' to compute them from the initial values and the bounds (see aux_do_mpc.auto_scaling)
     x_scaling = NP.array([1.0, 1.0, 1.0, 1.0])
     u_scaling = NP.array([1.0, 1.0])
 
@@ -22,11 +22,21 @@
 #
 
 from casadi import *
+import numpy as NP
 import core_do_mpc
 def observer(model):
 
-	# Full state feedback
-	observer_dict = {'x':1}
+	# Choose the state estimation: full state feedback ('state_feedback'), an extended ('ekf') or unscented ('ukf')
+	# Kalman filter or moving horizon estimation ('mhe')
+	method = 'state_feedback'
+	# Measured outputs (None if all the states are measured), for example only the temperatures T_R and T_K
+	meas = None
+	#meas = vertcat(model.x[2], model.x[3])
+	# Covariances of the process noise (over one simulator step) and of the measurement noise (diagonals)
+	Q = NP.array([1e-6, 1e-6, 1e-4, 1e-4])
+	R = NP.array([1e-4, 1e-4, 1e-2, 1e-2]) if meas is None else NP.array([1e-2, 1e-2])
+
+	observer_dict = {'x':1, 'method':method, 'meas':meas, 'Q':Q, 'R':R}
 	observer = core_do_mpc.observer(model,observer_dict)
 	# here some functions depending on observer_1
 
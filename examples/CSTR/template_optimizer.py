@@ -61,6 +61,16 @@ def optimizer(model):
 
     linear_solver = 'mumps'
 
+    # Hessian of the Lagrangian: 'exact', 'gauss-newton' (cheaper for least-squares
+    # cost functions) or 'limited-memory' (L-BFGS)
+    hessian_approximation = 'exact'
+
+    # Real-time mode: wall-clock budget (in seconds) of each optimization (None: no limit)
+    # and control input applied if it is exceeded or the solver fails: 'shift' (previous
+    # optimal solution), 'safe' (u_safe, u0 by default) or a function of the configuration
+    time_budget = None
+    fallback = 'shift'
+
     # GENERATE C CODE shared libraries NOTE: Not currently supported
     generate_code = 0
 
@@ -85,14 +95,16 @@ def optimizer(model):
     number_steps = int(t_end/t_step) + 1
     # Number of time-varying parameters
     n_tv_p = 2
-    tv_p_values = NP.resize(NP.array([]),(number_steps,n_tv_p,n_horizon))
-    for time_step in range (number_steps):
+    # The forecast (n_tv_p x n_horizon) of each sampling time is given by a function of the step instead of an array
+    # (number_steps x n_tv_p x n_horizon) of all the steps. Generators and the providers of forecast_do_mpc
+    # (memory-mapped files, sliding windows of received forecasts) can also be used
+    def tv_p_values(time_step):
         if time_step < number_steps/2:
             tv_param_1_values = 0.6*NP.ones(n_horizon)
         else:
             tv_param_1_values = 0.8*NP.ones(n_horizon)
         tv_param_2_values = 0.9*NP.ones(n_horizon)
-        tv_p_values[time_step] = NP.array([tv_param_1_values,tv_param_2_values])
+        return NP.array([tv_param_1_values,tv_param_2_values])
     # Parameteres of the NLP which may vary along the time (For example a set point that varies at a given time)
     set_point = SX.sym('set_point')
     parameters_nlp = NP.array([set_point])
@@ -109,6 +121,8 @@ def optimizer(model):
     'n_fin_elem': n_fin_elem,'generate_code':generate_code,'open_loop': open_loop,
     'uncertainty_values':uncertainty_values,'parameters_nlp':parameters_nlp,
     'state_discretization':state_discretization,'nlp_solver': nlp_solver,
-    'linear_solver':linear_solver, 'qp_solver':qp_solver, 'tv_p_values':tv_p_values}
+    'linear_solver':linear_solver, 'qp_solver':qp_solver, 'tv_p_values':tv_p_values,
+    'hessian_approximation':hessian_approximation, 'time_budget':time_budget,
+    'fallback':fallback}
     optimizer_1 = core_do_mpc.optimizer(model,optimizer_dict)
     return optimizer_1
@@ -32,11 +32,15 @@ def simulator(model):
     template_simulator: integration options
     --------------------------------------------------------------------------
     """
-    # Choose the simulator time step
+    # Choose the simulator time step (the t_step of the optimizer can be a multiple
+    # of it: the optimizer then runs every t_step / t_step_simulator simulator steps)
     t_step_simulator = 0.005
+    # Number of sub-steps of the integration of each simulator step
+    n_substeps = 1
     # Choose options for the integrator
     opts = {"abstol":1e-10,"reltol":1e-10, 'tf':t_step_simulator}
-    # Choose integrator: for example 'cvodes' for ODEs or 'idas' for DAEs
+    # Choose integrator: for example 'cvodes' for ODEs or 'idas' for DAEs, or the fixed-step
+    # 'rk4' and 'radau' with opts = {'number_of_finite_elements': 4} (see integrator_do_mpc)
     integration_tool = 'cvodes'
 
     # Choose the real value of the uncertain parameters that will be used
@@ -74,8 +78,11 @@ def simulator(model):
     """
 
     simulator_dict = {'integration_tool':integration_tool,'plot_states':plot_states,
-    'plot_control': plot_control,'plot_anim': plot_anim,'export_to_matlab': export_to_matlab,'export_name': export_name, 'p_real_now':p_real_now, 't_step_simulator': t_step_simulator, 'integrator_opts': opts, 'tv_p_real_now':tv_p_real_now}
+    'plot_control': plot_control,'plot_anim': plot_anim,'export_to_matlab': export_to_matlab,'export_name': export_name, 'p_real_now':p_real_now, 't_step_simulator': t_step_simulator, 'integrator_opts': opts, 'tv_p_real_now':tv_p_real_now, 'n_substeps':n_substeps}
 
     simulator_1 = core_do_mpc.simulator(model, simulator_dict)
+    # To apply the control moves to a plant listening on a TCP ('host:port') or Unix socket
+    # (for example the stand-in plant started with: python plant_do_mpc.py <example directory>)
+    #simulator_1 = core_do_mpc.simulator.application(model, simulator_dict, 'localhost:50000')
 
     return simulator_1
@@ -64,6 +64,22 @@ def optimizer(model):
     # GENERATE C CODE shared libraries NOTE: Not currently supported
     generate_code = 0
 
+    # Initial guess of the first optimization: 'constant' (x0 and u0 everywhere)
+    # or 'simulation' (forward simulation of the model with u0 for each scenario)
+    initial_guess = 'simulation'
+
+    # Move blocking: number of intervals in each block that share the same control
+    # input (must add up to n_horizon), for example [1,1,2,4,4,8]. None: no blocking
+    move_blocking = None
+
+    # Non-uniform prediction grid: length of each of the n_horizon intervals, the first one is t_step,
+    # for example n_horizon = 11 and [1,1,1,1,1,1,2,2,2,4,4] for the same look-ahead. None: uniform grid
+    t_step_horizon = None
+
+    # Shrinking-horizon mode: the optimization covers the remaining batch time. It
+    # requires n_horizon = int(t_end / t_step)
+    shrinking_horizon = False
+
     """
     --------------------------------------------------------------------------
     template_optimizer: uncertain parameters
@@ -106,6 +122,7 @@ def optimizer(model):
     'n_fin_elem': n_fin_elem,'generate_code':generate_code,'open_loop': open_loop,
     'uncertainty_values':uncertainty_values,'parameters_nlp':parameters_nlp,
     'state_discretization':state_discretization,'nlp_solver': nlp_solver,
-    'linear_solver':linear_solver, 'qp_solver':qp_solver, 'tv_p_values':tv_p_values}
+    'linear_solver':linear_solver, 'qp_solver':qp_solver, 'tv_p_values':tv_p_values,
+    'initial_guess':initial_guess, 'move_blocking':move_blocking, 't_step_horizon':t_step_horizon, 'shrinking_horizon':shrinking_horizon}
     optimizer_1 = core_do_mpc.optimizer(model,optimizer_dict)
     return optimizer_1
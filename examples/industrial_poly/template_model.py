@@ -198,6 +198,7 @@ def model():
     u0   = NP.array([m_dot_f_0 , T_in_M_0, T_in_EK_0])
 
     # Scaling factors for the states and control inputs. Important if the system is ill-conditioned
+    # Use 'auto' to compute them from the initial values and the bounds (see aux_do_mpc.auto_scaling)
     x_scaling=NP.array([10.0, 10.0, 10.0, 1.0, 1.0, 1.0, 1.0, 1.0, 10,1])
     u_scaling = NP.array([100.0, 1.0, 1.0])
 
@@ -61,9 +61,17 @@ def optimizer(model):
 
     linear_solver = 'mumps'
 
+    # Hessian of the Lagrangian: 'exact', 'gauss-newton' (cheaper for least-squares
+    # cost functions) or 'limited-memory' (L-BFGS)
+    hessian_approximation = 'gauss-newton'
+
     # GENERATE C CODE shared libraries NOTE: Not currently supported
     generate_code = 0
 
+    # Initial guess of the first optimization: 'constant' (x0 and u0 everywhere)
+    # or 'simulation' (forward simulation of the model with u0 for each scenario)
+    initial_guess = 'simulation'
+
     """
     --------------------------------------------------------------------------
     template_optimizer: uncertain parameters
@@ -106,6 +114,7 @@ def optimizer(model):
     'n_fin_elem': n_fin_elem,'generate_code':generate_code,'open_loop': open_loop,
     'uncertainty_values':uncertainty_values,'parameters_nlp':parameters_nlp,
     'state_discretization':state_discretization,'nlp_solver': nlp_solver,
-    'linear_solver':linear_solver, 'qp_solver':qp_solver, 'tv_p_values':tv_p_values}
+    'linear_solver':linear_solver, 'qp_solver':qp_solver, 'tv_p_values':tv_p_values,
+    'hessian_approximation':hessian_approximation, 'initial_guess':initial_guess}
     optimizer_1 = core_do_mpc.optimizer(model,optimizer_dict)
     return optimizer_1
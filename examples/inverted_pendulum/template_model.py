@@ -49,12 +49,11 @@ def model():
 
     # Define the differential states as CasADi symbols
     x 	   = SX.sym("x")               # x position of the mass
-    y 	   = SX.sym("y")		          # y position of the mass
     v     = SX.sym("v")              # linear velocity of the mass
     theta = SX.sym("theta")          # angle of the metal rod
     omega = SX.sym("omega")          # angular velocity of the mass
     # Define the algebraic states as CasADi symbols
-    #y 		= SX.sym("y")          # the y coordinate is considered algebraic
+    y 		= SX.sym("y")          # the y coordinate is considered algebraic
 
     # Define the control inputs as CasADi symbols
     F  	= SX.sym("F")             # control force applied to the lever
@@ -78,8 +77,8 @@ def model():
 
     _x = vertcat(x,v,theta,omega)
 
-    _z = []                                # toggle if there are no AE in your model
-    #_z = vertcat(y)
+    #_z = []                                # toggle if there are no AE in your model
+    _z = vertcat(y)
 
     _u = vertcat(F)
 
@@ -87,8 +86,8 @@ def model():
 
     _xdot = vertcat(dd)
 
-    _zdot = []                          # toggle if there are no AE in your model
-    #_zdot = vertcat(dtrajectory)
+    #_alg = []                          # toggle if there are no AE in your model
+    _alg = vertcat(dy)
 
     _tv_p = vertcat(tv_param_1)
     """
@@ -106,7 +105,7 @@ def model():
     y_init  = sqrt(3.0)/2.0
 
     x0 = NP.array([x_init, v_init, t_init, o_init])
-    z0 = NP.array([])
+    z0 = NP.array([y_init])            # initial guess, the simulator computes consistent values
     # Bounds on the states. Use "inf" for unconstrained states
     x_lb    =  -10.0;       x_ub  = 10.0
     v_lb    = -10.0;       v_ub  = 10.0
@@ -116,8 +115,8 @@ def model():
 
     x_lb = NP.array([x_lb, v_lb, t_lb, o_lb])
     x_ub = NP.array([x_ub, v_ub, t_ub, o_ub])
-    z_lb = NP.array([])
-    z_ub = NP.array([])
+    z_lb = NP.array([-inf])
+    z_ub = NP.array([inf])
     # Bounds on the control inputs. Use "inf" for unconstrained inputs
     F_lb    = -250.0;       F_ub = 250.00 ;     F_init = 0.0	;
 
@@ -172,7 +171,7 @@ def model():
     template_model: pass information (not necessary to edit)
     --------------------------------------------------------------------------
      """
-    model_dict = {'x':_x,'u': _u, 'rhs':_xdot,'p': _p, 'z':_z,'x0': x0,'x_lb': x_lb,'x_ub': x_ub, 'u0':u0, 'u_lb':u_lb, 'u_ub':u_ub, 'x_scaling':x_scaling, 'u_scaling':u_scaling, 'cons':cons,
+    model_dict = {'x':_x,'u': _u, 'rhs':_xdot,'p': _p, 'z':_z, 'alg':_alg, 'z0':z0, 'z_lb':z_lb, 'z_ub':z_ub,'x0': x0,'x_lb': x_lb,'x_ub': x_ub, 'u0':u0, 'u_lb':u_lb, 'u_ub':u_ub, 'x_scaling':x_scaling, 'u_scaling':u_scaling, 'cons':cons,
     "cons_ub": cons_ub, 'cons_terminal':cons_terminal, 'cons_terminal_lb': cons_terminal_lb,'tv_p':_tv_p, 'cons_terminal_ub':cons_terminal_ub, 'soft_constraint': soft_constraint, 'penalty_term_cons': penalty_term_cons, 'maximum_violation': maximum_violation, 'mterm': mterm,'lterm':lterm, 'rterm':rterm}
 
     model = core_do_mpc.model(model_dict)
@@ -37,7 +37,7 @@ def simulator(model):
     # Choose options for the integrator
     opts = {"abstol":1e-10,"reltol":1e-10, 'tf':t_step_simulator}
     # Choose integrator: for example 'cvodes' for ODEs or 'idas' for DAEs
-    integration_tool = 'cvodes'
+    integration_tool = 'idas'
 
     # Choose the real value of the uncertain parameters that will be used
     # to perform the simulation of the system. They can be constant or time-varying
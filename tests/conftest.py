@@ -0,0 +1,44 @@
+import os
+import sys
+import types
+import pytest
+
+CODE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code')
+EXAMPLES_PATH = os.path.join(os.path.dirname(CODE_PATH), 'examples')
+sys.path.insert(0, CODE_PATH)
+
+import matplotlib
+matplotlib.use('Agg')
+
+
+def load_template(example, name, replacements = None):
+    """ Load template_<name>.py of an example, with the source replaced by the given {old: new} pairs """
+    file_name = os.path.join(EXAMPLES_PATH, example, 'template_' + name + '.py')
+    with open(file_name) as template_file:
+        source = template_file.read()
+    for old, new in (replacements or {}).items():
+        assert old in source, old
+        source = source.replace(old, new)
+    module = types.ModuleType('template_' + name)
+    module.__file__ = file_name
+    exec(compile(source, file_name, 'exec'), module.__dict__)
+    return getattr(module, name)
+
+
+@pytest.fixture
+def example(monkeypatch, tmp_path):
+    """ Build the configuration of an example. The keyword arguments give the source replacements of each
+    template (model, optimizer, observer, simulator) """
+    import core_do_mpc
+    monkeypatch.chdir(tmp_path)
+
+    def build(name, setup_solver = True, **replacements):
+        model = load_template(name, 'model', replacements.get('model'))()
+        optimizer = load_template(name, 'optimizer', replacements.get('optimizer'))(model)
+        observer = load_template(name, 'observer', replacements.get('observer'))(model)
+        simulator = load_template(name, 'simulator', replacements.get('simulator'))(model)
+        configuration = core_do_mpc.configuration(model, optimizer, observer, simulator)
+        if setup_solver:
+            configuration.setup_solver()
+        return configuration
+    return build
@@ -0,0 +1,25 @@
+import numpy as NP
+import aux_do_mpc
+
+
+def test_recommend_collocation_in_the_loop(example):
+    configuration = example('CSTR')
+    for step in range(3):
+        configuration.make_step_optimizer()
+        configuration.make_step_simulator()
+        configuration.make_step_observer()
+        configuration.prepare_next_iter()
+    configuration.make_step_optimizer()
+    u_prev = NP.array(configuration.optimizer.arg['p']['uk_prev'])
+    x_current = NP.ravel(configuration.observer.observed_states)
+    degree = configuration.optimizer.poly_degree
+    [deg, ni, error] = aux_do_mpc.recommend_collocation(configuration, tol = 1e-8, apply = True, max_degree = degree + 1, max_fin_elem = 1)
+    assert deg == degree + 1
+    optimizer = configuration.optimizer
+    # The new NLP is solved from the current state with the current previous input
+    X_offset = optimizer.nlp_dict_out['X_offset']
+    nx = configuration.model.x.size1()
+    x0 = NP.ravel(optimizer.opt_result_step.optimal_solution)[X_offset[0, 0]:X_offset[0, 0] + nx]
+    NP.testing.assert_allclose(x0, x_current)
+    NP.testing.assert_allclose(NP.array(optimizer.arg['p']['uk_prev']), u_prev)
+    assert not NP.allclose(x_current, configuration.model.ocp.x0 / configuration.model.ocp.x_scaling)
@@ -0,0 +1,58 @@
+import numpy as NP
+import pytest
+import decomposition_do_mpc
+
+ROBUST_CSTR = {'model': {'rterm = NP.array([0.0, 0.0])': 'rterm = NP.array([0.1, 0.0])'},
+               'optimizer': {'n_robust = 0': 'n_robust = 1'}}
+
+
+def solve(solver, arg):
+    return solver(x0 = arg['x0'], lbx = arg['lbx'], ubx = arg['ubx'], lbg = arg['lbg'], ubg = arg['ubg'], p = arg['p'])
+
+
+def test_admm_matches_the_monolithic_nlp(example):
+    configuration = example('CSTR', **ROBUST_CSTR)
+    optimizer = configuration.optimizer
+    arg = optimizer.arg
+    U_offset = optimizer.nlp_dict_out['U_offset']
+    nu = configuration.model.u.size1()
+    result = solve(optimizer.solver, arg)
+    admm = decomposition_do_mpc.admm_solver(configuration.model, optimizer, optimizer.nlp_dict_out,
+                                            {"expand": True, "ipopt.linear_solver": 'mumps'}, max_iter = 100)
+    result_admm = solve(admm, arg)
+    assert admm.stats()['success']
+    # The subproblems weight the cost (including rterm) with their share of the scenario tree
+    u0 = NP.ravel(result['x'][U_offset[0, 0]:U_offset[0, 0] + nu])
+    u0_admm = NP.ravel(result_admm['x'][U_offset[0, 0]:U_offset[0, 0] + nu])
+    NP.testing.assert_allclose(u0_admm, u0, rtol = 1e-3, atol = 1e-3)
+    assert abs(float(result_admm['f']) - float(result['f'])) < 1e-3 * abs(float(result['f']))
+
+
+def test_admm_without_iterations(example):
+    configuration = example('CSTR', **ROBUST_CSTR)
+    optimizer = configuration.optimizer
+    admm = decomposition_do_mpc.admm_solver(configuration.model, optimizer, optimizer.nlp_dict_out,
+                                            {"expand": True, "ipopt.linear_solver": 'mumps'}, max_iter = 0)
+    solve(admm, optimizer.arg)
+    assert admm.stats()['iter_count'] == 0
+    assert not admm.stats()['success']
+
+
+def test_admm_rejects_advanced_step(example):
+    configuration = example('CSTR', setup_solver = False, **ROBUST_CSTR)
+    configuration.optimizer.decomposition = 'admm'
+    configuration.optimizer.advanced_step = True
+    with pytest.raises(Exception, match = 'advanced_step'):
+        configuration.setup_solver()
+
+
+def test_setup_solver_stops_the_workers_of_the_previous_admm_solver(example):
+    configuration = example('CSTR', setup_solver = False, **ROBUST_CSTR)
+    configuration.optimizer.decomposition = 'admm'
+    configuration.optimizer.decomposition_options = {'n_workers': 1}
+    configuration.setup_solver()
+    previous = configuration.optimizer.solver
+    assert previous.executor is not None
+    configuration.setup_solver()
+    assert previous.executor is None
+    configuration.optimizer.solver.close()
@@ -0,0 +1,12 @@
+import numpy as NP
+import disturbance_do_mpc
+
+
+def test_bounds_apply_to_the_disturbed_signal(example):
+    configuration = example('CSTR', setup_solver = False)
+    nominal = NP.ravel(configuration.simulator.p_real_now(0.0))
+    lb, ub = 0.98 * nominal, 1.02 * nominal
+    scenario = disturbance_do_mpc.disturbance_scenario(configuration, seed = 1, n_steps = 50,
+        p_real = {'kind': 'random_walk', 'std': 0.05 * nominal, 'lb': lb, 'ub': ub})
+    assert NP.all(scenario.p_real >= lb) and NP.all(scenario.p_real <= ub)
+    assert NP.any(scenario.p_real == ub) or NP.any(scenario.p_real == lb)
@@ -0,0 +1,28 @@
+import numpy as NP
+from casadi import Function
+import aux_do_mpc
+
+
+def test_simulated_guess_with_move_blocking(example):
+    configuration = example('CSTR', setup_solver = False)
+    model = configuration.model
+    optimizer = configuration.optimizer
+    nk = optimizer.n_horizon
+    optimizer.move_blocking = [2] * (nk // 2)
+    optimizer.initial_guess = 'simulation'
+    # A different input in each interval: only the first one of each block is applied
+    optimizer.u_init_profile = model.ocp.u0 * NP.linspace(0.9, 1.1, nk)[:, None]
+    configuration.setup_solver()
+    nlp_dict_out = optimizer.nlp_dict_out
+    vars_init = NP.ravel(aux_do_mpc.initial_guess(model, optimizer, nlp_dict_out, optimizer.u_init_profile))
+    U_offset = nlp_dict_out['U_offset']
+    nu = model.u.size1()
+    for k in range(0, nk, 2):
+        NP.testing.assert_allclose(vars_init[U_offset[k, 0]:U_offset[k, 0] + nu] * model.ocp.u_scaling, optimizer.u_init_profile[k])
+    # The states are consistent with the stored inputs: the equality constraints of the dynamics hold (the
+    # parameters of the scenarios are variables fixed by their bounds)
+    nlp_fcn = nlp_dict_out['nlp_fcn']
+    v = NP.clip(vars_init, NP.ravel(nlp_dict_out['vars_lb']), NP.ravel(nlp_dict_out['vars_ub']))
+    g = NP.ravel(Function('g', [nlp_fcn['x'], nlp_fcn['p'].cat], [nlp_fcn['g']])(v, optimizer.arg['p'].cat))
+    equality = NP.ravel(nlp_dict_out['lbg']) == NP.ravel(nlp_dict_out['ubg'])
+    assert NP.max(NP.abs(g[equality])) < 1e-6
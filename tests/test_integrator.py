@@ -0,0 +1,15 @@
+import glob
+import os
+import tempfile
+from casadi import SX, Function, sin
+import integrator_do_mpc
+
+
+def test_compile_function_removes_the_generated_code():
+    x = SX.sym("x", 2)
+    fcn = Function("compiled_test", [x], [2 * sin(x)])
+    pattern = os.path.join(tempfile.gettempdir(), "do_mpc_*")
+    directories = set(glob.glob(pattern))
+    compiled = integrator_do_mpc.compile_function(fcn)
+    assert float(compiled([1.0, 2.0])[0]) == float(fcn([1.0, 2.0])[0])
+    assert set(glob.glob(pattern)) == directories
@@ -0,0 +1,14 @@
+import numpy as NP
+
+
+def test_ukf_with_an_indefinite_covariance(example):
+    configuration = example('CSTR', observer = {"method = 'state_feedback'": "method = 'ukf'"})
+    estimator = configuration.observer.estimator
+    configuration.make_step_optimizer()
+    configuration.make_step_simulator()
+    # Round-off made one eigenvalue of the covariance slightly negative
+    P = NP.array(estimator.P, dtype = float)
+    estimator.P = P - (NP.min(NP.linalg.eigvalsh(P)) + 1e-12) * NP.eye(P.shape[0])
+    configuration.make_step_observer()
+    assert NP.all(NP.isfinite(estimator.x))
+    assert NP.min(NP.linalg.eigvalsh(estimator.P)) > 0
@@ -0,0 +1,73 @@
+import os
+import socket
+import threading
+import time
+import numpy as NP
+import pytest
+import plant_do_mpc
+from plant_do_mpc import FRAME_HEADER, FRAME_MAGIC, encode_frame
+
+
+def start_server(configuration, address):
+    server = threading.Thread(target = plant_do_mpc.serve_plant, args = (address, configuration.simulator, configuration.model))
+    server.daemon = True
+    server.start()
+    t_start = time.time()
+    while not os.path.exists(address) and time.time() - t_start < 10:
+        time.sleep(0.01)
+    return server
+
+
+def send_raw(address, frames):
+    """ Send the frames on a new connection and return True if the plant closed it """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10.0)
+    sock.connect(address)
+    sock.sendall(frames)
+    try:
+        closed = sock.recv(1) == b''
+    except ConnectionResetError:
+        # Closed with the rest of the frame still unread
+        closed = True
+    sock.close()
+    return closed
+
+
+def test_malformed_frames_only_close_their_connection(example, tmp_path):
+    configuration = example('CSTR', setup_solver = False)
+    model = configuration.model
+    address = str(tmp_path / 'plant.sock')
+    server = start_server(configuration, address)
+    hello = encode_frame(plant_do_mpc.FRAME_HELLO, 1, 0.0, [])
+    # Too many control moves, a huge announced body and control moves without a session
+    assert send_raw(address, hello + encode_frame(plant_do_mpc.FRAME_CONTROL, 1, 0.0, NP.ones(5)))
+    assert send_raw(address, hello + FRAME_HEADER.pack(FRAME_MAGIC, plant_do_mpc.FRAME_CONTROL, 1, 0.0, 2 ** 32 - 1))
+    assert send_raw(address, encode_frame(plant_do_mpc.FRAME_CONTROL, 1, 0.0, model.ocp.u0))
+    assert server.is_alive()
+    connector = plant_do_mpc.plant_connector(address, timeout = 10.0, n_measurements = model.x.size1())
+    assert connector.exchange(model.ocp.u0, 0.0).size == model.x.size1()
+    connector.close()
+
+
+def test_new_client_is_not_answered_with_a_stale_measurement(example, tmp_path):
+    configuration = example('CSTR', setup_solver = False)
+    model = configuration.model
+    address = str(tmp_path / 'plant.sock')
+    start_server(configuration, address)
+    measurements = []
+    for client in range(2):
+        # Both clients start their sequence at 1
+        connector = plant_do_mpc.plant_connector(address, timeout = 10.0)
+        measurements.append(connector.exchange(model.ocp.u0, 0.0))
+        connector.close()
+    assert not NP.allclose(measurements[0], measurements[1])
+
+
+def test_connector_rejects_measurements_of_another_size(example, tmp_path):
+    configuration = example('CSTR', setup_solver = False)
+    model = configuration.model
+    address = str(tmp_path / 'plant.sock')
+    start_server(configuration, address)
+    connector = plant_do_mpc.plant_connector(address, timeout = 10.0, n_retries = 0, n_measurements = model.x.size1() + 1)
+    with pytest.raises(Exception, match = 'No measurement'):
+        connector.exchange(model.ocp.u0, 0.0)
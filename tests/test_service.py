@@ -0,0 +1,40 @@
+import asyncio
+import numpy as NP
+import service_do_mpc
+from plant_do_mpc import FRAME_HEADER, FRAME_MAGIC, encode_frame
+
+
+async def exchange(service, frame):
+    """ Send a frame to the handler of the service and return the reply and whether the connection was closed """
+    server = await asyncio.start_server(service.handle_client, host = '127.0.0.1', port = 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(frame)
+    await writer.drain()
+    magic, kind, plant_id, t, n_values = FRAME_HEADER.unpack(await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size), 5))
+    closed = await asyncio.wait_for(reader.read(), 5) == b''
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    return kind, plant_id, closed
+
+
+def test_malformed_header_is_rejected_before_the_body():
+    service = service_do_mpc.solve_service('.', '127.0.0.1:0')
+    service.dimensions = (4, 2, 10)
+    # A header announcing a huge body: the service answers and closes without waiting for the body
+    frame = FRAME_HEADER.pack(FRAME_MAGIC, service_do_mpc.FRAME_SOLVE, 7, 0.0, 2 ** 32 - 1)
+    kind, plant_id, closed = asyncio.run(exchange(service, frame))
+    assert (kind, plant_id, closed) == (service_do_mpc.FRAME_ERROR, 7, True)
+    frame = FRAME_HEADER.pack(FRAME_MAGIC, 99, 7, 0.0, 0)
+    assert asyncio.run(exchange(service, frame))[0] == service_do_mpc.FRAME_ERROR
+
+
+def test_reset_frame():
+    service = service_do_mpc.solve_service('.', '127.0.0.1:0')
+    service.dimensions = (4, 2, 10)
+    service.warm_starts[3] = None
+    frame = encode_frame(service_do_mpc.FRAME_RESET, 3, 0.0, []) + encode_frame(service_do_mpc.FRAME_RESET, 3, 0.0, NP.ones(1))
+    kind, plant_id, closed = asyncio.run(exchange(service, frame))
+    assert (kind, plant_id) == (service_do_mpc.FRAME_SOLUTION, 3)
+    assert 3 not in service.warm_starts
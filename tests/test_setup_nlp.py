@@ -0,0 +1,24 @@
+import numpy as NP
+import setup_nlp
+
+TERMINAL_TV_P = {
+    'cons_terminal = vertcat()': 'cons_terminal = vertcat(C_b - tv_param_1, C_b)',
+    'cons_terminal_lb = NP.array([])': 'cons_terminal_lb = NP.array([-inf, 0.0])',
+    'cons_terminal_ub = NP.array([])': 'cons_terminal_ub = NP.array([-0.05, 5.0])'}
+
+
+def test_terminal_constraint_with_tv_p(example):
+    configuration = example('CSTR_tv_parameters', model = TERMINAL_TV_P)
+    model = configuration.model
+    optimizer = configuration.optimizer
+    nlp_dict_out = setup_nlp.setup_nlp(model, optimizer)
+    # Only the row that does not depend on tv_p is imposed as a bound
+    assert nlp_dict_out['n_bound_constraints'] == 1
+    configuration.make_step_optimizer()
+    assert configuration.optimizer.solver.stats()['success']
+    v_opt = NP.ravel(configuration.optimizer.opt_result_step.optimal_solution)
+    X_offset = configuration.optimizer.nlp_dict_out['X_offset']
+    nk = optimizer.n_horizon
+    x_terminal = v_opt[X_offset[nk, 0]:X_offset[nk, 0] + model.x.size1()] * model.ocp.x_scaling
+    tv_param_1 = NP.array(configuration.optimizer.arg['p']['TV_P'])[0, nk - 1]
+    assert x_terminal[1] - tv_param_1 <= -0.05 + 1e-6
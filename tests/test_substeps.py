@@ -0,0 +1,45 @@
+import os
+import threading
+import time
+import numpy as NP
+from casadi import vertcat
+import plant_do_mpc
+import realtime_do_mpc
+
+
+def simulate_nominal(configuration, x, u, t):
+    """ Scaled states at the end of one simulator step of the template simulator """
+    simulator = configuration.simulator
+    p = vertcat(u, simulator.p_real_now(t), simulator.tv_p_real_now(t))
+    return NP.array(simulator.simulator(x0 = x, p = p)['xf'])[:, -1]
+
+
+def test_predict_state_with_substeps(example):
+    configuration = example('CSTR', simulator = {'n_substeps = 1': 'n_substeps = 2'})
+    x = NP.ravel(configuration.simulator.x0_sim)
+    u = configuration.model.ocp.u0 / configuration.model.ocp.u_scaling
+    x_next = realtime_do_mpc.predict_state(configuration, x, u, 0.0)
+    assert x_next.shape == x.shape
+    NP.testing.assert_allclose(x_next, simulate_nominal(configuration, x, u, 0.0))
+
+
+def test_plant_server_with_substeps(example, tmp_path):
+    configuration = example('CSTR', setup_solver = False, simulator = {'n_substeps = 1': 'n_substeps = 2'})
+    model = configuration.model
+    address = str(tmp_path / 'plant.sock')
+    server = threading.Thread(target = plant_do_mpc.serve_plant, args = (address, configuration.simulator, model))
+    server.daemon = True
+    server.start()
+    t_start = time.time()
+    while not os.path.exists(address) and time.time() - t_start < 10:
+        time.sleep(0.01)
+    connector = plant_do_mpc.plant_connector(address, timeout = 10.0)
+    x = NP.ravel(configuration.simulator.x0_sim)
+    u = model.ocp.u0
+    for step in range(2):
+        t = step * configuration.simulator.t_step_simulator
+        measurement = connector.exchange(u, t)
+        x = simulate_nominal(configuration, x, u / model.ocp.u_scaling, t)
+        NP.testing.assert_allclose(measurement, x * model.ocp.x_scaling, rtol = 1e-8)
+    assert server.is_alive()
+    connector.close()